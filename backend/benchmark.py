@@ -0,0 +1,473 @@
+"""Бенчмарк конвертера на синтетических выгрузках ОФД и электронных счетах
+
+Генераторы данных детерминированы (задаются seed), поэтому результаты разных
+коммитов можно сравнивать между собой. Время и пиковая память измеряются для
+всего конвейера и для каждого этапа отдельно; результат сохраняется в JSON.
+
+Запуск из каталога backend:
+    python benchmark.py --rows 10000,100000 --output bench.json
+    python benchmark.py --rows 10000 --compare bench.json
+    python benchmark.py --reports bill_batch --bill-counts 1000,5000
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from xml.sax.saxutils import quoteattr
+
+import numpy as np
+import pandas as pd
+
+import main
+
+try:
+    import resource
+except ImportError:  # нет в Windows, пиковая память процесса не сохраняется
+    resource = None
+
+logger = logging.getLogger("benchmark")
+
+EXCEL_REPORTS = ['checks', 'nomenclature', 'taxcom']
+BILL_FORMATS = ['upd', 'commerceml']
+
+# Справочники для генерации
+ITEM_NAMES = ['Хлеб', 'Молоко', 'Кофе', 'Чай', 'Консультация', 'Доставка', 'Ремонт', 'Сахар', 'Масло', 'Вода']
+ITEM_TYPES = ['Товар', 'Услуга', 'Работа', 'Агентское вознаграждение', 'Платеж']
+START_DATE = pd.Timestamp('2025-03-01')
+
+def _dates(rng: np.random.Generator, rows: int, days: int = 31) -> pd.Series:
+    """Отсортированные моменты времени за days дней, как в выгрузке за месяц"""
+    seconds = np.sort(rng.integers(0, days * 86400, rows))
+    return pd.Series(START_DATE + pd.to_timedelta(seconds, unit='s'))
+
+def _money(rng: np.random.Generator, rows: int, high: float) -> np.ndarray:
+    return np.round(rng.random(rows) * high, 2)
+
+def generate_checks(rows: int, seed: int = 0) -> pd.DataFrame:
+    """Отчет по чекам: приходы и возвраты, ПАТЕНТ и УСН"""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'Дата/время': _dates(rng, rows),
+        'Номер документа': np.arange(1, rows + 1),
+        'Признак расчета': rng.choice(['Приход', 'Возврат прихода'], rows, p=[0.95, 0.05]),
+        'Тип налогообложения': rng.choice(['ПАТЕНТ', 'УСН доход'], rows, p=[0.4, 0.6]),
+    })
+    for column in main.PAYMENT_COLUMNS:
+        df[column] = np.where(rng.random(rows) < 0.5, _money(rng, rows, 5000), 0.0)
+    return df
+
+def generate_nomenclature(rows: int, seed: int = 0) -> pd.DataFrame:
+    """Отчет по номенклатуре: чеки из нескольких позиций, предоплата и возвраты"""
+    rng = np.random.default_rng(seed)
+    # Номер чека растет на каждой позиции с вероятностью 1/3, в чеке в среднем три позиции
+    receipts = np.cumsum(rng.random(rows) < 1 / 3) + 1
+    first_line = np.r_[True, receipts[1:] != receipts[:-1]]
+
+    amounts = _money(rng, rows, 3000)
+    cash = np.where(rng.random(rows) < 0.4, amounts, 0.0)
+    card = amounts - cash
+    # Предоплата указывается в первой строке чека у каждого десятого чека
+    prepaid = first_line & (rng.random(rows) < 0.1)
+    prepayment = np.where(prepaid, _money(rng, rows, 4000), np.nan)
+    # Возвраты - целые чеки
+    returned = rng.random(receipts.max() + 1) < 0.05
+
+    return pd.DataFrame({
+        'Дата/время': _dates(rng, rows),
+        'Номер документа': receipts,
+        'Наименование': rng.choice(ITEM_NAMES, rows),
+        'Признак расчета (тег 1054)': np.where(returned[receipts], 'Возврат прихода', 'Приход'),
+        'Признак предмета расчета (тег 1212)': rng.choice(ITEM_TYPES, rows, p=[0.6, 0.2, 0.1, 0.05, 0.05]),
+        'Наличными по чеку': cash,
+        'Электронными по чеку': card,
+        'Сумма товара': amounts,
+        'Зачет предоплаты (аванса) по чеку': prepayment,
+    })
+
+def generate_taxcom(rows: int, seed: int = 0) -> pd.DataFrame:
+    """Такском отчет по чекам: даты строками, строка 'Итог' после каждого дня и в конце"""
+    rng = np.random.default_rng(seed)
+    moments = _dates(rng, rows)
+    cash = np.where(rng.random(rows) < 0.4, _money(rng, rows, 3000), 0.0)
+    cashless = np.where(cash == 0, _money(rng, rows, 3000), 0.0)
+    df = pd.DataFrame({
+        'Дата и время': moments.dt.strftime('%d.%m.%Y %H:%M:%S'),
+        'Номер чека': np.arange(1, rows + 1),
+        'Система налогообложения': rng.choice(['Патент', 'УСН доход'], rows, p=[0.4, 0.6]),
+        'Наличными': cash,
+        'Безналичными': cashless,
+        'Сумма': cash + cashless,
+    })
+
+    # Итоговые строки по дням
+    day = moments.dt.normalize()
+    totals = df.groupby(day.to_numpy())[['Наличными', 'Безналичными', 'Сумма']].sum().reset_index(drop=True)
+    totals.insert(0, 'Дата и время', 'Итог')
+    last_rows = np.flatnonzero(np.r_[day.to_numpy()[1:] != day.to_numpy()[:-1], True])
+    position = np.concatenate([np.arange(rows), last_rows + 0.5])
+    df = pd.concat([df, totals], ignore_index=True).iloc[np.argsort(position, kind='stable')]
+
+    grand_total = pd.DataFrame([{'Дата и время': 'Итог', 'Наличными': cash.sum(),
+                                 'Безналичными': cashless.sum(), 'Сумма': (cash + cashless).sum()}])
+    return pd.concat([df, grand_total], ignore_index=True)
+
+EXCEL_GENERATORS = {
+    'checks': generate_checks,
+    'nomenclature': generate_nomenclature,
+    'taxcom': generate_taxcom,
+}
+
+def to_xlsx(df: pd.DataFrame) -> bytes:
+    """Книга Excel с одним листом, как выгрузка из личного кабинета ОФД"""
+    buffer = io.BytesIO()
+    engine = 'xlsxwriter' if main.xlsxwriter is not None else 'openpyxl'
+    df.to_excel(buffer, index=False, engine=engine)
+    return buffer.getvalue()
+
+def _bill_items(rng: np.random.Generator, rows: int):
+    quantity = rng.integers(1, 20, rows)
+    price = _money(rng, rows, 5000)
+    names = rng.choice(ITEM_NAMES, rows)
+    return zip(range(1, rows + 1), names, quantity, price, np.round(quantity * price, 2))
+
+def generate_upd(rows: int, seed: int = 0) -> bytes:
+    """УПД (счет-фактура с передаточным документом) формата ФНС в windows-1251, rows строк товаров"""
+    rng = np.random.default_rng(seed)
+    file_id = f"ON_NSCHFDOPPR_2BE000000000001_2BE000000000002_20250302_{seed:08d}"
+    lines = [
+        '<?xml version="1.0" encoding="windows-1251"?>',
+        f'<Файл ИдФайл="{file_id}" ВерсФорм="5.01" ВерсПрог="benchmark">',
+        '<СвУчДокОбор ИдОтпр="2BE000000000001" ИдПол="2BE000000000002"/>',
+        '<Документ КНД="1115131" Функция="СЧФДОП" ПоФактХЖ="Документ об отгрузке товаров" '
+        'НаимДокОпр="Счет-фактура и документ об отгрузке товаров" ДатаИнфПр="02.03.2025" '
+        'ВремИнфПр="12.00.00" НаимЭконСубСост="ООО Ромашка" НомерСчФ="54" ДатаСчФ="02.03.2025">',
+        '<СвСчФакт НомерСчФ="54" ДатаСчФ="02.03.2025" КодОКВ="643">',
+        '<СвПрод ИННЮЛ="7700000001" КПП="770001001" НаимОрг="ООО Ромашка">'
+        '<ИдСв><СвЮЛУч НаимОрг="ООО Ромашка" ИННЮЛ="7700000001" КПП="770001001"/></ИдСв></СвПрод>',
+        '<СвПокуп ИННФЛ="471402006641" ФИО="Климова Надежда Владимировна">'
+        '<ИдСв><СвИП ИННФЛ="471402006641"><ФИО Фамилия="Климова" Имя="Надежда" Отчество="Владимировна"/>'
+        '</СвИП></ИдСв></СвПокуп>',
+        '</СвСчФакт>',
+        '<ТаблСчФакт>',
+    ]
+    total = 0.0
+    for number, name, quantity, price, amount in _bill_items(rng, rows):
+        total += amount
+        lines.append(
+            f'<СведТов НомСтр="{number}" НаимТов={quoteattr(str(name))} ОКЕИ_Тов="796" КолТов="{quantity}" '
+            f'ЦенаТов="{price:.2f}" СтТовБезНДС="{amount:.2f}" НалСт="без НДС" СтТовУчНал="{amount:.2f}">'
+            '<Акциз><БезАкциз>без акциза</БезАкциз></Акциз><СумНал><БезНДС>без НДС</БезНДС></СумНал></СведТов>'
+        )
+    lines += [
+        f'<ВсегоОпл СтТовБезНДСВсего="{total:.2f}" СтТовУчНалВсего="{total:.2f}">'
+        '<СумНалВсего><БезНДС>без НДС</БезНДС></СумНалВсего></ВсегоОпл>',
+        '</ТаблСчФакт>',
+        '</Документ>',
+        '</Файл>',
+    ]
+    return '\n'.join(lines).encode('windows-1251')
+
+def generate_commerceml(rows: int, seed: int = 0) -> bytes:
+    """Счет на оплату в формате CommerceML (выгрузка 1С, как в каталоге bill), rows строк товаров"""
+    rng = np.random.default_rng(seed)
+    items = []
+    total = 0.0
+    for number, name, quantity, price, amount in _bill_items(rng, rows):
+        total += amount
+        items.append(
+            f'<Товар><Ид>{number:08d}</Ид><Наименование>{name}</Наименование>'
+            '<БазоваяЕдиница Код="796" НаименованиеПолное="Штука">шт</БазоваяЕдиница>'
+            f'<ЦенаЗаЕдиницу>{price:.2f}</ЦенаЗаЕдиницу><Количество>{quantity}</Количество>'
+            f'<Сумма>{amount:.2f}</Сумма></Товар>'
+        )
+    text = '\n'.join([
+        '<?xml version="1.0" encoding="windows-1251"?>',
+        '<КоммерческаяИнформация xmlns="urn:1C.ru:commerceml_2" ВерсияСхемы="2.08" '
+        'ДатаФормирования="2025-03-02T12:00:00">',
+        '<Документ>',
+        f'<Ид>00000000-0000-0000-0000-{seed:012d}</Ид><Номер>54</Номер><Дата>2025-03-02</Дата>',
+        '<ХозОперация>Счет на оплату</ХозОперация><Роль>Продавец</Роль><Валюта>643</Валюта><Курс>1</Курс>',
+        f'<Сумма>{total:.2f}</Сумма>',
+        '<Контрагенты>',
+        '<Контрагент><ПолноеНаименование>ООО Ромашка</ПолноеНаименование><ИНН>7700000001</ИНН>'
+        '<КПП>770001001</КПП><Роль>Продавец</Роль></Контрагент>',
+        '<Контрагент><ПолноеНаименование>ИП Климова Надежда Владимировна</ПолноеНаименование>'
+        '<ИНН>471402006641</ИНН><Роль>Покупатель</Роль></Контрагент>',
+        '</Контрагенты>',
+        '<Товары>',
+        *items,
+        '</Товары>',
+        '</Документ>',
+        '</КоммерческаяИнформация>',
+    ])
+    return text.encode('windows-1251')
+
+BILL_GENERATORS = {
+    'upd': generate_upd,
+    'commerceml': generate_commerceml,
+}
+
+def measure(func, *args, trace_memory: bool = True, repeat: int = 1) -> tuple[object, dict]:
+    """Выполнение func с замером времени и пиковой памяти
+
+    Время - лучшее из repeat запусков без трассировки; пиковая память Python-объектов
+    и массивов numpy - отдельный запуск под tracemalloc.
+    """
+    seconds = []
+    result = None
+    for _ in range(max(repeat, 1)):
+        start = time.perf_counter()
+        result = func(*args)
+        seconds.append(time.perf_counter() - start)
+    stats = {'seconds': round(min(seconds), 4)}
+
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            func(*args)
+            stats['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, stats
+
+def _write_partitions(partitions: list) -> list[bytes]:
+    return [main.write_partition(df, sheet_name, add_totals, totals)
+            for _, sheet_name, df, add_totals, totals in partitions]
+
+def _write_partitions_parallel(pool: ProcessPoolExecutor, partitions: list) -> list[bytes]:
+    # Порядок результатов совпадает с порядком частей, как в write_partitions
+    futures = [pool.submit(main.write_partition, df, sheet_name, add_totals, totals)
+               for _, sheet_name, df, add_totals, totals in partitions]
+    return [future.result() for future in futures]
+
+def _zip_partitions(partitions: list, workbooks: list[bytes]) -> bytes:
+    return main.build_zip([(f"processed_{file_suffix}_bench.xlsx", data)
+                           for (file_suffix, *_), data in zip(partitions, workbooks)])
+
+def bench_excel(report_type: str, rows: int, seed: int, pool, trace_memory: bool, repeat: int) -> dict:
+    """Замер конвейера Excel отчета целиком и по этапам"""
+    logger.warning(f"Generating {report_type} report: {rows} rows")
+    content = to_xlsx(EXCEL_GENERATORS[report_type](rows, seed))
+
+    stages = {}
+    (detected_type, df), stages['read'] = measure(
+        main.read_excel_report, content, report_type, trace_memory=trace_memory, repeat=repeat)
+    partitions, stages['process'] = measure(
+        main.partition_report, df, detected_type, trace_memory=trace_memory, repeat=repeat)
+    workbooks, stages['write'] = measure(
+        _write_partitions, partitions, trace_memory=trace_memory, repeat=repeat)
+    _, stages['zip'] = measure(
+        _zip_partitions, partitions, workbooks, trace_memory=trace_memory, repeat=repeat)
+
+    result = {
+        'report': report_type,
+        'rows': rows,
+        'input_bytes': len(content),
+        'partitions': len(partitions),
+        'stages': stages,
+    }
+
+    if pool is not None:
+        # Пиковая память параллельной записи приходится на процессы пула и здесь не видна
+        _, stages['write_parallel'] = measure(
+            _write_partitions_parallel, pool, partitions, trace_memory=False, repeat=repeat)
+        result['parallel_write_speedup'] = round(
+            stages['write']['seconds'] / max(stages['write_parallel']['seconds'], 1e-9), 2)
+
+    del df, partitions, workbooks
+    archive, result['end_to_end'] = measure(
+        main.convert_excel, content, 'bench.xlsx', report_type, 'bench', trace_memory=trace_memory, repeat=repeat)
+    result['output_bytes'] = len(archive)
+    return result
+
+def bench_bill(bill_format: str, rows: int, seed: int, trace_memory: bool, repeat: int) -> dict:
+    """Замер упаковки электронного счета целиком и по этапам"""
+    logger.warning(f"Generating {bill_format} bill: {rows} items")
+    content = BILL_GENERATORS[bill_format](rows, seed)
+    filename = f"{bill_format}.xml"
+
+    stages = {}
+    members, stages['build'] = measure(
+        main.build_bill_members, content, filename, trace_memory=trace_memory, repeat=repeat)
+    _, stages['zip'] = measure(main.build_zip, members, trace_memory=trace_memory, repeat=repeat)
+    archive, end_to_end = measure(
+        main.convert_bill, content, filename, 'bench', trace_memory=trace_memory, repeat=repeat)
+
+    return {
+        'report': f"bill_{bill_format}",
+        'rows': rows,
+        'input_bytes': len(content),
+        'output_bytes': len(archive),
+        'stages': stages,
+        'end_to_end': end_to_end,
+    }
+
+def generate_bills(count: int, rows: int, seed: int = 0) -> list[tuple[bytes, str]]:
+    """Пакет из count счетов по rows строк товаров, форматы чередуются"""
+    return [(BILL_GENERATORS[BILL_FORMATS[i % len(BILL_FORMATS)]](rows, seed + i), f"bill_{i:05d}.xml")
+            for i in range(count)]
+
+def _package_bills(bills: list, separate: bool) -> list:
+    return main.build_bill_batch(bills, separate)
+
+def _package_bills_parallel(pool: ProcessPoolExecutor, bills: list, separate: bool) -> list:
+    # Группы по BILL_BATCH_SIZE счетов, как в /api/process_bill_batch
+    size = main.BILL_BATCH_SIZE
+    futures = [pool.submit(main.build_bill_batch, bills[i:i + size], separate) for i in range(0, len(bills), size)]
+    return [result for future in futures for result in future.result()]
+
+def _zip_containers(results: list) -> bytes:
+    return main.build_zip([(f"bill_{i:05d}.zip", archive) for i, (_, archive) in enumerate(results)])
+
+def _combined_container(bills: list) -> bytes:
+    documents = [document for _, document in _package_bills(bills, separate=False)]
+    members = [(f"{number}/{name}", data)
+               for number, (_, files) in enumerate(documents, start=1) for name, data in files]
+    meta = main.build_meta_content([document for document, _ in documents])
+    return main.build_zip([('meta.xml', meta), *members])
+
+def bench_bill_batch(count: int, rows: int, seed: int, pool, trace_memory: bool, repeat: int) -> dict:
+    """Замер пакетной упаковки count счетов: отдельные контейнеры и один общий"""
+    logger.warning(f"Generating {count} bills: {rows} items each")
+    bills = generate_bills(count, rows, seed)
+
+    stages = {}
+    results, stages['separate'] = measure(_package_bills, bills, True, trace_memory=trace_memory, repeat=repeat)
+    archive, stages['zip'] = measure(_zip_containers, results, trace_memory=trace_memory, repeat=repeat)
+    _, stages['combined'] = measure(_combined_container, bills, trace_memory=trace_memory, repeat=repeat)
+
+    result = {
+        'report': 'bill_batch',
+        'rows': count,
+        'input_bytes': sum(len(content) for content, _ in bills),
+        'output_bytes': len(archive),
+        'stages': stages,
+    }
+    end_to_end = {'seconds': round(stages['separate']['seconds'] + stages['zip']['seconds'], 4)}
+
+    if pool is not None:
+        # Пиковая память параллельной упаковки приходится на процессы пула и здесь не видна
+        _, stages['separate_parallel'] = measure(
+            _package_bills_parallel, pool, bills, True, trace_memory=False, repeat=repeat)
+        result['parallel_speedup'] = round(
+            stages['separate']['seconds'] / max(stages['separate_parallel']['seconds'], 1e-9), 2)
+        end_to_end['seconds'] = round(stages['separate_parallel']['seconds'] + stages['zip']['seconds'], 4)
+
+    result['end_to_end'] = end_to_end
+    result['bills_per_second'] = round(count / max(end_to_end['seconds'], 1e-9), 1)
+    return result
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def compare(previous: dict, current: dict) -> None:
+    """Печать отношения времени этапов текущего прогона к предыдущему"""
+    baseline = {(item['report'], item['rows']): item for item in previous['results']}
+    print(f"{'report':<20}{'rows':>10}  {'stage':<16}{'before, s':>12}{'after, s':>12}{'ratio':>8}")
+    for item in current['results']:
+        before = baseline.get((item['report'], item['rows']))
+        if before is None:
+            continue
+        stages = {**item['stages'], 'end_to_end': item['end_to_end']}
+        before_stages = {**before['stages'], 'end_to_end': before['end_to_end']}
+        for stage, stats in stages.items():
+            if stage not in before_stages:
+                continue
+            old, new = before_stages[stage]['seconds'], stats['seconds']
+            ratio = new / old if old else float('inf')
+            print(f"{item['report']:<20}{item['rows']:>10}  {stage:<16}{old:>12.3f}{new:>12.3f}{ratio:>8.2f}")
+
+def _int_list(value: str) -> list[int]:
+    return [int(part) for part in value.split(',') if part]
+
+def _name_list(value: str) -> list[str]:
+    return [part for part in value.split(',') if part]
+
+def main_cli(argv=None) -> dict:
+    parser = argparse.ArgumentParser(description="Бенчмарк конвертера ОФД на синтетических данных")
+    parser.add_argument('--rows', type=_int_list, default=[10000, 100000, 1000000],
+                        help="размеры Excel отчетов в строках, через запятую")
+    parser.add_argument('--bill-rows', type=_int_list, default=[1000, 10000, 100000],
+                        help="число строк товаров в электронных счетах, через запятую")
+    parser.add_argument('--bill-counts', type=_int_list, default=[1000, 5000],
+                        help="число счетов в пакете для bill_batch, через запятую")
+    parser.add_argument('--reports', type=_name_list,
+                        default=EXCEL_REPORTS + [f"bill_{f}" for f in BILL_FORMATS] + ['bill_batch'],
+                        help="отчеты: checks, nomenclature, taxcom, bill_upd, bill_commerceml, bill_batch")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help="число запусков для замера времени")
+    parser.add_argument('--workers', type=int, default=main.WORKER_COUNT,
+                        help="процессов для параллельной записи книг и упаковки счетов (0 - без замера)")
+    parser.add_argument('--no-memory', action='store_true', help="не замерять пиковую память")
+    parser.add_argument('--output', help="файл для результатов в JSON")
+    parser.add_argument('--compare', help="JSON предыдущего прогона для сравнения")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, force=True)
+    logging.getLogger('main').setLevel(logging.WARNING)
+
+    pool = None
+    if args.workers > 0:
+        pool = ProcessPoolExecutor(max_workers=args.workers, initializer=main._init_worker)
+
+    results = []
+    try:
+        for report in args.reports:
+            if report in EXCEL_GENERATORS:
+                runs = [lambda rows=rows: bench_excel(report, rows, args.seed, pool, not args.no_memory, args.repeat)
+                        for rows in args.rows]
+            elif report == 'bill_batch':
+                runs = [lambda count=count: bench_bill_batch(count, 10, args.seed, pool, not args.no_memory,
+                                                             args.repeat)
+                        for count in args.bill_counts]
+            elif report.startswith('bill_') and report[5:] in BILL_GENERATORS:
+                runs = [lambda rows=rows: bench_bill(report[5:], rows, args.seed, not args.no_memory, args.repeat)
+                        for rows in args.bill_rows]
+            else:
+                parser.error(f"unknown report: {report}")
+            for run in runs:
+                results.append(run())
+                print(json.dumps(results[-1], ensure_ascii=False), flush=True)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    output = {
+        'meta': {
+            'commit': _git_commit(),
+            'timestamp': datetime.now().isoformat(),
+            'python': sys.version.split()[0],
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'excel_writer': main.EXCEL_WRITER,
+            'workers': args.workers,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    if resource is not None:
+        output['meta']['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(output, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(json.load(f), output)
+    return output
+
+if __name__ == "__main__":
+    main_cli()
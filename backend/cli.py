@@ -0,0 +1,198 @@
+"""Пакетная конвертация выгрузок ОФД и электронных счетов без веб-сервера
+
+Используется та же обработка, что и в API: определение типа отчета, обработка
+и итоги по дням для Excel отчетов, card.xml и meta.xml для счетов. Файлы
+распределяются по пулу процессов. Результат каждого файла - такой же архив, как
+ответ API, в каталоге --output с сохранением относительных путей. Результаты,
+которые новее исходного файла, пропускаются.
+
+Запуск из каталога backend:
+    python cli.py exports/ --output converted/
+    python cli.py "exports/2025-*/*.xlsx" --output converted/ --report-type taxcom --workers 4
+"""
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from fastapi import HTTPException
+
+# Логирование настраивается до импорта main: иначе его basicConfig с уровнем DEBUG и
+# журнал запуска сервера выводятся при каждом запуске; уровень уточняет main_cli
+logging.basicConfig(level=logging.WARNING)
+
+import main  # noqa: E402
+
+logger = logging.getLogger("cli")
+
+# Расширения исходных файлов: Excel отчеты и электронные счета
+EXCEL_EXTENSIONS = ('.xlsx',)
+BILL_EXTENSIONS = ('.xml',)
+
+def find_sources(patterns: list[str]) -> list[tuple[str, str]]:
+    """Исходные файлы по каталогам, файлам и шаблонам glob: пары (путь, путь результата без .zip)
+
+    В каталоге файлы ищутся рекурсивно, и путь результата повторяет путь внутри
+    каталога. Для шаблона это путь от его части без подстановок, для файла - имя файла.
+    """
+    sources = {}
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, _, files in os.walk(pattern):
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    sources.setdefault(os.path.abspath(path), (path, os.path.relpath(path, pattern)))
+            continue
+        base = _glob_base(pattern)
+        for path in sorted(glob.glob(pattern, recursive=True)) or [pattern]:
+            if os.path.isfile(path):
+                relative = os.path.relpath(path, base) if base else os.path.basename(path)
+                sources.setdefault(os.path.abspath(path), (path, relative))
+            else:
+                logger.warning(f"No files match {pattern}")
+    return [
+        (path, relative) for path, relative in sources.values()
+        if path.lower().endswith(EXCEL_EXTENSIONS + BILL_EXTENSIONS)
+    ]
+
+def _glob_base(pattern: str) -> str:
+    """Каталог шаблона до первой части с подстановками; пусто, если подстановок нет"""
+    if not glob.has_magic(pattern):
+        return ''
+    parts = []
+    for part in pattern.replace('\\', '/').split('/'):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return '/'.join(parts) or '.'
+
+def output_path(output_dir: str, relative: str) -> str:
+    """Архив результата: путь исходного файла внутри output_dir с добавленным .zip"""
+    return os.path.join(output_dir, f"{relative}.zip")
+
+def is_up_to_date(source: str, output: str) -> bool:
+    return os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(source)
+
+def convert_file(source: str, output: str, report_type: str, timestamp: str) -> dict:
+    """Конвертация одного файла в архив output, возвращает запись итога
+
+    Архив сначала пишется во временный файл рядом, поэтому прерванный запуск
+    не оставляет неполных результатов, которые сочли бы актуальными.
+    """
+    started = time.perf_counter()
+    filename = os.path.basename(source)
+    entry = {'file': source, 'output': output, 'input_bytes': os.path.getsize(source)}
+    temp_path = f"{output}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        if source.lower().endswith(BILL_EXTENSIONS):
+            with open(source, 'rb') as f:
+                content = f.read()
+            members = main.build_bill_members(content, filename)
+            with open(temp_path, 'wb') as f:
+                f.write(main.build_zip(members))
+            entry['report_type'] = 'bill'
+            entry['files'] = len(members)
+        else:
+            with open(source, 'rb') as f:
+                mode = main.choose_excel_mode(f, entry['input_bytes'], report_type)
+            if mode == 'chunked':
+                entry['report_type'], entry['files'] = main.convert_excel_chunked(
+                    source, filename, report_type, timestamp, temp_path)
+            else:
+                entry['report_type'], members = main.convert_excel_members(source, filename, report_type, timestamp)
+                with open(temp_path, 'wb') as f:
+                    f.write(main.build_zip(members))
+                entry['files'] = len(members)
+        os.replace(temp_path, output)
+        entry['status'] = 'ok'
+        entry['output_bytes'] = os.path.getsize(output)
+    except (main.ConversionError, HTTPException) as e:
+        entry.update(status='error', error=f"{e.status_code}: {e.detail}")
+    except Exception as e:
+        entry.update(status='error', error=str(e) or type(e).__name__)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    entry['seconds'] = round(time.perf_counter() - started, 3)
+    return entry
+
+def print_entry(entry: dict) -> None:
+    if entry['status'] == 'skipped':
+        details = "up to date"
+    else:
+        details = entry.get('error') or f"{entry['report_type']}, {entry['files']} files, {entry['seconds']:.2f} s"
+    print(f"{entry['status']:<8}{entry['file']}  ({details})", flush=True)
+
+def print_summary(entries: list[dict], seconds: float) -> None:
+    """Итог запуска: число файлов по статусам, пропускная способность и ошибки"""
+    converted = [entry for entry in entries if entry['status'] == 'ok']
+    failed = [entry for entry in entries if entry['status'] == 'error']
+    skipped = len(entries) - len(converted) - len(failed)
+    input_bytes = sum(entry['input_bytes'] for entry in converted)
+    print()
+    print(f"Converted: {len(converted)}, skipped: {skipped}, failed: {len(failed)}, {seconds:.1f} s")
+    if converted and seconds > 0:
+        print(f"Throughput: {len(converted) / seconds:.2f} files/s, {input_bytes / seconds / 1024 / 1024:.2f} MB/s")
+    by_type = {}
+    for entry in converted:
+        by_type[entry['report_type']] = by_type.get(entry['report_type'], 0) + 1
+    for report_type, count in sorted(by_type.items()):
+        print(f"  {report_type}: {count}")
+    if failed:
+        print("Failed files:")
+        for entry in failed:
+            print(f"  {entry['file']}: {entry['error']}")
+
+def main_cli(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Пакетная конвертация выгрузок ОФД и электронных счетов")
+    parser.add_argument('paths', nargs='+', help="каталоги, файлы .xlsx и .xml или шаблоны glob")
+    parser.add_argument('--output', required=True, help="каталог для архивов с результатами")
+    parser.add_argument('--report-type', default='checks',
+                        help="тип Excel отчета по умолчанию; определяется по колонкам каждого файла")
+    parser.add_argument('--workers', type=int, default=main.WORKER_COUNT,
+                        help="процессов для конвертации (0 - в текущем процессе)")
+    parser.add_argument('--force', action='store_true', help="конвертировать и актуальные результаты")
+    parser.add_argument('--verbose', action='store_true', help="журнал конвертации")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, force=True)
+    logging.getLogger('main').setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    sources = find_sources(args.paths)
+    if not sources:
+        parser.error("no .xlsx or .xml files found")
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    started = time.perf_counter()
+    entries = []
+    tasks = []
+    for source, relative in sources:
+        output = output_path(args.output, relative)
+        if not args.force and is_up_to_date(source, output):
+            entries.append({'file': source, 'output': output, 'status': 'skipped', 'input_bytes': 0})
+            print_entry(entries[-1])
+        else:
+            tasks.append((source, output, args.report_type, timestamp))
+
+    if args.workers > 0 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=main._init_worker) as pool:
+            futures = [pool.submit(convert_file, *task) for task in tasks]
+            for future in as_completed(futures):
+                entries.append(future.result())
+                print_entry(entries[-1])
+    else:
+        for task in tasks:
+            entries.append(convert_file(*task))
+            print_entry(entries[-1])
+
+    print_summary(entries, time.perf_counter() - started)
+    return 1 if any(entry['status'] == 'error' for entry in entries) else 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,11 +1,16 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, Response
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
 import openpyxl
-from openpyxl.styles import PatternFill
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import TYPE_ERROR, TYPE_NUMERIC
+from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
+from openpyxl.utils.cell import range_boundaries
 import pandas as pd
 import numpy as np
-from datetime import datetime
+from datetime import date, datetime, timedelta
 import os
 import shutil
 import tempfile
@@ -13,13 +18,44 @@ import logging
 import json
 import traceback
 import zipfile
+import io
 from pathlib import Path
 import sys
-from typing import cast
+from typing import AsyncIterator, Callable, Iterable, Iterator, Optional, Union, cast
 import pandas as pd
 from pandas import DataFrame, Series
+from pandas.api.types import is_scalar
+from pandas.io.parsers import TextParser
 from xml.etree import ElementTree as ET
 import uuid
+import asyncio
+import codecs
+import hashlib
+import heapq
+import math
+import pickle
+import re
+import sqlite3
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from itertools import islice
+from operator import itemgetter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import xlsxwriter
+except ImportError:  # без xlsxwriter книги пишутся через openpyxl
+    xlsxwriter = None
+
+try:
+    import resource
+except ImportError:  # нет в Windows, пик памяти читается только из /proc
+    resource = None
 
 # Настройка логирования
 logging.basicConfig(
@@ -48,21 +84,12 @@ logger.info(f"Environment Info: {json.dumps(env_vars, indent=2)}")
 
 app = FastAPI()
 
-# Настройка CORS
+# Настройка CORS; слой добавляется после остальных (см. measure_request), чтобы быть внешним
 origins = [
     "http://localhost:3000",
     "https://ofd-converter.vercel.app",
 ]
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-    expose_headers=["*"]
-)
-
 @app.get("/api")
 async def root():
     logger.info("Root endpoint called")
@@ -113,6 +140,58 @@ async def health_check():
 # Константы
 PAYMENT_COLUMNS = ['Наличными', 'Электронными', 'Предоплата (аванс)', 'Зачет предоплаты (аванса)']
 HIGHLIGHT_COLOR = 'D3D3D3'  # Светло-серый цвет для итоговых строк
+EXCEL_MAX_ROWS = 1048576  # Число строк на листе Excel
+
+# Настройки обработки: число процессов-обработчиков (0 - обработка в потоках) и лимит времени на задачу, сек
+WORKER_COUNT = int(os.getenv("OFD_WORKER_COUNT", str(os.cpu_count() or 1)))
+JOB_TIMEOUT = float(os.getenv("OFD_JOB_TIMEOUT", "300"))
+# Обработка без временных файлов: загрузка, выходные файлы и архив только в памяти
+IN_MEMORY_PIPELINE = os.getenv("OFD_IN_MEMORY", "1") != "0"
+# Потоковая отдача архива: файлы упаковываются и отправляются по мере готовности
+STREAM_RESPONSES = os.getenv("OFD_STREAM_RESPONSES", "1") != "0"
+# Запись выходных книг: xlsxwriter (constant_memory), openpyxl-write-only или openpyxl (через pandas)
+EXCEL_WRITER = os.getenv("OFD_EXCEL_WRITER", "xlsxwriter")
+# Параллельная запись книг частей отчета в пуле процессов
+PARALLEL_WRITES = os.getenv("OFD_PARALLEL_WRITES", "1") != "0"
+# Кэш готовых архивов: размер в памяти, байт (0 - без кэша в памяти), время жизни записи, сек,
+# каталог дискового уровня (пусто - без него) и его размер, байт
+CACHE_MAX_BYTES = int(os.getenv("OFD_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+CACHE_TTL = float(os.getenv("OFD_CACHE_TTL", "3600"))
+CACHE_DIR = os.getenv("OFD_CACHE_DIR", "")
+CACHE_DISK_MAX_BYTES = int(os.getenv("OFD_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+# Асинхронные задачи: размер очереди, число одновременно выполняемых задач,
+# время хранения результата, сек, и каталог для файлов задач (пусто - в TEMP_DIR)
+JOB_QUEUE_SIZE = int(os.getenv("OFD_JOB_QUEUE_SIZE", "16"))
+JOB_RUNNERS = int(os.getenv("OFD_JOB_RUNNERS", "2"))
+JOB_RESULT_TTL = float(os.getenv("OFD_JOB_RESULT_TTL", "3600"))
+JOB_DIR = os.getenv("OFD_JOB_DIR", "")
+# Учет памяти: трассировка выделений через tracemalloc (заметно замедляет обработку)
+TRACE_MEMORY = os.getenv("OFD_TRACE_MEMORY", "0") != "0"
+# Бюджет памяти на конвертацию, байт (0 - без проверки); в AWS Lambda по умолчанию 90% памяти функции
+MEMORY_BUDGET = int(os.getenv("OFD_MEMORY_BUDGET", str(
+    int(os.getenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "0")) * 1024 * 1024 * 9 // 10
+)))
+# Потоковая обработка отчетов по чекам и Такском: строк в порции и число строк листа,
+# начиная с которого она включается (0 - только когда отчет не помещается в бюджет памяти)
+CHUNK_ROWS = int(os.getenv("OFD_CHUNK_ROWS", "50000"))
+CHUNKED_MIN_ROWS = int(os.getenv("OFD_CHUNKED_MIN_ROWS", "500000"))
+# Рабочие каталоги запросов: корневой каталог (пусто - ofd_work в TEMP_DIR), предельный возраст
+# каталога, сек, суммарный размер всех каталогов, байт (0 - без ограничения), и период очистки, сек
+WORKSPACE_DIR = os.getenv("OFD_WORKSPACE_DIR", "")
+WORKSPACE_MAX_AGE = float(os.getenv("OFD_WORKSPACE_MAX_AGE", "3600"))
+WORKSPACE_MAX_BYTES = int(os.getenv("OFD_WORKSPACE_MAX_BYTES", str(4 * 1024 * 1024 * 1024)))
+WORKSPACE_CLEAN_INTERVAL = float(os.getenv("OFD_WORKSPACE_CLEAN_INTERVAL", "60"))
+# Допуск запросов на конвертацию: число одновременно обрабатываемых запросов (0 - без ограничения),
+# длина очереди ожидающих, время ожидания в очереди, сек, и наибольший размер тела запроса, байт (0 - без ограничения)
+ADMISSION_LIMIT = int(os.getenv("OFD_ADMISSION_LIMIT", str(2 * max(WORKER_COUNT, 1))))
+ADMISSION_QUEUE_SIZE = int(os.getenv("OFD_ADMISSION_QUEUE_SIZE", "32"))
+ADMISSION_TIMEOUT = float(os.getenv("OFD_ADMISSION_TIMEOUT", "30"))
+# Объединение одновременных одинаковых запросов: наибольший результат, который ждущие запросы
+# получают от выполняющегося, байт (0 - без объединения)
+COALESCE_MAX_BYTES = int(os.getenv("OFD_COALESCE_MAX_BYTES", str(256 * 1024 * 1024)))
+MAX_UPLOAD_BYTES = int(os.getenv("OFD_MAX_UPLOAD_BYTES", str(512 * 1024 * 1024)))
+# Файл SQLite с ежедневными итогами и учтенными строками отчетов по кассам (пусто - без хранилища)
+TOTALS_DB = os.getenv("OFD_TOTALS_DB", "")
 
 # Определяем путь к временной директории
 try:
@@ -127,41 +206,807 @@ except Exception as e:
         detail="Failed to create temporary directory for file processing"
     )
 
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Процесс есть, но принадлежит другому пользователю
+        return True
+    return True
+
+class WorkspaceManager:
+    """Рабочие каталоги запросов и их очистка
+
+    Каждый запрос, которому нужен диск, получает свой каталог с уникальным именем
+    в корневом каталоге, поэтому одновременные запросы не пересекаются. Каталог
+    удаляется целиком по завершении запроса. Очистка удаляет каталоги, оставшиеся
+    от завершившихся процессов, каталоги старше max_age и, пока суммарный размер
+    больше max_bytes, самые старые каталоги, которые не используются этим процессом.
+    """
+
+    def __init__(self, directory: str, max_age: float, max_bytes: int):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._active: set[str] = set()
+        self._lock = threading.Lock()
+        self.stats = {'created': 0, 'removed_orphan': 0, 'removed_age': 0, 'removed_size': 0}
+
+    def create(self, prefix: str, parent: Optional[str] = None) -> str:
+        """Новый каталог: в корне с именем prefix_pid_id или вложенный в каталог запроса parent"""
+        if parent is not None:
+            return tempfile.mkdtemp(prefix=f"{prefix}_", dir=parent)
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{prefix}_{os.getpid()}_{uuid.uuid4().hex}")
+        with self._lock:
+            self._active.add(path)
+            self.stats['created'] += 1
+        os.makedirs(path)
+        return path
+
+    def release(self, path: str) -> None:
+        """Удаление каталога со всем содержимым"""
+        shutil.rmtree(path, ignore_errors=True)
+        with self._lock:
+            self._active.discard(path)
+
+    @contextmanager
+    def open(self, prefix: str, parent: Optional[str] = None) -> Iterator[str]:
+        """Каталог на время блока with"""
+        path = self.create(prefix, parent)
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    def _scan(self) -> list[tuple[float, int, str, Optional[int]]]:
+        """Каталоги в корне: (время последнего изменения, размер, путь, pid процесса-владельца)"""
+        if not os.path.isdir(self.directory):
+            return []
+        workspaces = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                modified, size = entry.stat(follow_symlinks=False).st_mtime, 0
+                for root, _, files in os.walk(entry.path):
+                    for name in files:
+                        try:
+                            stat = os.stat(os.path.join(root, name), follow_symlinks=False)
+                        except OSError:
+                            continue
+                        modified = max(modified, stat.st_mtime)
+                        size += stat.st_size
+                pid = entry.name.split('_')[-2] if entry.name.count('_') >= 2 else ''
+                workspaces.append((modified, size, entry.path, int(pid) if pid.isdigit() else None))
+        return workspaces
+
+    def _remove(self, path: str, reason: str) -> None:
+        logger.info(f"Removing workspace {path}: {reason}")
+        self.release(path)
+        with self._lock:
+            self.stats[f'removed_{reason}'] += 1
+
+    def clean(self) -> dict:
+        """Очистка по возрасту и суммарному размеру, возвращает число и размер оставшихся каталогов"""
+        now = time.time()
+        own_pid = os.getpid()
+        scanned = self._scan()
+        # Список используемых берется после обхода: каталог, созданный во время обхода, в него уже попал
+        with self._lock:
+            active = set(self._active)
+        workspaces = []
+        for modified, size, path, pid in scanned:
+            if path not in active and (pid == own_pid or pid is None or not _process_alive(pid)):
+                # Каталог завершившегося процесса или не удаленный из-за сбоя
+                self._remove(path, 'orphan')
+            elif now - modified > self.max_age and path not in active:
+                # Каталог выполняющегося запроса не удаляется, а только учитывается в размере
+                self._remove(path, 'age')
+            else:
+                workspaces.append((modified, size, path))
+
+        total = sum(size for _, size, _ in workspaces)
+        if self.max_bytes:
+            for modified, size, path in sorted(workspaces):
+                if total <= self.max_bytes:
+                    break
+                if path in active:
+                    continue
+                self._remove(path, 'size')
+                workspaces.remove((modified, size, path))
+                total -= size
+            if total > self.max_bytes:
+                logger.warning(f"Workspaces in use take {total} bytes, more than {self.max_bytes}")
+        return {'workspaces': len(workspaces), 'bytes': total}
+
+    def info(self) -> dict:
+        """Число и размер каталогов в корне без очистки и счетчики удалений"""
+        workspaces = self._scan()
+        with self._lock:
+            return {**self.stats, 'active': len(self._active),
+                    'workspaces': len(workspaces), 'bytes': sum(size for _, size, _, _ in workspaces)}
+
+    def close(self) -> None:
+        """Удаление каталогов этого процесса при остановке"""
+        with self._lock:
+            active = list(self._active)
+        for path in active:
+            self.release(path)
+
+workspaces = WorkspaceManager(WORKSPACE_DIR or os.path.join(TEMP_DIR, "ofd_work"),
+                              WORKSPACE_MAX_AGE, WORKSPACE_MAX_BYTES)
+
+# Метрики: длительности этапов конвертации, пики памяти и счетчики строк и байт
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+MEMORY_BUCKETS = tuple(size * 1024 * 1024 for size in (64, 128, 256, 512, 1024, 2048, 4096, 8192))
+
+class RequestMetrics:
+    """Замеры одного запроса: этапы (имя, длительность), счетчики (имя, значение) и пики памяти"""
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.report_type: Optional[str] = None
+        self.records: list[tuple[str, str, float]] = []
+        self.started = time.perf_counter()
+
+    def stage_durations(self) -> dict[str, float]:
+        """Суммарная длительность каждого этапа в порядке первого появления"""
+        durations: dict[str, float] = {}
+        for kind, name, value in self.records:
+            if kind == 'stage':
+                durations[name] = durations.get(name, 0.0) + value
+        return durations
+
+    def memory_peaks(self) -> dict[str, int]:
+        """Наибольший пик памяти по всем задачам запроса: peak_rss и traced_peak, байт"""
+        peaks: dict[str, int] = {}
+        for kind, name, value in self.records:
+            if kind == 'memory':
+                peaks[name] = max(peaks.get(name, 0), value)
+        return peaks
+
+    def server_timing(self) -> str:
+        timings = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stage_durations().items()]
+        timings.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ', '.join(timings)
+
+# Замеры текущего запроса в основном процессе
+current_metrics: ContextVar[Optional[RequestMetrics]] = ContextVar('current_metrics', default=None)
+# Замеры задачи, выполняемой в процессе-обработчике или потоке пула
+_worker_records = threading.local()
+
+def _records() -> Optional[list]:
+    records = getattr(_worker_records, 'records', None)
+    if records is None:
+        metrics = current_metrics.get()
+        records = metrics.records if metrics is not None else None
+    return records
+
+@contextmanager
+def stage(name: str):
+    """Замер длительности этапа конвертации для Server-Timing и гистограмм"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        records = _records()
+        if records is not None:
+            records.append(('stage', name, time.perf_counter() - start))
+
+def record_count(name: str, value: float) -> None:
+    """Счетчик текущего запроса, например число прочитанных строк"""
+    records = _records()
+    if records is not None:
+        records.append(('count', name, value))
+
+def record_elapsed(name: str) -> None:
+    """Этап от начала запроса до текущего момента, например прием загрузки до вызова обработчика"""
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.records.append(('stage', name, time.perf_counter() - metrics.started))
+
+def record_report_type(report_type: str) -> None:
+    """Тип отчета текущего запроса - метка его метрик"""
+    records = _records()
+    if records is not None:
+        records.append(('label', 'report_type', report_type))
+
+def _status_bytes(field: str) -> Optional[int]:
+    """Поле из /proc/self/status в байтах, например VmRSS или VmHWM (только Linux)"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def current_rss() -> Optional[int]:
+    """Текущий объем резидентной памяти процесса, байт"""
+    return _status_bytes('VmRSS')
+
+def peak_rss() -> Optional[int]:
+    """Пиковый объем резидентной памяти процесса с последнего сброса, байт"""
+    peak = _status_bytes('VmHWM')
+    if peak is None and resource is not None:
+        # Пик за все время жизни процесса; ru_maxrss в Linux в килобайтах
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return peak
+
+def reset_peak_rss() -> None:
+    """Сброс пика резидентной памяти процесса (Linux 4.0+), чтобы замерить пик одной задачи"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+# Число задач, выполняемых в процессе сейчас: пики памяти сбрасываются только первой из них,
+# при параллельных задачах в потоках замер получается общим на процесс
+_memory_lock = threading.Lock()
+_memory_calls = 0
+
+def start_memory_tracking() -> None:
+    global _memory_calls
+    with _memory_lock:
+        _memory_calls += 1
+        if _memory_calls > 1:
+            return
+        reset_peak_rss()
+        if TRACE_MEMORY:
+            tracemalloc.start()
+
+def finish_memory_tracking(records: list) -> None:
+    """Пики памяти задачи: резидентная память процесса и выделения Python по tracemalloc"""
+    global _memory_calls
+    with _memory_lock:
+        rss = peak_rss()
+        if rss is not None:
+            records.append(('memory', 'peak_rss', rss))
+        if tracemalloc.is_tracing():
+            records.append(('memory', 'traced_peak', tracemalloc.get_traced_memory()[1]))
+        _memory_calls -= 1
+        if _memory_calls == 0 and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+MEMORY_HEADERS = {'peak_rss': 'X-Memory-Peak', 'traced_peak': 'X-Memory-Traced-Peak'}
+MEMORY_METRICS = {
+    'peak_rss': "Peak resident memory of the process during a request",
+    'traced_peak': "Peak memory allocated by Python during a request (tracemalloc)",
+}
+
+def _format_labels(labels: tuple) -> str:
+    return ','.join(f'{key}="{str(value)}"' for key, value in labels)
+
+class MetricsRegistry:
+    """Гистограммы и счетчики процесса в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: dict[str, tuple[str, tuple, dict]] = {}
+        self._counters: dict[str, tuple[str, dict]] = {}
+
+    def observe(self, name: str, help_text: str, value: float,
+                bounds: tuple = METRIC_BUCKETS, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            _, bounds, series = self._histograms.setdefault(name, (help_text, bounds, {}))
+            buckets, total, count = series.get(key, ([0] * len(bounds), 0.0, 0))
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    buckets[i] += 1
+            series[key] = (buckets, total + value, count + 1)
+
+    def inc(self, name: str, help_text: str, value: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            _, series = self._counters.setdefault(name, (help_text, {}))
+            series[key] = series.get(key, 0) + value
+
+    def record_request(self, metrics: RequestMetrics, status: int, output_bytes: int) -> None:
+        """Учет завершенного запроса: этапы, пики памяти, счетчики по типу отчета и общая длительность"""
+        report_type = metrics.report_type
+        for kind, name, value in metrics.records:
+            if kind == 'label':
+                report_type = value
+        report_type = report_type or 'unknown'
+        for name, value in metrics.stage_durations().items():
+            self.observe('ofd_stage_duration_seconds', "Duration of conversion stages per request",
+                         value, stage=name, report_type=report_type)
+        for name, value in metrics.memory_peaks().items():
+            self.observe(f'ofd_{name}_bytes', MEMORY_METRICS[name], value, MEMORY_BUCKETS, report_type=report_type)
+        for kind, name, value in metrics.records:
+            if kind == 'stage' and name == 'write':
+                self.observe('ofd_partition_write_seconds', "Duration of writing one output workbook",
+                             value, report_type=report_type)
+            elif kind == 'count':
+                self.inc(f'ofd_{name}_total', f"Total {name.replace('_', ' ')} of processed reports",
+                         value, report_type=report_type)
+        if output_bytes:
+            self.inc('ofd_output_bytes_total', "Total output bytes of processed reports",
+                     output_bytes, report_type=report_type)
+        self.inc('ofd_requests_total', "Handled requests", endpoint=metrics.endpoint, status=status)
+        self.observe('ofd_request_duration_seconds', "Duration of requests including the response body",
+                     time.perf_counter() - metrics.started, endpoint=metrics.endpoint)
+
+    def render(self, extra_counters: Optional[dict] = None, extra_gauges: Optional[dict] = None) -> str:
+        lines = []
+        with self._lock:
+            for name, (help_text, bounds, series) in sorted(self._histograms.items()):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                for key, (buckets, total, count) in sorted(series.items()):
+                    for bound, bucket in zip(bounds, buckets):
+                        labels = _format_labels(key + (('le', bound),))
+                        lines.append(f"{name}_bucket{{{labels}}} {bucket}")
+                    lines.append(f"{name}_bucket{{{_format_labels(key + (('le', '+Inf'),))}}} {count}")
+                    lines.append(f"{name}_sum{{{_format_labels(key)}}} {total}")
+                    lines.append(f"{name}_count{{{_format_labels(key)}}} {count}")
+            counters = dict(self._counters)
+        for name, (help_text, series) in sorted({**counters, **(extra_counters or {})}.items()):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for key, value in sorted(series.items()):
+                lines.append(f"{name}{{{_format_labels(key)}}} {value}" if key else f"{name} {value}")
+        for name, (help_text, series) in sorted((extra_gauges or {}).items()):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            for key, value in sorted(series.items()):
+                lines.append(f"{name}{{{_format_labels(key)}}} {value}" if key else f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics_registry = MetricsRegistry()
+
+# Оформление как у pandas.to_excel: стиль заголовков и числовые форматы дат
+HEADER_FONT = Font(bold=True)
+HEADER_BORDER = Border(left=Side(style='thin'), right=Side(style='thin'),
+                       top=Side(style='thin'), bottom=Side(style='thin'))
+HEADER_ALIGNMENT = Alignment(horizontal='center', vertical='top')
+DATETIME_FORMAT = 'YYYY-MM-DD HH:MM:SS'
+DATE_FORMAT = 'YYYY-MM-DD'
+# Общая заливка строк с итогами
+HIGHLIGHT_FILL = PatternFill(start_color=HIGHLIGHT_COLOR, end_color=HIGHLIGHT_COLOR, fill_type='solid')
+
+def _excel_value(value):
+    """Значение ячейки в том виде, в котором его записывает pandas"""
+    if value is None or (is_scalar(value) and pd.isna(value)):
+        return None
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        if np.isinf(value):
+            return 'inf' if value > 0 else '-inf'
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value
+    if isinstance(value, timedelta):
+        return value.total_seconds() / 86400
+    return str(value)
+
+def _number_format(value) -> Optional[str]:
+    if isinstance(value, datetime):
+        return DATETIME_FORMAT
+    if isinstance(value, date):
+        return DATE_FORMAT
+    return None
+
+def _excel_columns(df: DataFrame) -> tuple[list[list], list[Optional[str]]]:
+    """Значения столбцов для записи и формат каждого столбца
+
+    Формат 'mixed' означает, что формат определяется для каждой ячейки отдельно.
+    """
+    columns = []
+    formats = []
+    for _, series in df.items():
+        if pd.api.types.is_datetime64_any_dtype(series):
+            values = series.astype(object).where(series.notna(), None).tolist()
+            fmt = DATETIME_FORMAT
+        elif pd.api.types.is_bool_dtype(series) or pd.api.types.is_integer_dtype(series):
+            values = series.astype(object).where(series.notna(), None).tolist()
+            fmt = None
+        elif pd.api.types.is_float_dtype(series):
+            objects = series.astype(object)
+            objects = objects.where(~np.isposinf(series), 'inf').where(~np.isneginf(series), '-inf')
+            values = objects.where(series.notna(), None).tolist()
+            fmt = None
+        else:
+            values = [_excel_value(value) for value in series.tolist()]
+            fmt = 'mixed'
+        columns.append(values)
+        formats.append(fmt)
+    return columns, formats
+
+class ReportWriter:
+    """Книга Excel с листами отчета: данные, ниже через две строки ежедневные итоги с подсветкой
+
+    Подклассы реализуют запись через конкретную библиотеку; результат во всех
+    реализациях выглядит одинаково.
+    """
+
+    def __init__(self, target):
+        # target - путь к файлу или буфер в памяти
+        self.target = target
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def write_report(self, sheet_name: str, data: DataFrame, totals: DataFrame,
+                     highlight_width: int, highlight_extra_rows: int = 0) -> None:
+        """Запись листа: данные, итоги и подсветка строк итогов шириной highlight_width колонок
+
+        Подсвечиваются заголовок итогов, строки итогов и highlight_extra_rows строк после них.
+        """
+        self.write_report_chunks(sheet_name, data.columns, [data], totals, highlight_width, highlight_extra_rows)
+
+    def write_report_chunks(self, sheet_name: str, columns, chunks: Iterable[DataFrame], totals: DataFrame,
+                            highlight_width: int, highlight_extra_rows: int = 0) -> None:
+        """Запись листа, данные которого приходят порциями с колонками columns
+
+        Данные, не поместившиеся на лист Excel, продолжаются на листах 'Имя (2)',
+        'Имя (3)' и т.д.; итоги пишутся после данных на последнем из них.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _rows_per_sheet(totals: DataFrame, highlight_extra_rows: int) -> int:
+        # Под заголовок, две пустые строки, итоги и строки после них место оставляется на каждом листе
+        return EXCEL_MAX_ROWS - 4 - len(totals) - highlight_extra_rows
+
+    @staticmethod
+    def _sheet_name(sheet_name: str, number: int) -> str:
+        return sheet_name if number == 1 else f'{sheet_name} ({number})'
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+class PandasReportWriter(ReportWriter):
+    """Запись через pandas.ExcelWriter: вся книга строится в памяти"""
+
+    def __init__(self, target):
+        super().__init__(target)
+        self._writer = pd.ExcelWriter(target, engine='openpyxl')
+
+    def write_report(self, sheet_name, data, totals, highlight_width, highlight_extra_rows=0):
+        # Записываем данные в Excel
+        data.to_excel(self._writer, sheet_name=sheet_name, index=False)
+        worksheet = self._writer.sheets[sheet_name]
+
+        # Добавляем итоги после основных данных
+        start_row = len(data) + 3
+        totals.to_excel(self._writer, sheet_name=sheet_name, startrow=start_row, index=False)
+
+        # Форматирование итогов
+        for row in worksheet.iter_rows(min_row=start_row + 1,
+                                       max_row=start_row + len(totals) + 1 + highlight_extra_rows,
+                                       max_col=highlight_width):
+            for cell in row:
+                cell.fill = HIGHLIGHT_FILL
+
+    def write_report_chunks(self, sheet_name, columns, chunks, totals, highlight_width, highlight_extra_rows=0):
+        # Лист строится в памяти целиком
+        data = pd.concat(chunks, ignore_index=True)
+        self.write_report(sheet_name, data, totals, highlight_width, highlight_extra_rows)
+
+    def close(self):
+        self._writer.close()
+
+class OpenpyxlWriteOnlyReportWriter(ReportWriter):
+    """Запись через openpyxl в режиме write-only: строки сразу сериализуются, память не растет"""
+
+    def __init__(self, target):
+        super().__init__(target)
+        self._workbook = openpyxl.Workbook(write_only=True)
+
+    def _header(self, worksheet, columns, highlight_width):
+        cells = []
+        for col_idx, name in enumerate(columns):
+            cell = WriteOnlyCell(worksheet, _excel_value(name))
+            cell.font = HEADER_FONT
+            cell.border = HEADER_BORDER
+            cell.alignment = HEADER_ALIGNMENT
+            if col_idx < highlight_width:
+                cell.fill = HIGHLIGHT_FILL
+            cells.append(cell)
+        # Подсветка может быть шире заголовка
+        for _ in range(len(cells), highlight_width):
+            cell = WriteOnlyCell(worksheet)
+            cell.fill = HIGHLIGHT_FILL
+            cells.append(cell)
+        return cells
+
+    def write_report_chunks(self, sheet_name, columns, chunks, totals, highlight_width, highlight_extra_rows=0):
+        rows_per_sheet = self._rows_per_sheet(totals, highlight_extra_rows)
+        worksheet = None
+        sheet_number = 0
+        sheet_rows = 0
+        date_cells = {}
+
+        def add_sheet():
+            nonlocal worksheet, sheet_number, sheet_rows, date_cells
+            sheet_number += 1
+            worksheet = self._workbook.create_sheet(self._sheet_name(sheet_name, sheet_number))
+            worksheet.append(self._header(worksheet, columns, 0))
+            sheet_rows = 0
+            date_cells = {}
+
+        # Основные данные: ячейки с датами переиспользуются, openpyxl сериализует строку сразу
+        for data in chunks:
+            values_columns, formats = _excel_columns(data)
+            date_columns = [col_idx for col_idx, fmt in enumerate(formats) if fmt is not None]
+            for values in zip(*values_columns):
+                if worksheet is None or sheet_rows == rows_per_sheet:
+                    add_sheet()
+                row = list(values)
+                for col_idx in date_columns:
+                    value = row[col_idx]
+                    fmt = formats[col_idx] if formats[col_idx] != 'mixed' else _number_format(value)
+                    if value is None or fmt is None:
+                        continue
+                    cell = date_cells.get((col_idx, fmt))
+                    if cell is None:
+                        cell = date_cells[col_idx, fmt] = WriteOnlyCell(worksheet)
+                        cell.number_format = fmt
+                    cell.value = value
+                    row[col_idx] = cell
+                worksheet.append(row)
+                sheet_rows += 1
+        if worksheet is None:
+            add_sheet()
+
+        # Две пустые строки перед итогами
+        worksheet.append([])
+        worksheet.append([])
+
+        # Итоги с подсветкой
+        worksheet.append(self._header(worksheet, totals.columns, highlight_width))
+        columns, _ = _excel_columns(totals)
+        highlight_rows = [list(values) for values in zip(*columns)]
+        highlight_rows.extend([] for _ in range(highlight_extra_rows))
+        for values in highlight_rows:
+            row = []
+            for col_idx in range(max(len(values), highlight_width)):
+                value = values[col_idx] if col_idx < len(values) else None
+                cell = WriteOnlyCell(worksheet, value)
+                fmt = _number_format(value)
+                if fmt:
+                    cell.number_format = fmt
+                if col_idx < highlight_width:
+                    cell.fill = HIGHLIGHT_FILL
+                row.append(cell)
+            worksheet.append(row)
+
+    def close(self):
+        self._workbook.save(self.target)
+
+class XlsxWriterReportWriter(ReportWriter):
+    """Запись через xlsxwriter в режиме constant_memory"""
+
+    def __init__(self, target):
+        super().__init__(target)
+        self._workbook = xlsxwriter.Workbook(target, {
+            'constant_memory': True,
+            'tmpdir': TEMP_DIR,
+            'strings_to_urls': False,
+        })
+        header = {'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}
+        highlight = {'bg_color': f'#{HIGHLIGHT_COLOR}', 'pattern': 1}
+        self._formats = {
+            'header': self._workbook.add_format(header),
+            'header_highlight': self._workbook.add_format({**header, **highlight}),
+            'highlight': self._workbook.add_format(highlight),
+        }
+        for fmt in (DATETIME_FORMAT, DATE_FORMAT):
+            self._formats[fmt] = self._workbook.add_format({'num_format': fmt})
+            self._formats[fmt + '_highlight'] = self._workbook.add_format({'num_format': fmt, **highlight})
+
+    def _write_row(self, worksheet, row_idx, values, formats, highlight_width=0):
+        for col_idx, value in enumerate(values):
+            fmt = formats[col_idx]
+            if fmt == 'mixed':
+                fmt = _number_format(value)
+            if col_idx < highlight_width:
+                fmt = fmt + '_highlight' if fmt else 'highlight'
+            cell_format = self._formats[fmt] if fmt else None
+            if value is None:
+                if cell_format is not None and col_idx < highlight_width:
+                    worksheet.write_blank(row_idx, col_idx, None, cell_format)
+            elif isinstance(value, (datetime, date)):
+                worksheet.write_datetime(row_idx, col_idx, value, cell_format)
+            else:
+                worksheet.write(row_idx, col_idx, value, cell_format)
+        for col_idx in range(len(values), highlight_width):
+            worksheet.write_blank(row_idx, col_idx, None, self._formats['highlight'])
+
+    def _add_data_sheet(self, sheet_name, columns):
+        worksheet = self._workbook.add_worksheet(sheet_name)
+        for col_idx, name in enumerate(columns):
+            worksheet.write(0, col_idx, _excel_value(name), self._formats['header'])
+        return worksheet
+
+    def write_report_chunks(self, sheet_name, columns, chunks, totals, highlight_width, highlight_extra_rows=0):
+        rows_per_sheet = self._rows_per_sheet(totals, highlight_extra_rows)
+        worksheet = None
+        sheet_number = 0
+        row_idx = 0
+
+        # Основные данные
+        for data in chunks:
+            values_columns, formats = _excel_columns(data)
+            for values in zip(*values_columns):
+                if worksheet is None or row_idx == rows_per_sheet:
+                    sheet_number += 1
+                    worksheet = self._add_data_sheet(self._sheet_name(sheet_name, sheet_number), columns)
+                    row_idx = 0
+                row_idx += 1
+                self._write_row(worksheet, row_idx, values, formats)
+        if worksheet is None:
+            worksheet = self._add_data_sheet(sheet_name, columns)
+
+        # Итоги с подсветкой
+        start_row = row_idx + 3
+        header_width = len(totals.columns)
+        for col_idx in range(max(header_width, highlight_width)):
+            if col_idx < header_width:
+                fmt = 'header_highlight' if col_idx < highlight_width else 'header'
+                worksheet.write(start_row, col_idx, _excel_value(totals.columns[col_idx]), self._formats[fmt])
+            else:
+                worksheet.write_blank(start_row, col_idx, None, self._formats['highlight'])
+        columns, formats = _excel_columns(totals)
+        row_idx = start_row
+        for row_idx, values in enumerate(zip(*columns), start=start_row + 1):
+            self._write_row(worksheet, row_idx, values, formats, highlight_width)
+        for extra in range(highlight_extra_rows):
+            self._write_row(worksheet, row_idx + 1 + extra, (), formats, highlight_width)
+
+    def close(self):
+        self._workbook.close()
+
+REPORT_WRITERS = {
+    'openpyxl': PandasReportWriter,
+    'openpyxl-write-only': OpenpyxlWriteOnlyReportWriter,
+    'xlsxwriter': XlsxWriterReportWriter,
+}
+
+def create_report_writer(target) -> ReportWriter:
+    """Создание записи книги отчета согласно настройке EXCEL_WRITER"""
+    writer_name = EXCEL_WRITER
+    if writer_name == 'xlsxwriter' and xlsxwriter is None:
+        logger.warning("xlsxwriter is not installed, using openpyxl-write-only")
+        writer_name = 'openpyxl-write-only'
+    writer_class = REPORT_WRITERS.get(writer_name)
+    if writer_class is None:
+        raise ValueError(f"Unknown Excel writer: {writer_name}")
+    return writer_class(target)
+
 def process_dataframe(df: DataFrame) -> DataFrame:
     """Обработка данных согласно требованиям"""
     # 3. Сортировка по дате
     df = df.copy()
-    df['Дата/время'] = pd.to_datetime(df['Дата/время'])
+    df['Дата/время'] = parse_report_datetime(df['Дата/время'])
     df = df.sort_values('Дата/время')
     return df
 
-def add_daily_totals(df: DataFrame, writer: pd.ExcelWriter, sheet_name: str) -> None:
-    """Добавление ежедневных итогов с форматированием"""
+def with_date_column(df: DataFrame, datetime_column: str) -> DataFrame:
+    """Данные для записи на лист: исходные колонки и колонка 'Дата' без времени
+
+    Исходный DataFrame не изменяется; если дата уже преобразована, его колонки не копируются.
+    """
+    if pd.api.types.is_datetime64_any_dtype(df[datetime_column]) and 'Дата' not in df.columns:
+        return pd.concat([df, df[datetime_column].dt.date.rename('Дата')], axis=1, copy=False)
+    df = df.copy()
+    df[datetime_column] = parse_report_datetime(df[datetime_column])
+    df['Дата'] = df[datetime_column].dt.date
+    return df
+
+def partition_daily_totals(df: DataFrame, codes: np.ndarray, count: int,
+                           datetime_column: str, value_columns: list[str]) -> list[DataFrame]:
+    """Ежедневные итоги всех частей отчета одной групповой агрегацией
+
+    codes - номер части (от 0 до count - 1) для каждой строки df.
+    """
+    days = parse_report_datetime(df[datetime_column]).dt.normalize().to_numpy()
+    sums = df.groupby([codes, days])[value_columns].sum().rename_axis([None, 'Дата'])
+
+    present = set(sums.index.get_level_values(0))
+    totals = []
+    for code in range(count):
+        if code not in present:
+            totals.append(pd.DataFrame(columns=['Дата', *value_columns]))
+            continue
+        part = sums.xs(code, level=0).reset_index()
+        part['Дата'] = part['Дата'].dt.date
+        totals.append(part)
+    return totals
+
+def daily_totals(df: DataFrame, datetime_column: str, value_columns: list[str]) -> DataFrame:
+    """Ежедневные итоги одной части отчета"""
+    return partition_daily_totals(df, np.zeros(len(df), dtype=np.intp), 1, datetime_column, value_columns)[0]
+
+def add_daily_totals(df: DataFrame, writer: ReportWriter, sheet_name: str,
+                     daily_totals_df: Optional[DataFrame] = None,
+                     chunks: Optional[Iterable[DataFrame]] = None) -> None:
+    """Добавление ежедневных итогов с форматированием
+
+    daily_totals_df - итоги, заранее посчитанные для всех частей отчета.
+    chunks - данные части порциями при потоковой обработке; df тогда задает только колонки.
+    """
     logger.info(f"Adding daily totals for sheet: {sheet_name}")
     
-    # Преобразуем столбец даты в datetime
-    df['Дата/время'] = pd.to_datetime(df['Дата/время'])
-    df['Дата'] = df['Дата/время'].dt.date
-    
-    # Группируем по дате и считаем итоги
-    daily_totals = df.groupby('Дата').agg({
-        col: 'sum' for col in PAYMENT_COLUMNS
-    }).reset_index()
+    # Добавляем колонку с датой, не изменяя данные части
+    data = with_date_column(df, 'Дата/время')
     
-    # Записываем данные в Excel
-    df.to_excel(writer, sheet_name=sheet_name, index=False)
+    # Группируем по дате и считаем итоги, если они не посчитаны заранее
+    if daily_totals_df is None:
+        daily_totals_df = daily_totals(data, 'Дата/время', REPORT_SCHEMAS['checks']['totals'])
     
-    # Получаем объект листа
-    worksheet = writer.sheets[sheet_name]
-    
-    # Добавляем итоги после основных данных
-    start_row = len(df) + 3
-    daily_totals.to_excel(writer, sheet_name=sheet_name, startrow=start_row, index=False)
-    
-    # Форматирование итогов
-    for row in worksheet[start_row + 1:start_row + len(daily_totals) + 2]:
-        for cell in row:
-            cell.fill = PatternFill(start_color=HIGHLIGHT_COLOR, end_color=HIGHLIGHT_COLOR, fill_type='solid')
+    # Записываем данные и итоги в рублях; подсветка на всю ширину листа и еще одну строку после итогов
+    money_columns = REPORT_SCHEMAS['checks']['money']
+    daily_totals_df = to_rubles(daily_totals_df, money_columns)
+    highlight_width = max(len(data.columns), len(daily_totals_df.columns))
+    if chunks is None:
+        writer.write_report(sheet_name, to_rubles(data, money_columns), daily_totals_df,
+                            highlight_width, highlight_extra_rows=1)
+    else:
+        writer.write_report_chunks(sheet_name, data.columns,
+                                   (to_rubles(with_date_column(chunk, 'Дата/время'), money_columns)
+                                    for chunk in chunks),
+                                   daily_totals_df, highlight_width, highlight_extra_rows=1)
+
+def apply_prepayment_offset(df: DataFrame, prepayment_column: str) -> Series:
+    """Зачет предоплаты по чекам, возвращает скорректированную 'Сумма товара'
+
+    Предоплата чека (значение из его первой строки) списывается с позиций по порядку:
+    покрытые целиком позиции обнуляются, из первой позиции, сумма которой не меньше
+    остатка, остаток вычитается, а следующие за ней позиции с тем же наименованием
+    обнуляются. Все чеки считаются за один проход групповыми накопительными суммами.
+    """
+    amounts = df['Сумма товара']
+    receipts = df['Номер документа']
+
+    # Чеки без номера не участвуют в зачете, как и при группировке
+    prepayment = df[prepayment_column].groupby(receipts, sort=False).transform('first')
+    active = (receipts.notna() & (prepayment > 0)).to_numpy()
+    if not active.any():
+        return amounts
+
+    groups = receipts[active]
+    item_amounts = amounts[active]
+
+    # Остаток предоплаты перед каждой позицией чека. Он округляется до сотых: для сумм в рублях
+    # разность с накопленной суммой отличается от поочередного вычитания в последних разрядах,
+    # и без округления позиция, на которой заканчивается предоплата, могла бы смениться
+    paid_before = item_amounts.fillna(0).groupby(groups, sort=False).cumsum()
+    paid_before = paid_before.groupby(groups, sort=False).shift(fill_value=0)
+    remaining = (prepayment[active] - paid_before).round(2)
+
+    # После позиции с пустой суммой остаток не определен, дальше позиции только обнуляются
+    nan_seen = item_amounts.isna().groupby(groups, sort=False).cummax()
+    covers = (item_amounts >= remaining) & ~nan_seen
+    covers_seen = covers.groupby(groups, sort=False).cumsum()
+    is_last = (covers & (covers_seen == 1)).to_numpy()
+
+    position = np.flatnonzero(active)
+    values = amounts.to_numpy(dtype=float, copy=True)
+
+    # Позиции до последней оплачены предоплатой полностью
+    values[position[(covers_seen == 0).to_numpy()]] = 0
+
+    if is_last.any():
+        # Обнуляем одинаковые позиции после той, на которой закончилась предоплата
+        names = df['Наименование'][active]
+        last_names = names.where(is_last).groupby(groups, sort=False).transform('first')
+        same_items = ((covers_seen > 0).to_numpy() & ~is_last
+                      & (names == last_names).to_numpy())
+        values[position[same_items]] = 0
+        values[position[is_last]] = (item_amounts - remaining).to_numpy()[is_last]
+
+    return pd.Series(values, index=df.index, name=amounts.name)
 
 def process_nomenclature_dataframe(df: DataFrame) -> DataFrame:
     """Обработка данных для отчета по номенклатуре"""
@@ -175,40 +1020,8 @@ def process_nomenclature_dataframe(df: DataFrame) -> DataFrame:
     if prepayment_column in df.columns:
         # Заполняем NaN значения нулями
         df[prepayment_column] = df[prepayment_column].fillna(0)
-        
-        # Группируем по номеру чека для обработки предоплаты
-        receipt_groups = df.groupby('Номер документа')
-        
-        for receipt_num, receipt_df in receipt_groups:
-            # Если есть предоплата в чеке
-            if (receipt_df[prepayment_column] > 0).any():
-                # Получаем общую сумму предоплаты для чека (берем только одно значение)
-                remaining_prepayment = receipt_df[prepayment_column].iloc[0]
-                
-                # Создаем маску для текущего чека
-                receipt_mask = df['Номер документа'] == receipt_num
-                
-                # Обрабатываем каждую позицию в чеке
-                for idx in receipt_df.index:
-                    current_amount = df.loc[idx, 'Сумма товара']
-                    
-                    if remaining_prepayment <= 0:
-                        break
-                        
-                    if current_amount >= remaining_prepayment:
-                        # Случай 1: Сумма товара больше или равна остатку предоплаты
-                        df.loc[idx, 'Сумма товара'] = current_amount - remaining_prepayment
-                        # Обнуляем остальные одинаковые позиции в чеке
-                        same_items_mask = (df['Номер документа'] == receipt_num) & \
-                                        (df.index > idx) & \
-                                        (df['Наименование'] == df.loc[idx, 'Наименование'])
-                        df.loc[same_items_mask, 'Сумма товара'] = 0
-                        remaining_prepayment = 0
-                    else:
-                        # Случай 2: Предоплата больше суммы товара
-                        df.loc[idx, 'Сумма товара'] = 0
-                        remaining_prepayment -= current_amount
-                        
+        df['Сумма товара'] = apply_prepayment_offset(df, prepayment_column)
+
     # Обработка значений согласно правилам
     for column in ['Наличными по чеку', 'Электронными по чеку']:
         # Замена значений, которые больше 'Сумма товара'
@@ -225,37 +1038,22 @@ def process_nomenclature_dataframe(df: DataFrame) -> DataFrame:
     
     return df
 
-def add_daily_totals_nomenclature(df: DataFrame, writer: pd.ExcelWriter, sheet_name: str) -> None:
+def add_daily_totals_nomenclature(df: DataFrame, writer: ReportWriter, sheet_name: str,
+                                  daily_totals_df: Optional[DataFrame] = None) -> None:
     """Добавление ежедневных итогов для отчета по номенклатуре"""
     logger.info(f"Adding daily totals for sheet: {sheet_name}")
     
-    # Преобразуем столбец даты в datetime
-    df['Дата/время'] = pd.to_datetime(df['Дата/время'])
-    df['Дата'] = df['Дата/время'].dt.date
-    
-    # Группируем по дате и считаем итоги
-    daily_totals = df.groupby('Дата').agg({
-        'Наличными по чеку': 'sum',
-        'Электронными по чеку': 'sum',
-        'Сумма товара': 'sum'
-    }).reset_index()
-    
-    # Записываем данные в Excel
-    df.to_excel(writer, sheet_name=sheet_name, index=False)
+    # Добавляем колонку с датой, не изменяя данные части
+    data = with_date_column(df, 'Дата/время')
     
-    # Получаем объект листа
-    worksheet = writer.sheets[sheet_name]
+    # Группируем по дате и считаем итоги, если они не посчитаны заранее
+    if daily_totals_df is None:
+        daily_totals_df = daily_totals(data, 'Дата/время', REPORT_SCHEMAS['nomenclature']['totals'])
     
-    # Добавляем итоги после основных данных
-    start_row = len(df) + 3
-    daily_totals.to_excel(writer, sheet_name=sheet_name, startrow=start_row, index=False)
-    
-    # Форматирование итогов
-    fill = PatternFill(start_color=HIGHLIGHT_COLOR, end_color=HIGHLIGHT_COLOR, fill_type='solid')
-    for row in range(start_row + 1, start_row + len(daily_totals) + 2):
-        for col in range(1, len(daily_totals.columns) + 1):
-            cell = worksheet.cell(row=row, column=col)
-            cell.fill = fill
+    # Записываем данные и итоги в рублях с подсветкой
+    money_columns = REPORT_SCHEMAS['nomenclature']['money']
+    writer.write_report(sheet_name, to_rubles(data, money_columns), to_rubles(daily_totals_df, money_columns),
+                        highlight_width=len(daily_totals_df.columns))
 
 def process_taxcom_dataframe(df: DataFrame) -> DataFrame:
     """Обработка данных для Такском отчета по чекам"""
@@ -268,59 +1066,53 @@ def process_taxcom_dataframe(df: DataFrame) -> DataFrame:
     df = df[~df['Дата и время'].astype(str).str.contains('Итог', case=False, na=False)]
     
     # Преобразуем и сортируем по дате
-    df['Дата и время'] = pd.to_datetime(df['Дата и время'])
+    df['Дата и время'] = parse_report_datetime(df['Дата и время'])
     df = df.sort_values('Дата и время')
     
     return df
 
-def add_daily_totals_taxcom(df: DataFrame, writer: pd.ExcelWriter, sheet_name: str) -> None:
-    """Добавление ежедневных итогов для Такском отчета"""
+def add_daily_totals_taxcom(df: DataFrame, writer: ReportWriter, sheet_name: str,
+                            daily_totals_df: Optional[DataFrame] = None,
+                            chunks: Optional[Iterable[DataFrame]] = None) -> None:
+    """Добавление ежедневных итогов для Такском отчета
+
+    chunks - данные части порциями при потоковой обработке; df тогда задает только колонки.
+    """
     logger.info(f"Adding daily totals for taxcom sheet: {sheet_name}")
     
-    # Создаем копию DataFrame для работы
-    df = df.copy()
-    
-    # Преобразуем столбец даты в datetime и создаем столбец только с датой
-    df['Дата'] = df['Дата и время'].dt.date
+    # Добавляем колонку с датой, не изменяя данные части
+    data = with_date_column(df, 'Дата и время')
     
-    # Группируем по дате и считаем итоги
-    daily_totals = df.groupby('Дата').agg({
-        'Наличными': 'sum',
-        'Безналичными': 'sum',
-        'Сумма': 'sum'
-    }).reset_index()
+    # Группируем по дате и считаем итоги, если они не посчитаны заранее
+    if daily_totals_df is None:
+        daily_totals_df = daily_totals(data, 'Дата и время', REPORT_SCHEMAS['taxcom']['totals'])
     
     # Форматируем даты в строки для вывода
-    daily_totals['Дата'] = daily_totals['Дата'].astype(str)
+    daily_totals_df = daily_totals_df.assign(Дата=daily_totals_df['Дата'].astype(str))
     
     # Добавляем строку с общим итогом
     total_row = pd.DataFrame([{
         'Дата': 'Итог',
-        'Наличными': daily_totals['Наличными'].sum(),
-        'Безналичными': daily_totals['Безналичными'].sum(),
-        'Сумма': daily_totals['Сумма'].sum()
+        'Наличными': daily_totals_df['Наличными'].sum(),
+        'Безналичными': daily_totals_df['Безналичными'].sum(),
+        'Сумма': daily_totals_df['Сумма'].sum()
     }])
-    daily_totals = pd.concat([daily_totals, total_row], ignore_index=True)
+    daily_totals_df = pd.concat([daily_totals_df, total_row], ignore_index=True)
     
-    # Записываем основные данные
-    df.to_excel(writer, sheet_name=sheet_name, index=False)
-    
-    # Получаем объект листа
-    worksheet = writer.sheets[sheet_name]
-    
-    # Добавляем итоги после основных данных
-    start_row = len(df) + 3
-    daily_totals.to_excel(writer, sheet_name=sheet_name, startrow=start_row, index=False)
-    
-    # Форматирование итогов
-    fill = PatternFill(start_color=HIGHLIGHT_COLOR, end_color=HIGHLIGHT_COLOR, fill_type='solid')
-    for row in range(start_row + 1, start_row + len(daily_totals) + 2):
-        for col in range(1, len(daily_totals.columns) + 1):
-            cell = worksheet.cell(row=row, column=col)
-            cell.fill = fill
-
-def create_card_xml(source_xml: ET.Element) -> ET.Element:
-    """Создает card.xml на основе данных из исходного файла"""
+    # Записываем данные и итоги в рублях с подсветкой
+    money_columns = REPORT_SCHEMAS['taxcom']['money']
+    daily_totals_df = to_rubles(daily_totals_df, money_columns)
+    if chunks is None:
+        writer.write_report(sheet_name, to_rubles(data, money_columns), daily_totals_df,
+                            highlight_width=len(daily_totals_df.columns))
+    else:
+        writer.write_report_chunks(sheet_name, data.columns,
+                                   (to_rubles(with_date_column(chunk, 'Дата и время'), money_columns)
+                                    for chunk in chunks),
+                                   daily_totals_df, highlight_width=len(daily_totals_df.columns))
+
+def create_card_xml(header: dict[str, dict[str, str]]) -> ET.Element:
+    """Создает card.xml на основе заголовка исходного файла, полученного extract_bill_header"""
     # Создаем корневой элемент Card
     card = ET.Element("Card", {
         "xmlns": "http://api-invoice.taxcom.ru/card",
@@ -346,7 +1138,7 @@ def create_card_xml(source_xml: ET.Element) -> ET.Element:
 
     try:
         # Получаем данные из исходного XML
-        doc = source_xml.find(".//Документ")
+        doc = header.get("Документ")
         if doc is not None:
             title = doc.get("НаимДокОпр", title)
             doc_number = doc.get("НомерСчФ") or doc.get("НомИнфПр", "")
@@ -371,7 +1163,7 @@ def create_card_xml(source_xml: ET.Element) -> ET.Element:
     sender = ET.SubElement(card, "Sender")
     try:
         # Получаем данные о продавце из исходного XML
-        seller = source_xml.find(".//СвПрод")
+        seller = header.get("СвПрод")
         if seller is not None:
             abonent = ET.SubElement(sender, "Abonent")
             inn = seller.get("ИННЮЛ", "") or seller.get("ИННФЛ", "")
@@ -394,7 +1186,7 @@ def create_card_xml(source_xml: ET.Element) -> ET.Element:
     receiver = ET.SubElement(card, "Receiver")
     try:
         # Получаем данные о покупателе из исходного XML
-        buyer = source_xml.find(".//СвПокуп")
+        buyer = header.get("СвПокуп")
         if buyer is not None:
             abonent = ET.SubElement(receiver, "Abonent")
             inn = buyer.get("ИННЮЛ", "") or buyer.get("ИННФЛ", "")
@@ -419,8 +1211,26 @@ def create_card_xml(source_xml: ET.Element) -> ET.Element:
 
     return card
 
-def create_meta_xml(source_xml: ET.Element) -> ET.Element:
-    """Создает meta.xml на основе данных из исходного файла"""
+def meta_document(header: dict[str, dict[str, str]]) -> tuple[str, str]:
+    """Данные документа для meta.xml из заголовка исходного файла: код регламента и имя основного файла"""
+    try:
+        doc_type = header["Документ"].get("Функция", "")
+        reglament_code = "Invoice" if doc_type == "СЧФ" else "Nonformalized"
+    except (KeyError, ValueError):
+        reglament_code = "Invoice"  # По умолчанию для счета на оплату
+
+    # Получаем имя исходного файла
+    try:
+        source_filename = header["Файл"].get("ИмяФайл", "document.xml")
+    except (KeyError, ValueError):
+        source_filename = "document.xml"
+    return reglament_code, source_filename
+
+def create_meta_xml(documents: list[tuple[str, str]]) -> ET.Element:
+    """Создает meta.xml для документов контейнера, данные которых получены meta_document
+
+    Документы нумеруются с 1, файлы документа N лежат в папке N.
+    """
     # Создаем корневой элемент ContainerDescription
     container = ET.Element("ContainerDescription", {
         "xmlns": "http://api-invoice.taxcom.ru/meta",
@@ -432,384 +1242,2288 @@ def create_meta_xml(source_xml: ET.Element) -> ET.Element:
     # Добавляем DocFlow с уникальным Id
     doc_flow = ET.SubElement(container, "DocFlow")
     doc_flow.set("Id", str(uuid.uuid4()))
-    doc_flow.set("DocumentCount", "1")
+    doc_flow.set("DocumentCount", str(len(documents)))
 
     # Добавляем Documents
-    documents = ET.SubElement(doc_flow, "Documents")
-    document = ET.SubElement(documents, "Document")
-    
-    # Устанавливаем атрибуты документа
-    try:
-        doc_type = source_xml.find(".//Документ").get("Функция", "")
-        if doc_type == "СЧФ":
-            document.set("ReglamentCode", "Invoice")
-        else:
-            document.set("ReglamentCode", "Nonformalized")
-    except (AttributeError, ValueError):
-        document.set("ReglamentCode", "Invoice")  # По умолчанию для счета на оплату
-    
-    document.set("TransactionCode", "MainDocument")
-    document.set("DocumentDate", datetime.now().strftime("%Y-%m-%dT%H:%M:%S"))
-    document.set("DocumentNumber", "1")
+    documents_elem = ET.SubElement(doc_flow, "Documents")
+    document_date = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    for number, (reglament_code, source_filename) in enumerate(documents, start=1):
+        # Устанавливаем атрибуты документа
+        document = ET.SubElement(documents_elem, "Document")
+        document.set("ReglamentCode", reglament_code)
+        document.set("TransactionCode", "MainDocument")
+        document.set("DocumentDate", document_date)
+        document.set("DocumentNumber", str(number))
 
-    # Добавляем Files
-    files = ET.SubElement(document, "Files")
+        # Добавляем Files
+        files = ET.SubElement(document, "Files")
 
-    # Добавляем MainImage
-    main_image = ET.SubElement(files, "MainImage")
-    main_image.set("xmlns:d6p1", "http://api-invoice.taxcom.ru/card")
-    
-    # Получаем имя исходного файла
-    try:
-        source_filename = source_xml.find(".//Файл").get("ИмяФайл", "document.xml")
-    except (AttributeError, ValueError):
-        source_filename = "document.xml"
-    main_image.set("Path", f"1/{source_filename}")
+        # Добавляем MainImage
+        main_image = ET.SubElement(files, "MainImage")
+        main_image.set("xmlns:d6p1", "http://api-invoice.taxcom.ru/card")
+        main_image.set("Path", f"{number}/{source_filename}")
 
-    # Добавляем ExternalCard
-    external_card = ET.SubElement(files, "ExternalCard")
-    external_card.set("xmlns:d6p1", "http://api-invoice.taxcom.ru/card")
-    external_card.set("Path", "1/card.xml")
+        # Добавляем ExternalCard
+        external_card = ET.SubElement(files, "ExternalCard")
+        external_card.set("xmlns:d6p1", "http://api-invoice.taxcom.ru/card")
+        external_card.set("Path", f"{number}/card.xml")
 
-    # Добавляем ProcessingState
-    state = ET.SubElement(document, "ProcessingState")
-    state.text = "New"
+        # Добавляем ProcessingState
+        state = ET.SubElement(document, "ProcessingState")
+        state.text = "New"
 
     return container
 
-@app.post("/api/process_excel")
-async def process_excel(file: UploadFile = File(...), report_type: str = 'checks'):
-    temp_path = None
-    output_files = []
-    archive_name = None
-    
+class ConversionError(Exception):
+    """Ошибка конвертации, которую нужно вернуть клиенту с указанным статусом
+
+    В отличие от HTTPException сериализуется через pickle, поэтому может быть
+    выброшена в процессе-обработчике и передана обратно в приложение.
+    """
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
+# Описание колонок отчетов:
+#   detect - колонки, по которым определяется тип отчета
+#   required - обязательные колонки
+#   columns - все колонки, участвующие в расчетах
+#   text / money - колонки, читаемые как строки / как числа; в обработке текст хранится
+#                  категориями, а суммы - в копейках (см. compact_report)
+#   datetime - колонка даты и времени; parse_dates - разбирать ли ее при чтении
+#   totals - колонки ежедневных итогов
+REPORT_SCHEMAS = {
+    'checks': {
+        'detect': ['Признак расчета', 'Тип налогообложения'],
+        'required': ['Дата/время', 'Признак расчета', 'Тип налогообложения'],
+        'columns': ['Дата/время', 'Признак расчета', 'Тип налогообложения'] + PAYMENT_COLUMNS,
+        'text': ['Признак расчета', 'Тип налогообложения'],
+        'money': PAYMENT_COLUMNS,
+        'datetime': 'Дата/время',
+        'parse_dates': True,
+        'totals': PAYMENT_COLUMNS,
+    },
+    'nomenclature': {
+        'detect': ['Признак расчета (тег 1054)', 'Признак предмета расчета (тег 1212)'],
+        'required': [
+            'Дата/время', 'Признак расчета (тег 1054)', 'Признак предмета расчета (тег 1212)',
+            'Наличными по чеку', 'Электронными по чеку', 'Сумма товара'
+        ],
+        'columns': [
+            'Дата/время', 'Номер документа', 'Наименование',
+            'Признак расчета (тег 1054)', 'Признак предмета расчета (тег 1212)',
+            'Наличными по чеку', 'Электронными по чеку', 'Сумма товара',
+            'Зачет предоплаты (аванса) по чеку'
+        ],
+        'text': ['Наименование', 'Признак расчета (тег 1054)', 'Признак предмета расчета (тег 1212)'],
+        'money': ['Наличными по чеку', 'Электронными по чеку', 'Сумма товара', 'Зачет предоплаты (аванса) по чеку'],
+        'datetime': 'Дата/время',
+        'parse_dates': True,
+        'totals': ['Наличными по чеку', 'Электронными по чеку', 'Сумма товара'],
+    },
+    'taxcom': {
+        'detect': ['Дата и время', 'Система налогообложения', 'Наличными', 'Безналичными', 'Сумма'],
+        'required': ['Дата и время', 'Система налогообложения', 'Наличными', 'Безналичными', 'Сумма'],
+        'columns': ['Дата и время', 'Система налогообложения', 'Наличными', 'Безналичными', 'Сумма'],
+        'text': ['Система налогообложения'],
+        'money': ['Наличными', 'Безналичными', 'Сумма'],
+        'datetime': 'Дата и время',
+        # В колонке даты есть строки 'Итог', она разбирается после их удаления
+        'parse_dates': False,
+        'totals': ['Наличными', 'Безналичными', 'Сумма'],
+    },
+}
+
+# Суммы внутри обработки хранятся в копейках: целые значения в float64, поэтому их сложение
+# точное, а пустые ячейки остаются NaN. В рубли они переводятся только при записи в Excel
+KOPECKS = 100
+
+def to_kopecks(values: Series) -> Series:
+    return (values * KOPECKS).round()
+
+def to_rubles(df: DataFrame, money_columns: list[str]) -> DataFrame:
+    """Данные для записи в Excel: суммы в рублях, остальные колонки без копирования"""
+    columns = [df[col] / KOPECKS if col in money_columns else df[col] for col in df.columns]
+    return pd.concat(columns, axis=1, copy=False) if columns else df
+
+def compact_report(df: DataFrame, schema: dict) -> DataFrame:
+    """Компактное представление прочитанного отчета: текстовые колонки схемы - категории, суммы - в копейках
+
+    Повторяющиеся строки занимают память один раз, а сравнения и разделение по
+    значениям идут по целочисленным кодам категорий.
+    """
+    for col in schema['text']:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    for col in schema['money']:
+        if col in df.columns:
+            df[col] = to_kopecks(df[col])
+    return df
+
+# Форматы дат в выгрузках ОФД
+REPORT_DATETIME_FORMATS = ['%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%d.%m.%Y']
+
+def parse_report_datetime(values: Series) -> Series:
+    """Преобразование колонки даты отчета в datetime
+
+    Формат определяется один раз по первому значению и применяется ко всей колонке;
+    уже преобразованная колонка возвращается как есть.
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+
+    filled = values.dropna()
+    first = filled.iloc[0] if len(filled) else None
+    if isinstance(first, str):
+        for fmt in REPORT_DATETIME_FORMATS:
+            try:
+                datetime.strptime(first, fmt)
+            except ValueError:
+                continue
+            try:
+                return pd.to_datetime(values, format=fmt)
+            except (ValueError, TypeError):
+                # Значения в разных форматах, разбираем как раньше
+                break
+
+    return pd.to_datetime(values)
+
+def detect_report_type(columns, report_type: str) -> str:
+    """Определение типа отчета по заголовкам колонок
+
+    Если колонки не соответствуют запрошенному типу, выбирается подходящий.
+    """
+    has_columns = {
+        name: all(col in columns for col in schema['detect'])
+        for name, schema in REPORT_SCHEMAS.items()
+    }
+
+    # Автоматически определяем тип отчета, если он не соответствует структуре
+    detected_type = report_type
+    if report_type in has_columns and not has_columns[report_type]:
+        for name in REPORT_SCHEMAS:
+            if name != report_type and has_columns[name]:
+                detected_type = name
+                break
+    return detected_type
+
+def read_report_header(excel: pd.ExcelFile, report_type: str) -> tuple[str, list]:
+    """Определение типа отчета по строке заголовков и проверка обязательных колонок"""
+    logger.info(f"Detecting report type based on columns")
+    with stage('detect'):
+        header = list(excel.parse(nrows=0).columns)
+        detected_type = detect_report_type(header, report_type)
+        schema = REPORT_SCHEMAS.get(detected_type, REPORT_SCHEMAS['taxcom'])
+    record_report_type(detected_type)
+
+    # Проверяем наличие необходимых колонок в зависимости от типа отчета
+    missing_columns = [col for col in schema['required'] if col not in header]
+    if missing_columns:
+        raise ConversionError(
+            status_code=400,
+            detail=f"Missing required columns for {detected_type} report: {', '.join(missing_columns)}"
+        )
+    return detected_type, header
+
+def report_dtypes(schema: dict, header: list) -> dict:
+    """Типы колонок схемы при чтении: текстовые как строки, суммы как числа"""
+    dtype = {col: str for col in schema['text'] if col in header}
+    dtype.update({col: 'float64' for col in schema['money'] if col in header})
+    return dtype
+
+def open_report(source) -> pd.ExcelFile:
+    """Открытие книги отчета; файл, который не является книгой Excel, - ошибка загрузки"""
     try:
-        logger.info(f"Получен файл: {file.filename}, тип отчета: {report_type}")
-        
-        # Проверка наличия файла и его имени
-        if not file or not file.filename:
-            raise HTTPException(status_code=400, detail="No file provided")
-            
-        # Проверка расширения файла
-        if not str(file.filename).endswith('.xlsx'):
-            raise HTTPException(status_code=400, detail="Only .xlsx files are allowed")
+        return pd.ExcelFile(source, engine='openpyxl')
+    except (zipfile.BadZipFile, KeyError, ValueError) as e:
+        raise ConversionError(status_code=400, detail=f"Invalid Excel file: {e}")
 
-        # Генерируем уникальные имена файлов
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        temp_path = os.path.join(TEMP_DIR, f"temp_{timestamp}_{file.filename}")
-        
-        # Сохраняем входной файл
-        with open(temp_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        logger.info("File saved successfully")
+def read_excel_report(source, report_type: str, required_only: bool = False) -> tuple[str, DataFrame]:
+    """Чтение Excel отчета и определение его типа по колонкам
+
+    source - путь к файлу, файловый объект или содержимое файла в байтах.
+    Тип определяется по строке заголовков до чтения данных. Колонки из схемы
+    читаются с явными типами; при required_only читаются только они.
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+
+    with open_report(source) as excel:
+        detected_type, header = read_report_header(excel, report_type)
+        schema = REPORT_SCHEMAS.get(detected_type, REPORT_SCHEMAS['taxcom'])
+        dtype = report_dtypes(schema, header)
+        usecols = [col for col in header if col in schema['columns']] if required_only else None
 
         # Читаем Excel файл
         logger.info("Reading Excel file")
-        df = cast(DataFrame, pd.read_excel(temp_path))
+        with stage('read'):
+            df = cast(DataFrame, excel.parse(dtype=dtype, usecols=usecols))
+            if schema['parse_dates']:
+                df[schema['datetime']] = parse_report_datetime(df[schema['datetime']])
+            df = compact_report(df, schema)
         logger.info(f"DataFrame shape: {df.shape}")
+        record_count('rows', len(df))
 
-        # Определяем тип отчета на основе наличия колонок
-        logger.info(f"Detecting report type based on columns")
-        checks_columns = ['Признак расчета', 'Тип налогообложения']
-        nomenclature_columns = ['Признак расчета (тег 1054)', 'Признак предмета расчета (тег 1212)']
-        taxcom_columns = ['Дата и время', 'Система налогообложения', 'Наличными', 'Безналичными', 'Сумма']
-
-        has_checks_columns = all(col in df.columns for col in checks_columns)
-        has_nomenclature_columns = all(col in df.columns for col in nomenclature_columns)
-        has_taxcom_columns = all(col in df.columns for col in taxcom_columns)
-
-        # Автоматически определяем тип отчета, если он не соответствует структуре
-        detected_type = report_type
-        if report_type == 'checks' and not has_checks_columns:
-            if has_nomenclature_columns:
-                detected_type = 'nomenclature'
-            elif has_taxcom_columns:
-                detected_type = 'taxcom'
-        elif report_type == 'nomenclature' and not has_nomenclature_columns:
-            if has_checks_columns:
-                detected_type = 'checks'
-            elif has_taxcom_columns:
-                detected_type = 'taxcom'
-        elif report_type == 'taxcom' and not has_taxcom_columns:
-            if has_checks_columns:
-                detected_type = 'checks'
-            elif has_nomenclature_columns:
-                detected_type = 'nomenclature'
-
-        # Проверяем наличие необходимых колонок в зависимости от типа отчета
-        if detected_type == 'checks':
-            required_columns = ['Дата/время', 'Признак расчета', 'Тип налогообложения']
-        elif detected_type == 'nomenclature':
-            required_columns = [
-                'Дата/время', 'Признак расчета (тег 1054)', 'Признак предмета расчета (тег 1212)',
-                'Наличными по чеку', 'Электронными по чеку', 'Сумма товара'
-            ]
-        else:  # taxcom
-            required_columns = ['Дата и время', 'Система налогообложения', 'Наличными', 'Безналичными', 'Сумма']
-            
-        missing_columns = [col for col in required_columns if col not in df.columns]
-        if missing_columns:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Missing required columns for {detected_type} report: {', '.join(missing_columns)}"
-            )
+    return detected_type, df
+
+def split_positions(values: Series) -> dict:
+    """Позиции строк для каждого значения колонки за один проход
+
+    Значения идут в порядке первого появления, пустые значения пропускаются.
+    """
+    codes, uniques = pd.factorize(values)
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    # Строки с пустыми значениями (код -1) стоят в начале
+    order = order[len(codes) - counts.sum():]
+    return dict(zip(uniques, np.split(order, np.cumsum(counts)[:-1])))
+
+# Части отчетов по чекам (по вхождению в 'Тип налогообложения') и Такском (система налогообложения и суффикс файла)
+CHECKS_TAX_TYPES = ['ПАТЕНТ', 'УСН']
+TAXCOM_TAX_TYPES = {'Патент': 'PATENT', 'УСН доход': 'USN'}
+
+def split_report(df: DataFrame, detected_type: str) -> list[tuple[str, str, np.ndarray]]:
+    """Разделение обработанного отчета на выходные файлы
+
+    Возвращает кортежи (суффикс имени файла, имя листа, позиции строк).
+    """
+    parts = []
+    if detected_type == 'checks':
+        # Разделяем по типу налогообложения; строка может попасть в обе части
+        tax_values = split_positions(df['Тип налогообложения'])
+        for tax_type in CHECKS_TAX_TYPES:
+            matched = [positions for value, positions in tax_values.items()
+                       if tax_type.lower() in str(value).lower()]
+            if matched:
+                parts.append((tax_type, f'{tax_type}', np.sort(np.concatenate(matched))))
+    elif detected_type == 'nomenclature':
+        # Разделяем по признаку предмета расчета
+        for item_type, positions in split_positions(df['Признак предмета расчета (тег 1212)']).items():
+            safe_item_type = "".join(x for x in str(item_type) if x.isalnum() or x in (' ', '-', '_'))[:50]
+            parts.append((safe_item_type, safe_item_type, positions))
+    else:  # taxcom
+        # Разделяем по системе налогообложения
+        tax_values = split_positions(df['Система налогообложения'])
+        for tax_type, file_suffix in TAXCOM_TAX_TYPES.items():
+            if tax_type in tax_values:
+                parts.append((file_suffix, tax_type, tax_values[tax_type]))
+    return parts
+
+def process_report(df: DataFrame, detected_type: str) -> tuple[DataFrame, Callable]:
+    """Обработка данных по типу отчета, возвращает обработанные данные и функцию записи итогов"""
+    if detected_type == 'checks':
+        return process_dataframe(df), add_daily_totals
+    if detected_type == 'nomenclature':
+        return process_nomenclature_dataframe(df), add_daily_totals_nomenclature
+    return process_taxcom_dataframe(df), add_daily_totals_taxcom
+
+def partition_report(df: DataFrame, detected_type: str) -> list[tuple]:
+    """Обработка данных и разделение на выходные файлы за один проход
+
+    Строки всех частей выбираются одной операцией, каждая часть - срез без копирования.
+    Ежедневные итоги всех частей считаются одной групповой агрегацией.
+    Возвращает кортежи (суффикс имени файла, имя листа, данные, функция записи итогов, итоги).
+    """
+    logger.info(f"Processing data for report type: {detected_type}")
+    with stage('process'):
+        df, add_totals = process_report(df, detected_type)
+
+    with stage('partition'):
+        parts = split_report(df, detected_type)
+        if not parts:
+            return []
+
+        # Строки частей подряд в одном DataFrame
+        lengths = [len(positions) for _, _, positions in parts]
+        ordered = df.take(np.concatenate([positions for _, _, positions in parts]))
+        codes = np.repeat(np.arange(len(parts)), lengths)
+
+        schema = REPORT_SCHEMAS.get(detected_type, REPORT_SCHEMAS['taxcom'])
+        totals = partition_daily_totals(ordered, codes, len(parts), schema['datetime'], schema['totals'])
+
+    bounds = np.cumsum([0] + lengths)
+    return [
+        (file_suffix, sheet_name, ordered.iloc[bounds[i]:bounds[i + 1]], add_totals, totals[i])
+        for i, (file_suffix, sheet_name, _) in enumerate(parts)
+    ]
+
+# Хранилище итогов для пересекающихся выгрузок одной кассы: строки отчета, уже учтенные
+# в прошлых загрузках, и ежедневные итоги частей в копейках
+TOTALS_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS report_rows (
+    register TEXT NOT NULL,
+    report_type TEXT NOT NULL,
+    day TEXT NOT NULL,
+    row_key INTEGER NOT NULL,
+    PRIMARY KEY (register, report_type, day, row_key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS daily_totals (
+    register TEXT NOT NULL,
+    report_type TEXT NOT NULL,
+    file_suffix TEXT NOT NULL,
+    sheet TEXT NOT NULL,
+    day TEXT NOT NULL,
+    column_name TEXT NOT NULL,
+    kopecks INTEGER NOT NULL,
+    PRIMARY KEY (register, report_type, file_suffix, day, column_name)
+);
+"""
+
+class DailyTotalsStore:
+    """Ежедневные итоги частей отчетов и учтенные строки по кассам в файле SQLite
+
+    Строка отчета узнается по ключу - хэшу колонок схемы и номера повторения
+    одинаковых строк в выгрузке: строки пересекающихся выгрузок учитываются один раз,
+    а одинаковые позиции одной выгрузки - каждая. Соединение открывается в процессе,
+    где к нему обращаются. Загрузка только читает хранилище, а ее строки учитываются
+    после отдачи результата (apply); проверка и учет строк идут в одной транзакции,
+    поэтому одновременные загрузки одной кассы не учитывают строку дважды.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @contextmanager
+    def transaction(self, write: bool = True) -> Iterator[sqlite3.Connection]:
+        """Транзакция; без write - только чтение согласованного состояния хранилища"""
+        connection = sqlite3.connect(self.path, timeout=JOB_TIMEOUT, isolation_level=None)
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(TOTALS_DB_SCHEMA)
+            connection.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+    def seen_rows(self, connection: sqlite3.Connection, register: str, report_type: str,
+                  first_day: str, last_day: str) -> np.ndarray:
+        """Ключи строк, учтенных за дни от first_day до last_day"""
+        rows = connection.execute(
+            'SELECT row_key FROM report_rows WHERE register = ? AND report_type = ? AND day BETWEEN ? AND ?',
+            (register, report_type, first_day, last_day))
+        return np.fromiter((row_key for row_key, in rows), dtype=np.int64)
+
+    def apply(self, update: tuple) -> int:
+        """Учет новых строк загрузки и прибавление их итогов к хранимым
+
+        update - обновление из stored_partitions. Строки, которые после чтения хранилища
+        учла другая загрузка той же кассы, пропускаются вместе со своим вкладом в итоги.
+        Возвращает число учтенных строк.
+        """
+        register, report_type, keys, rows, value_columns = update
+        if keys.empty:
+            return 0
+        with self.transaction() as connection:
+            seen = self.seen_rows(connection, register, report_type, keys['day'].min(), keys['day'].max())
+            keys = keys[~np.isin(keys['row_key'].to_numpy(), seen)]
+            rows = rows[rows['row_key'].isin(keys['row_key'])]
+            sums = rows.groupby(['file_suffix', 'sheet', 'day'], sort=False)[value_columns].sum().reset_index()
+            connection.executemany(
+                'INSERT INTO report_rows VALUES (?, ?, ?, ?)',
+                ((register, report_type, day, row_key)
+                 for day, row_key in zip(keys['day'].tolist(), keys['row_key'].tolist())))
+            connection.executemany(
+                'INSERT INTO daily_totals VALUES (?, ?, ?, ?, ?, ?, ?)'
+                ' ON CONFLICT (register, report_type, file_suffix, day, column_name)'
+                ' DO UPDATE SET kopecks = kopecks + excluded.kopecks',
+                ((register, report_type, file_suffix, sheet_name, day, col, int(round(value)))
+                 for file_suffix, sheet_name, day, *values in sums.itertuples(index=False)
+                 for col, value in zip(value_columns, values)))
+        logger.info(f"Stored {len(keys)} new rows for register {register}")
+        return len(keys)
+
+    def totals(self, connection: sqlite3.Connection, register: str, report_type: str,
+               first_day: str, last_day: str, value_columns: list[str]) -> list[tuple[str, str, DataFrame]]:
+        """Итоги частей за дни от first_day до last_day: кортежи (суффикс имени файла, имя листа, итоги)
+
+        Части идут в порядке их первого учета, итоги - в том же виде, что у partition_report.
+        """
+        rows = connection.execute(
+            'SELECT file_suffix, sheet, day, column_name, kopecks FROM daily_totals'
+            ' WHERE register = ? AND report_type = ? AND day BETWEEN ? AND ? ORDER BY rowid',
+            (register, report_type, first_day, last_day)).fetchall()
+        stored = pd.DataFrame(rows, columns=['file_suffix', 'sheet', 'day', 'column_name', 'kopecks'])
+        parts = []
+        for (file_suffix, sheet_name), part in stored.groupby(['file_suffix', 'sheet'], sort=False):
+            table = (part.pivot(index='day', columns='column_name', values='kopecks')
+                     .reindex(columns=value_columns).fillna(0).astype('float64').sort_index())
+            totals = pd.DataFrame({'Дата': [date.fromisoformat(day) for day in table.index]})
+            for col in value_columns:
+                totals[col] = table[col].to_numpy()
+            parts.append((file_suffix, sheet_name, totals))
+        return parts
+
+totals_store = DailyTotalsStore(TOTALS_DB) if TOTALS_DB else None
+
+def report_row_keys(df: DataFrame, schema: dict) -> DataFrame:
+    """День и ключ каждой строки прочитанного отчета
+
+    Ключ - хэш значений колонок схемы и номера повторения: одинаковые строки
+    нумеруются по порядку. У строк без даты, например итоговых строк Такском, день пустой.
+    """
+    values = df[schema['datetime']]
+    if not pd.api.types.is_datetime64_any_dtype(values):
+        values = parse_report_datetime(values.mask(values.astype(str).str.contains('Итог', case=False, na=False)))
+    columns = [col for col in schema['columns'] if col in df.columns]
+    fingerprints = pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+    occurrences = pd.Series(fingerprints).groupby(fingerprints).cumcount().to_numpy()
+    row_keys = pd.util.hash_array(fingerprints ^ pd.util.hash_array(occurrences))
+    days = np.datetime_as_string(values.to_numpy().astype('datetime64[D]')).astype(object)
+    days[values.isna().to_numpy()] = None
+    return pd.DataFrame({'day': days, 'row_key': row_keys.view(np.int64)})
+
+def stored_partitions(df: DataFrame, detected_type: str, register: str) -> tuple[int, list[tuple], tuple]:
+    """Обработка только новых строк отчета кассы register с итогами из хранилища
+
+    Ключи строк считаются один раз; обрабатываются и разделяются на части только строки,
+    которых не было в прошлых загрузках кассы. Хранилище только читается.
+    Возвращает число новых строк, кортежи, как у partition_report, и обновление
+    хранилища для DailyTotalsStore.apply. Данные части - только новые строки (для частей
+    без новых строк пусто), итоги - хранимые вместе с итогами новых строк за дни
+    от первого до последнего дня отчета.
+    """
+    schema = REPORT_SCHEMAS.get(detected_type, REPORT_SCHEMAS['taxcom'])
+    value_columns = schema['totals']
+    keys = report_row_keys(df, schema).set_axis(df.index)
+    dated = keys['day'].notna().to_numpy()
+    days = keys['day'][dated]
+    first_day, last_day = (days.min(), days.max()) if len(days) else ('', '')
+
+    with stage('store'), cast(DailyTotalsStore, totals_store).transaction(write=False) as connection:
+        seen = totals_store.seen_rows(connection, register, detected_type, first_day, last_day)
+        stored = totals_store.totals(connection, register, detected_type, first_day, last_day, value_columns)
+    new = dated & ~np.isin(keys['row_key'].to_numpy(), seen)
+    logger.info(f"New rows for register {register}: {new.sum()} of {len(df)}")
+    record_count('new_rows', int(new.sum()))
+
+    # Строки без даты обрабатываются вместе с новыми: обработка сама их отбрасывает
+    partitions = partition_report(df[new | ~dated], detected_type)
+
+    # Вклад каждой новой строки в итоги ее частей: строки, уже учтенные к моменту
+    # внесения обновления, вычитаются из него точно
+    is_new = pd.Series(new, index=df.index)
+    contributions = []
+    for file_suffix, sheet_name, df_part, _, _ in partitions:
+        part = df_part[is_new.loc[df_part.index].to_numpy()]
+        if len(part):
+            contributions.append(keys.loc[part.index].assign(
+                file_suffix=file_suffix, sheet=sheet_name, **{col: part[col].fillna(0) for col in value_columns}))
+    rows = (pd.concat(contributions, ignore_index=True) if contributions
+            else pd.DataFrame(columns=['day', 'row_key', 'file_suffix', 'sheet', *value_columns]))
+    update = (register, detected_type, keys[new], rows, value_columns)
+
+    # Части в порядке их первого учета, за ними - впервые встреченные в этой загрузке
+    new_parts = {file_suffix: (df_part, add_totals, totals)
+                 for file_suffix, _, df_part, add_totals, totals in partitions}
+    stored_suffixes = {file_suffix for file_suffix, _, _ in stored}
+    stored += [(file_suffix, sheet_name, None) for file_suffix, sheet_name, _, _, totals in partitions
+               if file_suffix not in stored_suffixes and len(totals)]
+    empty = None
+    result = []
+    for file_suffix, sheet_name, totals in stored:
+        if file_suffix in new_parts:
+            df_part, add_totals, new_totals = new_parts[file_suffix]
+            if len(new_totals):
+                # Хранилище держит итоги в целых копейках
+                new_totals = new_totals.round()
+                totals = new_totals if totals is None else combine_daily_totals([totals, new_totals], value_columns)
+        else:
+            if empty is None:
+                # Части без новых строк в этой загрузке: пустые данные с колонками обработанного отчета
+                empty = process_report(df.iloc[:0], detected_type)
+            df_part, add_totals = empty
+        result.append((file_suffix, sheet_name, df_part, add_totals, totals))
+    return int(new.sum()), result, update
+
+def prepare_excel(source, report_type: str) -> tuple[str, list]:
+    """Чтение, обработка и разделение Excel отчета без записи выходных файлов"""
+    detected_type, df = read_excel_report(source, report_type)
+    return detected_type, partition_report(df, detected_type)
+
+def prepare_register_excel(source, report_type: str, register: str) -> tuple[str, list, tuple]:
+    """prepare_excel для кассы register: новые строки с итогами из хранилища и обновление хранилища"""
+    detected_type, df = read_excel_report(source, report_type)
+    _, partitions, update = stored_partitions(df, detected_type, register)
+    return detected_type, partitions, update
+
+def write_partition(df: DataFrame, sheet_name: str, add_totals,
+                    daily_totals_df: Optional[DataFrame] = None) -> bytes:
+    """Запись части отчета с ежедневными итогами в книгу Excel в памяти"""
+    buffer = io.BytesIO()
+    with stage('write'):
+        with create_report_writer(buffer) as writer:
+            add_totals(df, writer, sheet_name, daily_totals_df)
+    return buffer.getvalue()
+
+def build_zip(members: list[tuple[str, bytes]]) -> bytes:
+    """Сборка ZIP архива в памяти из пар (путь в архиве, содержимое)"""
+    buffer = io.BytesIO()
+    with stage('zip'):
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for arcname, data in members:
+                zipf.writestr(arcname, data)
+    return buffer.getvalue()
+
+def convert_excel(source, filename: str, report_type: str, timestamp: str,
+                  work_dir: Optional[str] = None) -> bytes:
+    """Конвертация Excel отчета, возвращает содержимое архива с результатами
+
+    В режиме IN_MEMORY_PIPELINE выходные файлы и архив собираются в памяти,
+    иначе через временные файлы в отдельном каталоге внутри каталога запроса work_dir.
+    """
+    detected_type, df = read_excel_report(source, report_type)
+    partitions = partition_report(df, detected_type)
+    del df
+
+    if IN_MEMORY_PIPELINE:
+        members = [
+            (f"processed_{file_suffix}_{timestamp}_{filename}",
+             write_partition(df_filtered, sheet_name, add_totals, totals))
+            for file_suffix, sheet_name, df_filtered, add_totals, totals in partitions
+        ]
+        if not members:
+            raise Exception("Не удалось создать выходные файлы")
+        logger.info(f"Creating ZIP archive in memory: {len(members)} files")
+        return build_zip(members)
+
+    # Временные файлы удаляются вместе с каталогом
+    with workspaces.open('excel', work_dir) as temp_dir:
+        output_files = []
+        for file_suffix, sheet_name, df_filtered, add_totals, totals in partitions:
+            output_filename = os.path.join(temp_dir, f"processed_{file_suffix}_{timestamp}_{filename}")
+            output_files.append(output_filename)
+            with stage('write'), create_report_writer(output_filename) as writer:
+                add_totals(df_filtered, writer, sheet_name, totals)
 
-        # Обрабатываем данные в зависимости от типа отчета
-        logger.info(f"Processing data for report type: {detected_type}")
-        if detected_type == 'checks':
-            df = process_dataframe(df)
-            # Разделяем по типу налогообложения
-            for tax_type in ['ПАТЕНТ', 'УСН']:
-                mask = df['Тип налогообложения'].str.contains(tax_type, case=False, na=False)
-                df_filtered = cast(DataFrame, df[mask])
-                if not df_filtered.empty:
-                    output_filename = os.path.join(TEMP_DIR, f"processed_{tax_type}_{timestamp}_{file.filename}")
-                    with pd.ExcelWriter(output_filename, engine='openpyxl') as writer:
-                        add_daily_totals(df_filtered.copy(), writer, f'{tax_type}')
-                    output_files.append(output_filename)
-        elif detected_type == 'nomenclature':
-            df = process_nomenclature_dataframe(df)
-            # Разделяем по признаку предмета расчета
-            for item_type in df['Признак предмета расчета (тег 1212)'].unique():
-                if pd.isna(item_type):
-                    continue
-                mask = df['Признак предмета расчета (тег 1212)'] == item_type
-                df_filtered = cast(DataFrame, df[mask])
-                if not df_filtered.empty:
-                    safe_item_type = "".join(x for x in str(item_type) if x.isalnum() or x in (' ', '-', '_'))[:50]
-                    output_filename = os.path.join(TEMP_DIR, f"processed_{safe_item_type}_{timestamp}_{file.filename}")
-                    with pd.ExcelWriter(output_filename, engine='openpyxl') as writer:
-                        add_daily_totals_nomenclature(df_filtered.copy(), writer, safe_item_type)
-                    output_files.append(output_filename)
-        else:  # taxcom
-            df = process_taxcom_dataframe(df)
-            # Разделяем по системе налогообложения
-            tax_types_map = {'Патент': 'PATENT', 'УСН доход': 'USN'}
-            for tax_type, file_suffix in tax_types_map.items():
-                mask = df['Система налогообложения'] == tax_type
-                df_filtered = cast(DataFrame, df[mask])
-                if not df_filtered.empty:
-                    output_filename = os.path.join(TEMP_DIR, f"processed_{file_suffix}_{timestamp}_{file.filename}")
-                    with pd.ExcelWriter(output_filename, engine='openpyxl') as writer:
-                        add_daily_totals_taxcom(df_filtered.copy(), writer, tax_type)
-                    output_files.append(output_filename)
-        
         # Проверяем, что файлы созданы
         if not output_files:
             raise Exception("Не удалось создать выходные файлы")
-        
+
         # Создаем архив с результатами
-        archive_name = os.path.join(TEMP_DIR, f"results_{timestamp}.zip")
+        archive_name = os.path.join(temp_dir, f"results_{timestamp}.zip")
         logger.info(f"Creating ZIP archive: {archive_name}")
-        
-        with zipfile.ZipFile(archive_name, 'w', zipfile.ZIP_DEFLATED) as zipf:
+
+        with stage('zip'), zipfile.ZipFile(archive_name, 'w', zipfile.ZIP_DEFLATED) as zipf:
             for f in output_files:
                 if os.path.exists(f):
                     zipf.write(f, os.path.basename(f))
                 else:
                     logger.error(f"Файл {f} не найден при создании архива")
-        
+
         # Проверяем, что архив создан
         if not os.path.exists(archive_name):
             raise Exception("Не удалось создать архив с результатами")
-        
-        logger.info("Processing completed successfully")
-        
+
         # Читаем архив в память
         with open(archive_name, 'rb') as f:
-            file_data = f.read()
-        
-        # Удаляем временные файлы
-        if temp_path and os.path.exists(temp_path):
-            os.remove(temp_path)
-        for f in output_files:
-            if os.path.exists(f):
-                os.remove(f)
-        if archive_name and os.path.exists(archive_name):
-            os.remove(archive_name)
-        
-        # Возвращаем архив с правильными заголовками
-        return Response(
-            content=file_data,
-            media_type='application/zip',
-            headers={
-                'Content-Disposition': f'attachment; filename="results_{timestamp}.zip"',
-                'Content-Type': 'application/zip'
-            }
+            return f.read()
+
+# Потоковая обработка больших отчетов по чекам и Такском
+CHUNKED_REPORT_TYPES = ('checks', 'taxcom')
+# Строк в пакете файла отсортированной порции и число файлов, сливаемых за один проход
+MERGE_BATCH_ROWS = 2000
+MERGE_FAN_IN = 32
+
+def _cell_value(cell):
+    """Значение ячейки в том виде, в котором его читает pandas.read_excel"""
+    if cell.value is None:
+        return ''
+    if cell.data_type == TYPE_ERROR:
+        return np.nan
+    if cell.data_type == TYPE_NUMERIC:
+        value = int(cell.value)
+        return value if value == cell.value else float(cell.value)
+    return cell.value
+
+def read_report_chunks(excel: pd.ExcelFile, header: list, schema: dict) -> Iterator[DataFrame]:
+    """Строки первого листа порциями по CHUNK_ROWS с теми же типами, что при чтении всего листа
+
+    Лист книги, открытой в режиме read-only, читается одним проходом; в памяти
+    только текущая порция.
+    """
+    sheet = excel.book.worksheets[0]
+    sheet.reset_dimensions()
+    rows_iter = iter(sheet.rows)
+    width = len(header)
+    dtype = report_dtypes(schema, header)
+    header_skipped = False
+    while True:
+        with stage('read'):
+            rows = []
+            for row in rows_iter:
+                values = [_cell_value(cell) for cell in row[:width]]
+                while values and values[-1] == '':
+                    values.pop()
+                # Пустые строки пропускаются, первая непустая - заголовок
+                if not values:
+                    continue
+                if not header_skipped:
+                    header_skipped = True
+                    continue
+                rows.append(values + [''] * (width - len(values)))
+                if len(rows) >= CHUNK_ROWS:
+                    break
+            if not rows:
+                return
+            chunk = compact_report(cast(DataFrame, TextParser(rows, names=header, dtype=dtype).read()), schema)
+        yield chunk
+
+def _batches(items: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+class SortedRuns:
+    """Строки части отчета, отсортированные по дате порциями во временных файлах
+
+    Каждая порция сохраняется пакетами по MERGE_BATCH_ROWS строк и при чтении
+    сливается с остальными; при равных датах сохраняется порядок строк в файле.
+    Если порций больше MERGE_FAN_IN, они заранее сливаются группами, поэтому в
+    памяти одновременно не больше MERGE_FAN_IN пакетов.
+    """
+
+    def __init__(self, directory: str, name: str, datetime_column: str):
+        self.directory = directory
+        self.name = name
+        self.datetime_column = datetime_column
+        self.columns: Optional[DataFrame] = None
+        self.paths: list[str] = []
+        self._created = 0
+
+    def _new_path(self) -> str:
+        self._created += 1
+        return os.path.join(self.directory, f"{self.name}_{self._created}.run")
+
+    def _save(self, batches: Iterable[DataFrame]) -> str:
+        path = self._new_path()
+        with open(path, 'wb') as f:
+            for batch in batches:
+                pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+        return path
+
+    def add(self, df: DataFrame) -> None:
+        """Сохранение порции, уже отсортированной по дате"""
+        if self.columns is None:
+            self.columns = df.iloc[:0]
+        self.paths.append(self._save(
+            df.iloc[start:start + MERGE_BATCH_ROWS] for start in range(0, len(df), MERGE_BATCH_ROWS)
+        ))
+
+    def _rows(self, path: str) -> Iterator[tuple[int, tuple]]:
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    batch = pickle.load(f)
+                except EOFError:
+                    return
+                keys = batch[self.datetime_column].to_numpy(dtype='datetime64[ns]').view('i8')
+                # Строки без даты идут последними, как при sort_values
+                keys = np.where(keys == np.iinfo(np.int64).min, np.iinfo(np.int64).max, keys)
+                yield from zip(keys.tolist(), batch.itertuples(index=False, name=None))
+
+    def _merge(self, paths: list[str]) -> Iterator[tuple[int, tuple]]:
+        # heapq.merge при равных ключах сохраняет порядок файлов
+        return heapq.merge(*(self._rows(path) for path in paths), key=itemgetter(0))
+
+    def _frame(self, rows: list[tuple[int, tuple]]) -> DataFrame:
+        return pd.DataFrame.from_records([row for _, row in rows], columns=self.columns.columns)
+
+    def chunks(self) -> Iterator[DataFrame]:
+        """Строки части в порядке дат порциями по CHUNK_ROWS строк"""
+        while len(self.paths) > MERGE_FAN_IN:
+            merged = []
+            for group in _batches(self.paths, MERGE_FAN_IN):
+                merged.append(self._save(
+                    self._frame(rows) for rows in _batches(self._merge(group), MERGE_BATCH_ROWS)
+                ))
+                for path in group:
+                    os.remove(path)
+            self.paths = merged
+        for rows in _batches(self._merge(self.paths), CHUNK_ROWS):
+            yield self._frame(rows)
+
+def combine_daily_totals(totals: list[DataFrame], value_columns: list[str]) -> DataFrame:
+    """Ежедневные итоги части по итогам ее порций"""
+    totals = [part for part in totals if len(part)]
+    if not totals:
+        return pd.DataFrame(columns=['Дата', *value_columns])
+    return pd.concat(totals, ignore_index=True).groupby('Дата', as_index=False)[value_columns].sum()
+
+def spill_report_chunks(excel: pd.ExcelFile, detected_type: str, header: list,
+                        directory: str) -> list[tuple]:
+    """Чтение и обработка отчета порциями: части порций сохраняются на диск, итоги накапливаются
+
+    Возвращает кортежи (суффикс имени файла, имя листа, функция записи итогов, итоги, порции части).
+    """
+    schema = REPORT_SCHEMAS[detected_type]
+    parts = {}
+    rows = 0
+    for chunk in read_report_chunks(excel, header, schema):
+        rows += len(chunk)
+        for file_suffix, sheet_name, df_part, add_totals, totals in partition_report(chunk, detected_type):
+            if file_suffix not in parts:
+                runs = SortedRuns(directory, f"part{len(parts)}", schema['datetime'])
+                parts[file_suffix] = (sheet_name, add_totals, [], runs)
+            parts[file_suffix][2].append(totals)
+            with stage('spill'):
+                parts[file_suffix][3].add(df_part)
+    logger.info(f"Read {rows} rows in chunks of {CHUNK_ROWS}")
+    record_count('rows', rows)
+
+    # Части в том же порядке, что и при обработке всего отчета
+    order = [*CHECKS_TAX_TYPES, *TAXCOM_TAX_TYPES.values()]
+    return [
+        (file_suffix, sheet_name, add_totals, combine_daily_totals(totals, schema['totals']), runs)
+        for file_suffix, (sheet_name, add_totals, totals, runs)
+        in sorted(parts.items(), key=lambda item: order.index(item[0]))
+    ]
+
+def convert_excel_chunked(source, filename: str, report_type: str, timestamp: str,
+                          archive_path: str, work_dir: Optional[str] = None) -> tuple[str, int]:
+    """Конвертация большого Excel отчета с записью архива в archive_path, возвращает тип отчета и число файлов
+
+    Отчеты по чекам и Такском читаются порциями по CHUNK_ROWS строк: итоги по дням
+    накапливаются по порциям, отсортированные порции сбрасываются на диск и сливаются
+    при записи книг, поэтому память не зависит от размера файла. Отчет по номенклатуре
+    обрабатывается целиком. Книги пишутся во временные файлы в отдельном каталоге
+    внутри каталога запроса work_dir.
+    """
+    with workspaces.open('chunked', work_dir) as work_dir:
+        with open_report(source) as excel:
+            detected_type, header = read_report_header(excel, report_type)
+            if detected_type in CHUNKED_REPORT_TYPES:
+                parts = spill_report_chunks(excel, detected_type, header, work_dir)
+
+        if detected_type not in CHUNKED_REPORT_TYPES:
+            logger.warning(f"Chunked processing is not supported for {detected_type} reports, reading the whole file")
+            detected_type, df = read_excel_report(source, report_type)
+            parts = [
+                (file_suffix, sheet_name, add_totals, totals, df_part)
+                for file_suffix, sheet_name, df_part, add_totals, totals in partition_report(df, detected_type)
+            ]
+            del df
+
+        if not parts:
+            raise Exception("Не удалось создать выходные файлы")
+
+        with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            while parts:
+                file_suffix, sheet_name, add_totals, totals, data = parts.pop(0)
+                output_name = f"processed_{file_suffix}_{timestamp}_{filename}"
+                output_path = os.path.join(work_dir, f"output_{file_suffix}.xlsx")
+                with stage('write'), create_report_writer(output_path) as writer:
+                    if isinstance(data, SortedRuns):
+                        add_totals(data.columns, writer, sheet_name, totals, chunks=data.chunks())
+                    else:
+                        add_totals(data, writer, sheet_name, totals)
+                with stage('zip'):
+                    zipf.write(output_path, output_name)
+                os.remove(output_path)
+            count = len(zipf.namelist())
+
+    logger.info(f"Created ZIP archive: {archive_path}, {count} files")
+    return detected_type, count
+
+def convert_excel_members(source, filename: str, report_type: str, timestamp: str, chunked: bool = False,
+                          work_dir: Optional[str] = None) -> tuple[str, list[tuple[str, bytes]]]:
+    """Конвертация Excel отчета в одном вызове, возвращает тип отчета и пары (имя файла, содержимое)
+
+    Для пакетной обработки: файлы пакета конвертируются параллельно, а книги одного
+    файла пишутся по одной. При chunked отчет обрабатывается порциями через временный архив
+    в каталоге запроса work_dir.
+    """
+    if chunked:
+        with workspaces.open('batch', work_dir) as work_dir:
+            archive_path = os.path.join(work_dir, 'results.zip')
+            detected_type, _ = convert_excel_chunked(source, filename, report_type, timestamp,
+                                                     archive_path, work_dir)
+            with zipfile.ZipFile(archive_path) as archive:
+                return detected_type, [(name, archive.read(name)) for name in archive.namelist()]
+
+    detected_type, partitions = prepare_excel(source, report_type)
+    if not partitions:
+        raise Exception("Не удалось создать выходные файлы")
+    members = []
+    while partitions:
+        file_suffix, sheet_name, df_filtered, add_totals, totals = partitions.pop(0)
+        members.append((f"processed_{file_suffix}_{timestamp}_{filename}",
+                        write_partition(df_filtered, sheet_name, add_totals, totals)))
+    return detected_type, members
+
+# Элементы заголовка электронного счета, атрибуты которых нужны для card.xml и meta.xml
+BILL_HEADER_TAGS = ('Файл', 'Документ', 'СвПрод', 'СвПокуп')
+# Размер порции текста XML, передаваемой парсеру
+BILL_PARSE_CHUNK = 64 * 1024
+
+def extract_bill_header(source: Union[str, bytes]) -> dict[str, dict[str, str]]:
+    """Атрибуты элементов заголовка счета за один проход, без построения дерева документа
+
+    Для каждого тега из BILL_HEADER_TAGS берутся атрибуты первого элемента с ним,
+    включая корневой. Разобранные элементы сразу освобождаются, а разбор
+    останавливается, как только найдены все теги: строки товаров (СведТов) после
+    заголовка не разбираются. Некорректный XML до этого места дает ET.ParseError.
+    source - текст XML или его байты, кодировку которых парсер определяет по BOM и прологу.
+    """
+    header: dict[str, dict[str, str]] = {}
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    parents = []
+    for start in range(0, len(source), BILL_PARSE_CHUNK):
+        parser.feed(source[start:start + BILL_PARSE_CHUNK])
+        for event, element in parser.read_events():
+            if event == 'start':
+                if element.tag in BILL_HEADER_TAGS and element.tag not in header:
+                    header[element.tag] = dict(element.attrib)
+                    if len(header) == len(BILL_HEADER_TAGS):
+                        return header
+                parents.append(element)
+            else:
+                # Все дочерние элементы родителя уже разобраны, удаляем их из дерева
+                parents.pop()
+                if parents:
+                    del parents[-1][:]
+    parser.close()
+    return header
+
+# Итоги отчета без записи книг: ответ /api/process_excel?output=json
+def partition_totals_json(file_suffix: str, sheet_name: str, rows: int,
+                          totals: DataFrame, value_columns: list[str]) -> dict:
+    """Итоги части отчета для JSON: суммы по дням и за весь период в рублях"""
+    values = {col: (totals[col] / KOPECKS).tolist() for col in value_columns}
+    return {
+        'file_suffix': file_suffix,
+        'sheet': sheet_name,
+        'rows': rows,
+        'daily_totals': [
+            {'date': str(day), **{col: values[col][i] for col in value_columns}}
+            for i, day in enumerate(totals['Дата'])
+        ],
+        'total': {col: float(totals[col].sum()) / KOPECKS for col in value_columns},
+    }
+
+def excel_totals(source, report_type: str, chunked: bool = False, register: Optional[str] = None) -> dict:
+    """Ежедневные итоги частей Excel отчета без записи книг и архива
+
+    Читаются только колонки схемы. При chunked отчеты по чекам и Такском читаются
+    порциями по CHUNK_ROWS строк, итоги порций складываются; на диск ничего не пишется.
+    Для кассы register отчет читается целиком, обрабатываются только новые строки,
+    а итоги берутся из хранилища итогов вместе с итогами новых строк; хранилище не меняется.
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+
+    if chunked and register is None:
+        with open_report(source) as excel:
+            detected_type, header = read_report_header(excel, report_type)
+            if detected_type in CHUNKED_REPORT_TYPES:
+                schema = REPORT_SCHEMAS[detected_type]
+                chunk_parts = {}
+                rows = 0
+                for chunk in read_report_chunks(excel, header, schema):
+                    rows += len(chunk)
+                    for file_suffix, sheet_name, df_part, _, totals in partition_report(chunk, detected_type):
+                        part = chunk_parts.setdefault(file_suffix, [sheet_name, 0, []])
+                        part[1] += len(df_part)
+                        part[2].append(totals)
+                record_count('rows', rows)
+
+                # Части в том же порядке, что и при обработке всего отчета
+                order = [*CHECKS_TAX_TYPES, *TAXCOM_TAX_TYPES.values()]
+                parts = [
+                    (file_suffix, sheet_name, part_rows, combine_daily_totals(totals, schema['totals']))
+                    for file_suffix, (sheet_name, part_rows, totals)
+                    in sorted(chunk_parts.items(), key=lambda item: order.index(item[0]))
+                ]
+                return {'report_type': detected_type, 'rows': rows,
+                        'partitions': [partition_totals_json(*part, schema['totals']) for part in parts]}
+        logger.warning(f"Chunked processing is not supported for {detected_type} reports, reading the whole file")
+        if hasattr(source, 'seek'):
+            source.seek(0)
+
+    detected_type, df = read_excel_report(source, report_type, required_only=True)
+    schema = REPORT_SCHEMAS.get(detected_type, REPORT_SCHEMAS['taxcom'])
+    if register is not None:
+        # Предварительный просмотр: строки загрузки в хранилище не учитываются
+        new_rows, partitions, _ = stored_partitions(df, detected_type, register)
+        return {
+            'report_type': detected_type,
+            'rows': len(df),
+            'new_rows': new_rows,
+            'partitions': [
+                partition_totals_json(file_suffix, sheet_name, len(df_part), totals, schema['totals'])
+                for file_suffix, sheet_name, df_part, _, totals in partitions
+            ],
+        }
+    return {
+        'report_type': detected_type,
+        'rows': len(df),
+        'partitions': [
+            partition_totals_json(file_suffix, sheet_name, len(df_part), totals, schema['totals'])
+            for file_suffix, sheet_name, df_part, _, totals in partition_report(df, detected_type)
+        ],
+    }
+
+# Кодировка XML файлов в контейнере Такском
+BILL_ENCODING = 'windows-1251'
+XML_DECLARATION_ENCODING = re.compile(rb"""^<\?xml[^>]*?encoding\s*=\s*["']([A-Za-z][A-Za-z0-9._-]*)["']""")
+XML_DECLARATION = re.compile(r'^<\?xml[^>]*\?>')
+XML_DECLARATION_ATTRIBUTE = {
+    'encoding': re.compile(r"""(encoding\s*=\s*["'])[^"']*(["'])"""),
+    'version': re.compile(r"""(version\s*=\s*["'][^"']*["'])"""),
+}
+
+def sniff_xml_encoding(content: bytes) -> Optional[str]:
+    """Кодировка XML по BOM и объявлению в прологе, как ее определяет парсер; None, если она не указана"""
+    if content.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if content.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    # UTF-16 без BOM узнается по первым символам пролога
+    if content.startswith(b'<\x00?\x00'):
+        return 'utf-16-le'
+    if content.startswith(b'\x00<\x00?'):
+        return 'utf-16-be'
+    match = XML_DECLARATION_ENCODING.match(content[:256])
+    return match.group(1).decode('ascii') if match else None
+
+def declare_encoding(xml_content: str, encoding: str) -> str:
+    """Текст XML с объявлением кодировки encoding в прологе; пролог добавляется, если его нет"""
+    match = XML_DECLARATION.match(xml_content)
+    if match is None:
+        return f'<?xml version="1.0" encoding="{encoding}"?>\n' + xml_content
+    declaration = match.group(0)
+    if XML_DECLARATION_ATTRIBUTE['encoding'].search(declaration):
+        declaration = XML_DECLARATION_ATTRIBUTE['encoding'].sub(rf'\g<1>{encoding}\g<2>', declaration, count=1)
+    else:
+        # Кодировка объявляется сразу после версии
+        declaration = XML_DECLARATION_ATTRIBUTE['version'].sub(rf'\g<1> encoding="{encoding}"', declaration, count=1)
+    return declaration + xml_content[match.end():]
+
+def read_bill_source(content: bytes) -> tuple[bytes, dict[str, dict[str, str]]]:
+    """Исходный XML электронного счета для контейнера в кодировке BILL_ENCODING и его заголовок
+
+    Кодировка определяется один раз по BOM и прологу. Файл в windows-1251 попадает в
+    контейнер байт в байт, без декодирования, поэтому подписанные оригиналы остаются
+    действительными. Файлы в других кодировках перекодируются с заменой объявления
+    кодировки в прологе. Файл без BOM и объявления, который не является UTF-8, читается
+    как windows-1251.
+    """
+    declared = sniff_xml_encoding(content)
+    try:
+        encoding = codecs.lookup(declared or 'utf-8').name
+    except LookupError:
+        raise ConversionError(status_code=400, detail=f"Неизвестная кодировка файла: {declared}")
+    target = codecs.lookup(BILL_ENCODING).name
+
+    try:
+        xml_content = None
+        if declared is None:
+            try:
+                xml_content = content.decode('utf-8')
+            except UnicodeDecodeError:
+                encoding = target
+        logger.info(f"Detected {encoding} encoding" + ("" if declared else " (not declared)"))
+
+        if encoding == target:
+            # Без объявления парсер считает файл UTF-8, поэтому ему передается текст
+            header = extract_bill_header(content if declared else content.decode(encoding))
+            logger.info("Successfully parsed XML, keeping the original bytes")
+            return content, header
+
+        header = extract_bill_header(content)
+        logger.info("Successfully parsed XML")
+        if xml_content is None:
+            xml_content = content.decode(encoding)
+    except (UnicodeDecodeError, ET.ParseError) as e:
+        logger.error(f"Failed to read XML as {encoding}: {str(e)}")
+        raise ConversionError(
+            status_code=400,
+            detail="Не удалось определить кодировку файла или файл содержит некорректный XML"
         )
-    
-    except Exception as e:
-        logger.error(f"Error processing file: {str(e)}", exc_info=True)
-        # В случае ошибки очищаем все файлы
+
+    try:
+        return declare_encoding(xml_content, BILL_ENCODING).encode(BILL_ENCODING), header
+    except UnicodeEncodeError:
+        # Символы вне windows-1251: файл остается в своей кодировке, она указана в нем самом
+        logger.warning(f"XML contains characters outside {BILL_ENCODING}, keeping the original {encoding} bytes")
+        return content, header
+
+def build_bill_document(content: bytes, filename: str) -> tuple[tuple[str, str], list[tuple[str, bytes]]]:
+    """Подготовка документа контейнера Такском для электронного счета
+
+    Возвращает данные документа для meta.xml и пары (имя в папке документа, содержимое):
+    исходный файл и card.xml.
+    """
+    with stage('parse'):
+        source, header = read_bill_source(content)
+
+    with stage('build'):
+        # Создаем card.xml
+        logger.info("Creating card.xml")
+        card_xml = create_card_xml(header)
+        card_content = ('<?xml version="1.0" encoding="windows-1251"?>\n' +
+                      ET.tostring(card_xml, encoding='unicode'))
+
+        return meta_document(header), [
+            (filename, source),
+            # Символы вне windows-1251 (например, в названии организации) - ссылками на символы XML
+            ('card.xml', card_content.encode(BILL_ENCODING, errors='xmlcharrefreplace')),
+        ]
+
+def build_meta_content(documents: list[tuple[str, str]]) -> bytes:
+    """Содержимое meta.xml контейнера с документами documents"""
+    with stage('build'):
+        logger.info("Creating meta.xml")
+        meta_xml = create_meta_xml(documents)
+        meta_content = ('<?xml version="1.0" encoding="windows-1251"?>\n' +
+                      ET.tostring(meta_xml, encoding='unicode'))
+        return meta_content.encode(BILL_ENCODING, errors='xmlcharrefreplace')
+
+def build_bill_members(content: bytes, filename: str) -> list[tuple[str, bytes]]:
+    """Подготовка файлов контейнера Такском для электронного счета
+
+    Возвращает пары (путь в архиве, содержимое): meta.xml в корне, исходный файл и card.xml в папке 1.
+    """
+    document, files = build_bill_document(content, filename)
+    return [('meta.xml', build_meta_content([document])), *((f'1/{name}', data) for name, data in files)]
+
+def convert_bill(content: bytes, filename: str, timestamp: str, work_dir: Optional[str] = None) -> bytes:
+    """Упаковка электронного счета в контейнер Такском, возвращает содержимое архива
+
+    Без IN_MEMORY_PIPELINE файлы контейнера собираются в отдельном каталоге внутри
+    каталога запроса work_dir.
+    """
+    members = build_bill_members(content, filename)
+
+    if IN_MEMORY_PIPELINE:
+        logger.info("Creating ZIP archive in memory")
+        archive_data = build_zip(members)
+        logger.info(f"Archive size: {len(archive_data)} bytes")
+        return archive_data
+
+    # Создаем временную директорию для работы с файлами; она удаляется вместе с содержимым
+    with workspaces.open('bill', work_dir) as work_dir:
+        temp_dir = os.path.join(work_dir, "container")
+        logger.info(f"Created temp directory: {temp_dir}")
+
+        # Создаем структуру папок
+        bill_dir = os.path.join(temp_dir, "1")
+        os.makedirs(bill_dir)
+        logger.info(f"Created bill directory: {bill_dir}")
+
+        # Сохраняем meta.xml, исходный файл и card.xml
+        for arcname, data in members:
+            file_path = os.path.join(temp_dir, arcname)
+            with open(file_path, 'wb') as f:
+                f.write(data)
+            logger.info(f"Saved {arcname}: {file_path}")
+
+        # Создаем ZIP архив
+        logger.info("Creating ZIP archive")
+        archive_name = os.path.join(work_dir, f"bill_{timestamp}.zip")
+        with stage('zip'), zipfile.ZipFile(archive_name, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for arcname, _ in members:
+                zipf.write(os.path.join(temp_dir, arcname), arcname)
+        logger.info(f"Created ZIP archive: {archive_name}")
+
+        # Проверяем, что архив существует и имеет размер
+        if not os.path.exists(archive_name):
+            raise ConversionError(
+                status_code=500,
+                detail="Ошибка при создании архива: файл не найден"
+            )
+
+        archive_size = os.path.getsize(archive_name)
+        logger.info(f"Archive size: {archive_size} bytes")
+
+        if archive_size == 0:
+            raise ConversionError(
+                status_code=500,
+                detail="Ошибка при создании архива: файл пуст"
+            )
+
+        # Читаем архив в память перед отправкой
+        with open(archive_name, 'rb') as f:
+            return f.read()
+
+# Пакетная упаковка счетов: число счетов в одной задаче пула процессов
+BILL_BATCH_SIZE = 64
+
+def build_bill_batch(bills: list[tuple[bytes, str]], separate: bool) -> list[tuple]:
+    """Упаковка группы электронных счетов за один вызов в процессе-обработчике
+
+    Для каждого счета возвращает (None, результат) или ((код статуса, текст ошибки), None).
+    Результат - архив отдельного контейнера при separate, иначе данные документа и его
+    файлы для общего контейнера, как у build_bill_document.
+    """
+    results = []
+    for content, filename in bills:
+        try:
+            if separate:
+                result = build_zip(build_bill_members(content, filename))
+            else:
+                result = build_bill_document(content, filename)
+        except ConversionError as e:
+            results.append(((e.status_code, e.detail), None))
+            continue
+        except Exception as e:
+            logger.error(f"Failed to package bill {filename}: {str(e)}", exc_info=True)
+            results.append(((500, str(e)), None))
+            continue
+        results.append((None, result))
+    return results
+
+def read_bill_archive(content: bytes) -> list[tuple[str, bytes]]:
+    """XML файлы счетов из загруженного ZIP архива: пары (путь в архиве, содержимое)"""
+    with zipfile.ZipFile(io.BytesIO(content)) as archive:
+        return [
+            (info.filename, archive.read(info)) for info in archive.infolist()
+            if not info.is_dir() and info.filename.lower().endswith('.xml')
+            and not info.filename.startswith('__MACOSX/')
+        ]
+
+class ZipStreamBuffer(io.RawIOBase):
+    """Буфер без перемотки для потоковой записи ZIP архива
+
+    zipfile пишет в него записи с дескрипторами данных, а накопленные байты
+    забираются методом drain и сразу отправляются клиенту.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: list[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def _write_zip_member(zipf: zipfile.ZipFile, buffer: ZipStreamBuffer, arcname: str, data: bytes) -> bytes:
+    with stage('zip'):
+        zipf.writestr(arcname, data)
+    return buffer.drain()
+
+def _close_zip(zipf: zipfile.ZipFile, buffer: ZipStreamBuffer) -> bytes:
+    with stage('zip'):
+        zipf.close()
+    return buffer.drain()
+
+async def stream_zip(members) -> AsyncIterator[bytes]:
+    """Потоковая отдача ZIP архива: каждый файл уходит клиенту сразу после упаковки
+
+    members - асинхронный итератор пар (путь в архиве, содержимое).
+    """
+    buffer = ZipStreamBuffer()
+    zipf = zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED)
+    count = 0
+    async for arcname, data in members:
+        yield await run_in_threadpool(_write_zip_member, zipf, buffer, arcname, data)
+        count += 1
+    # Центральный каталог архива
+    yield await run_in_threadpool(_close_zip, zipf, buffer)
+    logger.info(f"Streamed ZIP archive: {count} files")
+
+class ResultCache:
+    """Кэш готовых архивов по хэшу загруженного файла
+
+    В памяти - LRU с ограничением суммарного размера и времени жизни записей.
+    Если задан каталог, архивы сохраняются еще и на диск (тоже LRU с ограничением
+    размера) и переживают перезапуск; запись с диска при попадании поднимается в память.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, directory: str = "", disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self._entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'memory_hits': 0, 'disk_hits': 0, 'stores': 0, 'evictions': 0}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 or bool(self.directory)
+
+    @property
+    def max_entry_bytes(self) -> int:
+        """Наибольший архив, который можно сохранить хотя бы в одном уровне"""
+        return max(self.max_bytes, self.disk_max_bytes if self.directory else 0)
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created, data = entry
+                if now - created <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    self.stats['memory_hits'] += 1
+                    return data
+                self._remove(key)
+
+        entry = self._disk_get(key, now)
+        with self._lock:
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            created, data = entry
+            self.stats['hits'] += 1
+            self.stats['disk_hits'] += 1
+            self._memory_put(key, created, data)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        now = time.time()
+        with self._lock:
+            self.stats['stores'] += 1
+            self._memory_put(key, now, data)
+        self._disk_put(key, data)
+
+    def info(self) -> dict:
+        with self._lock:
+            return {**self.stats, 'entries': len(self._entries), 'bytes': self._size}
+
+    def _remove(self, key: str) -> None:
+        _, data = self._entries.pop(key)
+        self._size -= len(data)
+
+    def _memory_put(self, key: str, created: float, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (created, data)
+        self._size += len(data)
+        # Вытесняем давно не использованные записи
+        while self._size > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.stats['evictions'] += 1
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.zip")
+
+    def _disk_get(self, key: str, now: float) -> Optional[tuple[float, bytes]]:
+        if not self.directory:
+            return None
+        path = self._disk_path(key)
         try:
-            if temp_path and os.path.exists(temp_path):
+            created = os.path.getmtime(path)
+            if now - created > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Время доступа - порядок вытеснения, время изменения - время создания записи
+            os.utime(path, (now, created))
+            return created, data
+        except OSError:
+            return None
+
+    def _disk_put(self, key: str, data: bytes) -> None:
+        if not self.directory or len(data) > self.disk_max_bytes:
+            return
+        path = self._disk_path(key)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            self._disk_evict()
+        except OSError as e:
+            logger.warning(f"Failed to store cached result on disk: {e}")
+            if os.path.exists(temp_path):
                 os.remove(temp_path)
-            for f in output_files:
-                if os.path.exists(f):
-                    os.remove(f)
-            if archive_name and os.path.exists(archive_name):
-                os.remove(archive_name)
-        except Exception as cleanup_error:
-            logger.error(f"Error cleaning up files: {str(cleanup_error)}")
-        
+
+    def _disk_evict(self) -> None:
+        now = time.time()
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.zip'):
+                    continue
+                stat = entry.stat()
+                if now - stat.st_mtime > self.ttl:
+                    os.remove(entry.path)
+                else:
+                    files.append((stat.st_atime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            with self._lock:
+                self.stats['evictions'] += 1
+
+result_cache = ResultCache(CACHE_MAX_BYTES, CACHE_TTL, CACHE_DIR, CACHE_DISK_MAX_BYTES)
+
+def file_digest(fileobj) -> str:
+    """SHA-256 содержимого файла; после чтения файл перематывается в начало"""
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(1024 * 1024), b''):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+def result_key(digest: str, *params: str) -> str:
+    """Ключ кэша: хэш содержимого загрузки и параметров, от которых зависит результат"""
+    return hashlib.sha256(':'.join([digest, *params]).encode('utf-8')).hexdigest()
+
+async def cache_stream(key: str, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Потоковая отдача архива с сохранением его в кэш после успешной отправки"""
+    parts = []
+    size = 0
+    async for chunk in chunks:
+        yield chunk
+        # Архив, который не поместится в кэш, не накапливаем
+        if parts is not None:
+            parts.append(chunk)
+            size += len(chunk)
+            if size > result_cache.max_entry_bytes:
+                parts = None
+    if parts is not None:
+        await run_in_threadpool(result_cache.put, key, b''.join(parts))
+
+async def apply_after_stream(update: tuple, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Потоковая отдача архива; строки загрузки учитываются в хранилище итогов после успешной отправки"""
+    async for chunk in chunks:
+        yield chunk
+    await run_in_threadpool(cast(DailyTotalsStore, totals_store).apply, update)
+
+class InflightResults:
+    """Результаты выполняющихся конвертаций: одновременные одинаковые запросы ждут одной из них
+
+    Результат - содержимое ответа, HTTPException с ошибкой в данных (4xx) или None,
+    если результатом поделиться нельзя (сбой, прерванная потоковая отдача, архив больше
+    COALESCE_MAX_BYTES, обработка порциями); тогда ждавшие запросы конвертируют файл сами.
+    """
+
+    def __init__(self):
+        self._pending: dict[str, asyncio.Future] = {}
+        self.stats = {'leaders': 0, 'coalesced': 0, 'shared': 0}
+
+    def lead(self, key: str) -> tuple[bool, asyncio.Future]:
+        """Выполняет ли запрос конвертацию сам и будущий результат этой конвертации"""
+        future = self._pending.get(key)
+        if future is not None:
+            self.stats['coalesced'] += 1
+            return False, future
+        future = self._pending[key] = asyncio.get_running_loop().create_future()
+        self.stats['leaders'] += 1
+        return True, future
+
+    def finish(self, key: str, future: asyncio.Future, result: Union[bytes, HTTPException, None]) -> None:
+        """Передача результата ждущим запросам; повторный вызов ничего не делает
+
+        Запись снимается, только если она еще принадлежит этой конвертации: после
+        таймаута ожидания ключ может занимать уже другой выполняющий запрос.
+        """
+        if self._pending.get(key) is future:
+            del self._pending[key]
+        if future.done():
+            return
+        if isinstance(result, HTTPException) and result.status_code >= 500:
+            result = None
+        future.set_result(result)
+
+    async def wait(self, key: str, future: asyncio.Future) -> Union[bytes, HTTPException, None]:
+        """Результат выполняющейся конвертации, но не дольше JOB_TIMEOUT
+
+        Если результата нет дольше JOB_TIMEOUT (например, выполнявший запрос завис),
+        его запись снимается, и следующий lead делает ждавший запрос выполняющим.
+        """
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), timeout=JOB_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Coalesced request timed out, converting the file again")
+            self.finish(key, future, None)
+            return None
+        if result is not None:
+            self.stats['shared'] += 1
+        return result
+
+inflight = InflightResults()
+
+class SharedStreamingResponse(StreamingResponse):
+    """Потоковая отдача архива, который после отправки получают запросы, ждущие того же результата
+
+    Результат передается при любом завершении ответа, в том числе когда отдача так и
+    не началась (клиент отключился до первой порции): тогда ждущие получают None и
+    конвертируют файл сами. Архив больше COALESCE_MAX_BYTES не передается.
+    """
+
+    def __init__(self, key: str, future: asyncio.Future, chunks: AsyncIterator[bytes], **kwargs):
+        self.shared_key = key
+        self.shared_future = future
+        self.shared_data: Optional[bytes] = None
+        super().__init__(self._collect(chunks), **kwargs)
+
+    async def _collect(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        parts = []
+        size = 0
+        async for chunk in chunks:
+            yield chunk
+            if parts is not None:
+                parts.append(chunk)
+                size += len(chunk)
+                if size > COALESCE_MAX_BYTES:
+                    parts = None
+        if parts is not None:
+            self.shared_data = b''.join(parts)
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            inflight.finish(self.shared_key, self.shared_future, self.shared_data)
+
+# Пул процессов для конвертации
+worker_pool: Optional[ProcessPoolExecutor] = None
+
+def _init_worker() -> None:
+    """Прогрев процесса-обработчика: тяжелые библиотеки импортируются один раз при старте"""
+    import pandas  # noqa: F401
+    import openpyxl  # noqa: F401
+    import openpyxl.styles  # noqa: F401
+
+def _worker_pid() -> int:
+    return os.getpid()
+
+async def start_worker_pool() -> None:
+    """Запуск и прогрев пула процессов-обработчиков"""
+    global worker_pool
+    if WORKER_COUNT <= 0:
+        logger.info("Worker pool disabled, conversions run in threads")
+        return
+
+    try:
+        worker_pool = ProcessPoolExecutor(max_workers=WORKER_COUNT, initializer=_init_worker)
+        loop = asyncio.get_running_loop()
+        pids = await asyncio.gather(*(
+            loop.run_in_executor(worker_pool, _worker_pid) for _ in range(WORKER_COUNT)
+        ))
+        logger.info(f"Worker pool started: {WORKER_COUNT} workers, pids {sorted(set(pids))}")
+    except (OSError, NotImplementedError, BrokenProcessPool) as e:
+        # Например, в serverless окружении без /dev/shm
+        logger.warning(f"Failed to start worker pool, conversions run in threads: {e}")
+        worker_pool = None
+
+def _measured_call(func, *args):
+    """Вызов в процессе-обработчике или потоке пула с возвратом замеров этапов"""
+    _worker_records.records = records = []
+    start_memory_tracking()
+    try:
+        return func(*args), records
+    finally:
+        finish_memory_tracking(records)
+        _worker_records.records = None
+
+async def run_conversion(func, *args):
+    """Выполнение CPU-емкой конвертации вне цикла событий с ограничением по времени
+
+    Замеры этапов из процесса-обработчика добавляются к замерам текущего запроса.
+    """
+    global worker_pool
+    loop = asyncio.get_running_loop()
+    pool = worker_pool
+    future = loop.run_in_executor(pool, _measured_call, func, *args)
+
+    try:
+        result, records = await asyncio.wait_for(future, timeout=JOB_TIMEOUT)
+        metrics = current_metrics.get()
+        if metrics is not None:
+            metrics.records.extend(records)
+        return result
+    except asyncio.TimeoutError:
+        # Задачу в процессе прервать нельзя, обработчик освободится после ее завершения
+        logger.error(f"Conversion {func.__name__} timed out after {JOB_TIMEOUT} s")
+        raise HTTPException(status_code=504, detail="Превышено время обработки файла")
+    except BrokenProcessPool:
+        # Процесс-обработчик аварийно завершился (например, нехватка памяти), пересоздаем пул
+        logger.error("Worker pool is broken, restarting", exc_info=True)
+        if worker_pool is pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+            await start_worker_pool()
+        raise HTTPException(status_code=500, detail="Процесс обработки аварийно завершился")
+    except ConversionError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+async def write_partitions(partitions: list, filename: str, timestamp: str,
+                           parallel: bool = True) -> AsyncIterator[tuple[str, bytes]]:
+    """Запись частей отчета в книги Excel, возвращает пары (путь в архиве, содержимое)
+
+    С пулом процессов книги пишутся параллельно, а результаты отдаются в исходном
+    порядке частей. Без пула или с parallel=False книги пишутся по одной, данные
+    части освобождаются сразу после записи.
+    """
+    if worker_pool is None or not PARALLEL_WRITES or not parallel:
+        while partitions:
+            file_suffix, sheet_name, df_filtered, add_totals, totals = partitions.pop(0)
+            data = await run_conversion(write_partition, df_filtered, sheet_name, add_totals, totals)
+            yield f"processed_{file_suffix}_{timestamp}_{filename}", data
+        return
+
+    # Данные частей передаются в процессы при постановке задач, здесь они больше не нужны
+    names = []
+    tasks = []
+    while partitions:
+        file_suffix, sheet_name, df_filtered, add_totals, totals = partitions.pop(0)
+        names.append(f"processed_{file_suffix}_{timestamp}_{filename}")
+        tasks.append(asyncio.ensure_future(
+            run_conversion(write_partition, df_filtered, sheet_name, add_totals, totals)
+        ))
+    logger.info(f"Writing {len(tasks)} workbooks in parallel")
+
+    try:
+        for name, task in zip(names, tasks):
+            yield name, await task
+    finally:
+        # При ошибке или отключении клиента снимаем задачи, которые еще не начались
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+# Оценка памяти конвертации по замерам сверх памяти процесса: около 70 байт на ячейку отчета
+# и 12-16 байт на байт загрузки, здесь с запасом
+MEMORY_PER_CELL = 96
+MEMORY_PER_UPLOAD_BYTE = 20
+
+def excel_dimensions(source) -> Optional[tuple[int, int]]:
+    """Число строк и колонок первого листа книги по тегу dimension, без чтения ячеек"""
+    try:
+        with zipfile.ZipFile(source) as archive:
+            # Первый лист книги - тот, что читает read_excel
+            workbook = ET.fromstring(archive.read('xl/workbook.xml'))
+            relations = ET.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+            sheet = next(element for element in workbook.iter() if element.tag.endswith('}sheet'))
+            relation_id = next(value for key, value in sheet.attrib.items() if key.endswith('}id'))
+            target = next(element.get('Target') for element in relations
+                          if element.get('Id') == relation_id)
+            path = target.lstrip('/') if target.startswith('/') else f'xl/{target}'
+            with archive.open(path) as worksheet:
+                for _, element in ET.iterparse(worksheet, events=('start',)):
+                    if element.tag.endswith('}dimension'):
+                        min_col, min_row, max_col, max_row = range_boundaries(element.get('ref'))
+                        return max_row - min_row + 1, max_col - min_col + 1
+                    if element.tag.endswith('}sheetData'):
+                        return None
+    except (zipfile.BadZipFile, KeyError, StopIteration, ET.ParseError, TypeError, ValueError):
+        return None
+    finally:
+        if hasattr(source, 'seek'):
+            source.seek(0)
+    return None
+
+def estimate_conversion_memory(upload_bytes: int, dimensions: Optional[tuple[int, int]]) -> int:
+    """Оценка памяти под данные конвертации Excel отчета сверх памяти процесса, байт
+
+    Берется большая из оценок по размеру листа и по размеру загрузки: в файле с
+    повторяющимися строками ячеек много при малом размере, а размер листа в файле
+    может быть не указан.
+    """
+    estimate = upload_bytes * MEMORY_PER_UPLOAD_BYTE
+    if dimensions is not None:
+        rows, columns = dimensions
+        estimate = max(estimate, rows * columns * MEMORY_PER_CELL)
+    return estimate
+
+def choose_excel_mode(source, upload_bytes: int, report_type: str) -> str:
+    """Выбор режима конвертации до ее начала: 'parallel', 'serial' или 'chunked'
+
+    Отчеты по чекам и Такском от CHUNKED_MIN_ROWS строк обрабатываются порциями.
+    При параллельной записи в процессах-обработчиках одновременно находятся копии
+    частей отчета, это еще половина оценки памяти. Если с ней MEMORY_BUDGET превышен,
+    книги пишутся по одной; если отчет не помещается и так, он обрабатывается
+    порциями, а отчет по номенклатуре отклоняется с кодом 413.
+    """
+    mode = 'parallel' if worker_pool is not None and PARALLEL_WRITES else 'serial'
+    chunkable = report_type in CHUNKED_REPORT_TYPES
+    dimensions = excel_dimensions(source)
+    rows, columns = dimensions or (0, len(REPORT_SCHEMAS.get(report_type, REPORT_SCHEMAS['taxcom'])['columns']))
+    if chunkable and CHUNKED_MIN_ROWS > 0 and rows >= CHUNKED_MIN_ROWS:
+        logger.info(f"Report has {rows} rows, processing in chunks")
+        return 'chunked'
+    if MEMORY_BUDGET <= 0:
+        return mode
+
+    data = estimate_conversion_memory(upload_bytes, dimensions)
+    serial_estimate = (current_rss() or 0) + data
+    parallel_estimate = serial_estimate + data // 2
+    logger.info(f"Estimated memory: {serial_estimate} bytes, parallel writes: {parallel_estimate} bytes, "
+                f"budget: {MEMORY_BUDGET} bytes")
+    if mode == 'parallel' and parallel_estimate <= MEMORY_BUDGET:
+        return mode
+    if serial_estimate <= MEMORY_BUDGET:
+        if mode == 'parallel':
+            logger.info("Parallel writes exceed the memory budget, writing workbooks one by one")
+            metrics_registry.inc('ofd_memory_budget_total', "Conversions checked against the memory budget",
+                                 decision='serial')
+        return 'serial'
+
+    # Порция, ее обработанная копия и пакеты слияния
+    chunked_estimate = ((current_rss() or 0)
+                        + (2 * CHUNK_ROWS + MERGE_FAN_IN * MERGE_BATCH_ROWS) * columns * MEMORY_PER_CELL)
+    if chunkable and chunked_estimate <= MEMORY_BUDGET:
+        logger.info("Report exceeds the memory budget, processing in chunks")
+        metrics_registry.inc('ofd_memory_budget_total', "Conversions checked against the memory budget",
+                             decision='chunked')
+        return 'chunked'
+
+    metrics_registry.inc('ofd_memory_budget_total', "Conversions checked against the memory budget",
+                         decision='rejected')
+    raise HTTPException(
+        status_code=413,
+        detail=(f"Файл слишком большой для обработки: требуется около {serial_estimate // (1024 * 1024)} МБ "
+                f"памяти, доступно {MEMORY_BUDGET // (1024 * 1024)} МБ")
+    )
+
+# Допуск запросов на конвертацию: ограничение одновременной обработки и размера загрузок
+ADMISSION_PATHS = ('/api/process_excel', '/api/process_bill', '/api/process_excel_batch', '/api/process_bill_batch')
+
+class AdmissionController:
+    """Ограничение числа одновременно обрабатываемых запросов с очередью ожидания
+
+    Сверх limit запросы ждут в очереди не больше timeout секунд; если очередь
+    заполнена или время ожидания истекло, запрос отклоняется с 429 и Retry-After.
+    """
+
+    def __init__(self, limit: int, queue_size: int, timeout: float):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        # Средняя длительность запроса, сек, для оценки Retry-After
+        self.average_duration = 1.0
+        self.stats = {'admitted': 0, 'rejected_queue': 0, 'rejected_timeout': 0, 'rejected_size': 0}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def start(self) -> None:
+        """Семафор создается в цикле событий сервера"""
+        self._semaphore = asyncio.Semaphore(self.limit) if self.limit > 0 else None
+
+    def retry_after(self) -> int:
+        """Оценка времени, через которое освободится место: очередь, деленная на число мест"""
+        return max(1, math.ceil(self.average_duration * (self.waiting + 1) / max(self.limit, 1)))
+
+    def _reject(self, reason: str, detail: str) -> HTTPException:
+        self.stats[f'rejected_{reason}'] += 1
+        logger.warning(f"Request rejected: {detail}, active: {self.active}, waiting: {self.waiting}")
+        return HTTPException(status_code=429, detail=detail, headers={'Retry-After': str(self.retry_after())})
+
+    async def acquire(self) -> None:
+        if self.limit <= 0:
+            self.active += 1
+            self.stats['admitted'] += 1
+            return
+        if self._semaphore is None:
+            self.start()
+        if self._semaphore.locked() and self.waiting >= self.queue_size:
+            raise self._reject('queue', "Сервер перегружен, повторите позже")
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise self._reject('timeout', "Сервер перегружен, повторите позже") from None
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        self.stats['admitted'] += 1
+
+    def release(self, duration: float) -> None:
+        self.active -= 1
+        self.average_duration = 0.8 * self.average_duration + 0.2 * duration
+        if self._semaphore is not None and self.limit > 0:
+            self._semaphore.release()
+
+admission = AdmissionController(ADMISSION_LIMIT, ADMISSION_QUEUE_SIZE, ADMISSION_TIMEOUT)
+
+def _upload_too_large() -> HTTPException:
+    admission.stats['rejected_size'] += 1
+    return HTTPException(status_code=413, detail=f"Размер запроса больше {MAX_UPLOAD_BYTES} байт")
+
+class AdmissionMiddleware:
+    """Допуск запросов к ADMISSION_PATHS и ограничение размера тела запроса MAX_UPLOAD_BYTES
+
+    Место занимается до приема загрузки и освобождается после отправки последнего
+    байта ответа, поэтому потоковые ответы тоже учитываются. Размер тела проверяется
+    по Content-Length и по мере приема, так что большая загрузка прерывается сразу.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        admitted = scope['method'] == 'POST' and scope['path'] in ADMISSION_PATHS
+        try:
+            content_length = dict(scope['headers']).get(b'content-length', b'')
+            if MAX_UPLOAD_BYTES and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES:
+                raise _upload_too_large()
+            if admitted:
+                with stage('queue'):
+                    await admission.acquire()
+        except HTTPException as e:
+            response = JSONResponse({'detail': e.detail}, status_code=e.status_code, headers=e.headers)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            # Исключение при разборе формы FastAPI превращает в ответ с его кодом
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request' and MAX_UPLOAD_BYTES:
+                received += len(message.get('body', b''))
+                if received > MAX_UPLOAD_BYTES:
+                    raise _upload_too_large()
+            return message
+
+        if not admitted:
+            await self.app(scope, limited_receive, send)
+            return
+        started = time.perf_counter()
+        try:
+            await self.app(scope, limited_receive, send)
+        finally:
+            admission.release(time.perf_counter() - started)
+
+# Слои добавляются изнутри наружу: допуск - самый внутренний, замер запросов учитывает
+# отклоненные запросы, а внешний CORS добавляет к ответам 429 и 413 заголовки,
+# без которых браузер не покажет их странице
+app.add_middleware(AdmissionMiddleware)
+
+@app.on_event("startup")
+async def start_admission():
+    admission.start()
+
+async def _measured_body(body: AsyncIterator[bytes], metrics: RequestMetrics, status: int) -> AsyncIterator[bytes]:
+    """Тело ответа с замером отправки; запрос учитывается в метриках после последнего байта"""
+    output_bytes = 0
+    start = time.perf_counter()
+    try:
+        async for chunk in body:
+            output_bytes += len(chunk)
+            yield chunk
+    finally:
+        metrics.records.append(('stage', 'response', time.perf_counter() - start))
+        metrics_registry.record_request(metrics, status, output_bytes)
+
+@app.middleware("http")
+async def measure_request(request, call_next):
+    """Замер этапов обработки запроса: заголовок Server-Timing и метрики /api/metrics"""
+    metrics = RequestMetrics(request.url.path)
+    token = current_metrics.set(metrics)
+    try:
+        response = await call_next(request)
+    except Exception:
+        metrics_registry.record_request(metrics, 500, 0)
+        raise
+    finally:
+        current_metrics.reset(token)
+
+    # Шаблон пути вместо самого пути, чтобы идентификаторы задач не плодили серии
+    route = request.scope.get('route')
+    metrics.endpoint = getattr(route, 'path', metrics.endpoint)
+    response.headers['Server-Timing'] = metrics.server_timing()
+    # Пики памяти задач, выполненных до начала ответа
+    for name, value in metrics.memory_peaks().items():
+        response.headers[MEMORY_HEADERS[name]] = str(value)
+    response.body_iterator = _measured_body(response.body_iterator, metrics, response.status_code)
+    return response
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=origins,
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=["*"]
+)
+
+@app.get("/api/metrics")
+async def prometheus_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    cache_stats = result_cache.info()
+    cache_counters = {
+        f'ofd_cache_{name}_total': (f"Result cache {name.replace('_', ' ')}", {(): cache_stats[name]})
+        for name in ('hits', 'misses', 'memory_hits', 'disk_hits', 'stores', 'evictions')
+    }
+    workspace_stats = await run_in_threadpool(workspaces.info)
+    workspace_counters = {
+        'ofd_workspaces_created_total': ("Request workspaces created", {(): workspace_stats['created']}),
+        'ofd_workspaces_removed_total': ("Workspaces removed by the cleanup", {
+            (('reason', reason),): workspace_stats[f'removed_{reason}'] for reason in ('orphan', 'age', 'size')
+        }),
+    }
+    admission_counters = {
+        'ofd_admission_admitted_total': ("Conversion requests admitted", {(): admission.stats['admitted']}),
+        'ofd_admission_rejected_total': ("Requests rejected by admission control", {
+            (('reason', reason),): admission.stats[f'rejected_{reason}'] for reason in ('queue', 'timeout', 'size')
+        }),
+    }
+    coalesce_counters = {
+        'ofd_coalesce_leaders_total': ("Conversions that concurrent identical requests could wait for",
+                                       {(): inflight.stats['leaders']}),
+        'ofd_coalesced_requests_total': ("Requests that waited for a concurrent identical conversion",
+                                         {(): inflight.stats['coalesced']}),
+        'ofd_coalesce_shared_total': ("Requests answered with the result of a concurrent identical conversion",
+                                      {(): inflight.stats['shared']}),
+    }
+    admission_gauges = {
+        'ofd_admission_active': ("Conversion requests in progress", {(): admission.active}),
+        'ofd_admission_waiting': ("Conversion requests waiting in the admission queue", {(): admission.waiting}),
+    }
+    workspace_gauges = {
+        'ofd_workspaces': ("Request workspaces on disk", {(): workspace_stats['workspaces']}),
+        'ofd_workspaces_active': ("Workspaces in use by this process", {(): workspace_stats['active']}),
+        'ofd_workspace_bytes': ("Disk space used by request workspaces", {(): workspace_stats['bytes']}),
+    }
+    return Response(
+        content=metrics_registry.render({**cache_counters, **workspace_counters, **admission_counters,
+                                         **coalesce_counters},
+                                        {**workspace_gauges, **admission_gauges}),
+        media_type='text/plain; version=0.0.4; charset=utf-8'
+    )
+
+@app.on_event("startup")
+async def startup_worker_pool():
+    await start_worker_pool()
+
+# Форматы ответа /api/process_excel: архив с книгами или только итоги в JSON
+EXCEL_OUTPUTS = ('zip', 'json')
+
+def excel_response(content: bytes, output: str, headers: dict) -> Response:
+    """Готовый результат /api/process_excel из кэша или от одновременного запроса"""
+    if output == 'json':
+        return Response(content=content, media_type='application/json')
+    return Response(content=content, media_type='application/zip', headers=headers)
+
+@app.post("/api/process_excel")
+async def process_excel(file: UploadFile = File(...), report_type: str = 'checks', output: str = 'zip',
+                        register: Optional[str] = None):
+    work_dir = None
+    # Ключ, по которому запрос передает результат одновременным одинаковым запросам
+    shared_key = None
+    shared_future = None
+    # Загрузка принимается и разбирается до вызова обработчика
+    record_elapsed('upload')
+
+    try:
+        logger.info(f"Получен файл: {file.filename}, тип отчета: {report_type}")
+
+        # Проверка наличия файла и его имени
+        if not file or not file.filename:
+            raise HTTPException(status_code=400, detail="No file provided")
+
+        # Проверка расширения файла
+        if not str(file.filename).endswith('.xlsx'):
+            raise HTTPException(status_code=400, detail="Only .xlsx files are allowed")
+
+        if output not in EXCEL_OUTPUTS:
+            raise HTTPException(status_code=400, detail=f"output must be one of: {', '.join(EXCEL_OUTPUTS)}")
+
+        if register is not None and totals_store is None:
+            raise HTTPException(status_code=400, detail="Daily totals store is not configured (OFD_TOTALS_DB)")
+
+        # Генерируем уникальные имена файлов
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+        headers = {
+            'Content-Disposition': f'attachment; filename="results_{timestamp}.zip"',
+            'Content-Type': 'application/zip'
+        }
+
+        record_count('input_bytes', file.size or 0)
+
+        # Повторная загрузка того же файла отдается из кэша без обработки
+        request_key = None
+        cache_key = None
+        if result_cache.enabled or COALESCE_MAX_BYTES:
+            with stage('cache'):
+                digest = await run_in_threadpool(file_digest, file.file)
+                params = ['excel', report_type, file.filename]
+                if output == 'json':
+                    params.append(output)
+                if register is not None:
+                    params += ['register', register]
+                request_key = result_key(digest, *params)
+                # Итоги кассы зависят от прошлых загрузок, поэтому в кэш не попадают
+                if result_cache.enabled and register is None:
+                    cache_key = request_key
+                    cached = await run_in_threadpool(result_cache.get, cache_key)
+                    if cached is not None:
+                        logger.info("Returning cached result")
+                        return excel_response(cached, output, headers)
+
+        # Тот же файл уже конвертируется другим запросом: ждем его результата
+        while request_key and COALESCE_MAX_BYTES:
+            leader, pending = inflight.lead(request_key)
+            if leader:
+                shared_key, shared_future = request_key, pending
+                break
+            with stage('coalesce'):
+                shared = await inflight.wait(request_key, pending)
+            if isinstance(shared, HTTPException):
+                raise HTTPException(status_code=shared.status_code, detail=shared.detail)
+            if shared is not None:
+                logger.info("Returning result of a concurrent identical request")
+                return excel_response(shared, output, headers)
+
+        # Режим обработки выбирается до ее начала по размеру листа и бюджету памяти
+        mode = await run_in_threadpool(choose_excel_mode, file.file, file.size or 0, report_type)
+        parallel = mode == 'parallel'
+        if mode == 'chunked' and register is not None and output != 'json':
+            # Архив порциями пишется из всех строк файла, хранилище итогов в нем не участвует
+            raise HTTPException(status_code=413,
+                                detail="Report is too large for register processing, split the upload by period")
+        if mode == 'chunked' and shared_key:
+            # Архив большого отчета отдается с диска, ждущие запросы обрабатывают его сами
+            inflight.finish(shared_key, shared_future, None)
+            shared_key = None
+
+        with stage('receive'):
+            if IN_MEMORY_PIPELINE and mode != 'chunked':
+                # Читаем файл прямо из буфера загрузки; в процесс-обработчик передаем содержимое
+                source = await file.read() if worker_pool is not None else file.file
+            else:
+                # Сохраняем входной файл в каталог запроса
+                work_dir = workspaces.create('excel')
+                source = os.path.join(work_dir, 'source.xlsx')
+                with open(source, "wb") as buffer:
+                    await run_in_threadpool(shutil.copyfileobj, file.file, buffer)
+                logger.info("File saved successfully")
+
+        if output == 'json':
+            # Только итоги: книги и архив не создаются
+            totals = await run_conversion(excel_totals, source, report_type, mode == 'chunked', register)
+            content = json.dumps(totals, ensure_ascii=False).encode('utf-8')
+            if cache_key:
+                await run_in_threadpool(result_cache.put, cache_key, content)
+            if shared_key:
+                inflight.finish(shared_key, shared_future, content)
+            logger.info(f"Returning totals of {len(totals['partitions'])} partitions")
+            return Response(content=content, media_type='application/json')
+
+        if mode == 'chunked':
+            # Архив большого отчета пишется в каталог запроса и отдается с диска;
+            # каталог удаляется после отправки ответа
+            archive_path = os.path.join(work_dir, 'results.zip')
+            await run_conversion(convert_excel_chunked, source, file.filename, report_type,
+                                 timestamp, archive_path, work_dir)
+            response = FileResponse(archive_path, media_type='application/zip', headers=headers,
+                                    background=BackgroundTask(workspaces.release, work_dir))
+            work_dir = None
+            return response
+
+        # Обновление хранилища итогов кассы: вносится только после отдачи архива,
+        # чтобы прерванная загрузка или повтор запроса не теряли строки
+        update = None
+        if STREAM_RESPONSES:
+            # Ошибки чтения и обработки должны вернуться до начала ответа
+            if register is not None:
+                detected_type, partitions, update = await run_conversion(prepare_register_excel, source,
+                                                                         report_type, register)
+            else:
+                detected_type, partitions = await run_conversion(prepare_excel, source, report_type)
+            if not partitions:
+                raise Exception("Не удалось создать выходные файлы")
+
+            logger.info(f"Streaming {len(partitions)} files for report type: {detected_type}")
+            chunks = stream_zip(write_partitions(partitions, file.filename, timestamp, parallel))
+            if update is not None:
+                chunks = apply_after_stream(update, chunks)
+            if cache_key:
+                chunks = cache_stream(cache_key, chunks)
+            if shared_key:
+                # Результат передается ждущим запросам после отправки архива
+                response = SharedStreamingResponse(shared_key, shared_future, chunks,
+                                                   media_type='application/zip', headers=headers)
+                shared_key = None
+                return response
+            return StreamingResponse(chunks, media_type='application/zip', headers=headers)
+
+        if register is not None or (IN_MEMORY_PIPELINE and parallel):
+            # Книги частей пишутся в пуле процессов (в режиме parallel - параллельно), архив собирается здесь
+            if register is not None:
+                detected_type, partitions, update = await run_conversion(prepare_register_excel, source,
+                                                                         report_type, register)
+            else:
+                detected_type, partitions = await run_conversion(prepare_excel, source, report_type)
+            if not partitions:
+                raise Exception("Не удалось создать выходные файлы")
+            members = [member async for member in write_partitions(partitions, file.filename, timestamp, parallel)]
+            file_data = await run_in_threadpool(build_zip, members)
+        else:
+            file_data = await run_conversion(convert_excel, source, file.filename, report_type, timestamp,
+                                             work_dir)
+
+        if cache_key:
+            await run_in_threadpool(result_cache.put, cache_key, file_data)
+        if shared_key:
+            inflight.finish(shared_key, shared_future, file_data if len(file_data) <= COALESCE_MAX_BYTES else None)
+
+        logger.info("Processing completed successfully")
+
+        # Возвращаем архив с правильными заголовками
+        return Response(content=file_data, media_type='application/zip', headers=headers,
+                        background=BackgroundTask(totals_store.apply, update) if update is not None else None)
+
+    except HTTPException as e:
+        if shared_key:
+            inflight.finish(shared_key, shared_future, e)
+        raise
+    except Exception as e:
+        logger.error(f"Error processing file: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+    finally:
+        # Ждущие запросы не остаются без ответа, если результат не был передан
+        if shared_key:
+            inflight.finish(shared_key, shared_future, None)
+        # Удаляем временные файлы
+        if work_dir:
+            workspaces.release(work_dir)
+
+# Пакетная обработка: манифест с результатом по каждому файлу пакета в корне архива
+BATCH_MANIFEST_NAME = 'manifest.json'
+
+def batch_folder_names(filenames: list[str]) -> list[str]:
+    """Папки файлов пакета в архиве: имя файла без расширения, повторы нумеруются как листы"""
+    folders = []
+    used = set()
+    for filename in filenames:
+        base = Path(filename.replace('\\', '/')).stem.strip() or 'file'
+        folder = base
+        number = 2
+        while folder in used:
+            folder = f"{base} ({number})"
+            number += 1
+        used.add(folder)
+        folders.append(folder)
+    return folders
+
+async def receive_batch_file(file: UploadFile, report_type: str, work_dir: str) -> tuple:
+    """Прием файла пакета до начала ответа, возвращает источник для конвертации и признак обработки порциями
+
+    Загрузки закрываются при выходе из обработчика запроса, поэтому содержимое
+    читается в память, а большие отчеты и файлы без IN_MEMORY_PIPELINE сохраняются в каталог запроса.
+    """
+    if not file.filename:
+        raise HTTPException(status_code=400, detail="No file provided")
+    if not str(file.filename).endswith('.xlsx'):
+        raise HTTPException(status_code=400, detail="Only .xlsx files are allowed")
+
+    mode = await run_in_threadpool(choose_excel_mode, file.file, file.size or 0, report_type)
+    if IN_MEMORY_PIPELINE and mode != 'chunked':
+        return await file.read(), False
+    temp_path = os.path.join(work_dir, f"source_{uuid.uuid4().hex}.xlsx")
+    with open(temp_path, "wb") as buffer:
+        await run_in_threadpool(shutil.copyfileobj, file.file, buffer)
+    return temp_path, mode == 'chunked'
+
+async def convert_batch_file(entry: dict, source, chunked: bool, report_type: str, timestamp: str,
+                             work_dir: str, slots: asyncio.Semaphore) -> tuple[dict, list[tuple[str, bytes]]]:
+    """Конвертация одного файла пакета, возвращает запись манифеста и файлы результата в его папке
+
+    Ошибка файла записывается в манифест и не прерывает обработку остальных файлов.
+    """
+    if entry.get('status') == 'error':
+        return entry, []
+    try:
+        # Одновременно обрабатывается не больше файлов, чем процессов-обработчиков,
+        # чтобы ожидание в очереди пула не входило в JOB_TIMEOUT
+        async with slots:
+            # Файлы результата лежат в папке файла, поэтому путь из имени загрузки отбрасывается
+            filename = os.path.basename(entry['file'].replace('\\', '/'))
+            detected_type, members = await run_conversion(convert_excel_members, source, filename,
+                                                          report_type, timestamp, chunked, work_dir)
+    except HTTPException as e:
+        logger.warning(f"Batch file {entry['file']} failed: {e.detail}")
+        entry.update(status='error', status_code=e.status_code, error=e.detail)
+        return entry, []
+    except Exception as e:
+        logger.error(f"Batch file {entry['file']} failed: {str(e)}", exc_info=True)
+        entry.update(status='error', status_code=500, error=str(e))
+        return entry, []
+    finally:
+        if isinstance(source, str) and os.path.exists(source):
+            os.remove(source)
+
+    members = [(f"{entry['folder']}/{name}", data) for name, data in members]
+    entry.update(status='ok', report_type=detected_type, files=[name for name, _ in members])
+    return entry, members
+
+@app.post("/api/process_excel_batch")
+async def process_excel_batch(files: list[UploadFile] = File(...), report_type: str = 'checks'):
+    """Пакетная обработка Excel отчетов: папка с результатами на каждый файл и манифест
+
+    Тип отчета определяется по колонкам каждого файла отдельно, report_type - тип по
+    умолчанию. Файлы конвертируются параллельно; ошибка файла попадает в манифест.
+    """
+    record_elapsed('upload')
+    if not files:
+        raise HTTPException(status_code=400, detail="No file provided")
+
+    logger.info(f"Получен пакет файлов: {len(files)}, тип отчета: {report_type}")
+    record_count('input_bytes', sum(file.size or 0 for file in files))
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    headers = {
+        'Content-Disposition': f'attachment; filename="batch_results_{timestamp}.zip"',
+        'Content-Type': 'application/zip'
+    }
+
+    # Все файлы принимаются до начала ответа, конвертация идет во время отправки архива
+    work_dir = workspaces.create('batch')
+    received = []
+    for file, folder in zip(files, batch_folder_names([file.filename or '' for file in files])):
+        entry = {'file': file.filename, 'folder': folder}
+        source, chunked = None, False
+        try:
+            with stage('receive'):
+                source, chunked = await receive_batch_file(file, report_type, work_dir)
+        except HTTPException as e:
+            entry.update(status='error', status_code=e.status_code, error=e.detail)
+        except Exception as e:
+            logger.error(f"Error receiving batch file {file.filename}: {str(e)}", exc_info=True)
+            entry.update(status='error', status_code=500, error=str(e))
+        received.append((entry, source, chunked))
+
+    slots = asyncio.Semaphore(max(WORKER_COUNT, 1))
+    tasks = [
+        asyncio.ensure_future(convert_batch_file(entry, source, chunked, report_type, timestamp, work_dir, slots))
+        for entry, source, chunked in received
+    ]
+    metrics = current_metrics.get()
+
+    async def batch_members():
+        # Файлы уходят в архив в порядке загрузки, пока остальные еще конвертируются
+        manifest = []
+        try:
+            while tasks:
+                entry, members = await tasks.pop(0)
+                manifest.append(entry)
+                while members:
+                    yield members.pop(0)
+        finally:
+            # При отключении клиента снимаем файлы, которые еще не начали обрабатываться
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            workspaces.release(work_dir)
+
+        failed = sum(1 for entry in manifest if entry['status'] != 'ok')
+        logger.info(f"Batch completed: {len(manifest) - failed} files converted, {failed} failed")
+        # Этапы пакета суммируются по всем файлам, поэтому у запроса своя метка
+        if metrics is not None:
+            metrics.records.append(('label', 'report_type', 'batch'))
+        yield BATCH_MANIFEST_NAME, json.dumps(
+            {'timestamp': timestamp, 'failed': failed, 'files': manifest}, ensure_ascii=False, indent=2
+        ).encode('utf-8')
+
+    if STREAM_RESPONSES:
+        return StreamingResponse(stream_zip(batch_members()), media_type='application/zip', headers=headers)
+
+    members = [member async for member in batch_members()]
+    file_data = await run_in_threadpool(build_zip, members)
+    return Response(content=file_data, media_type='application/zip', headers=headers)
+
 @app.post("/api/process_bill")
 async def process_bill(file: UploadFile = File(...)):
     """Обработка электронного счета"""
-    temp_dir = None
-    archive_name = None
-    response = None
-    
+    record_elapsed('upload')
+    record_report_type('bill')
+
     try:
         logger.info(f"Processing electronic bill: {file.filename}")
-        
+
         # Проверка расширения файла
         if not file.filename.lower().endswith('.xml'):
             raise HTTPException(status_code=400, detail="Only XML files are allowed")
-        
-        # Создаем временную директорию для работы с файлами
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        temp_dir = os.path.join(TEMP_DIR, f"bill_processing_{timestamp}")
-        os.makedirs(temp_dir)
-        logger.info(f"Created temp directory: {temp_dir}")
-        
-        # Создаем структуру папок
-        bill_dir = os.path.join(temp_dir, "1")
-        os.makedirs(bill_dir)
-        logger.info(f"Created bill directory: {bill_dir}")
-        
+
         # Читаем входной XML файл
         content = await file.read()
         logger.info(f"Read file content, size: {len(content)} bytes")
-        
-        # Определяем кодировку файла
-        encoding = 'utf-8'
-        if content.startswith(b'\xef\xbb\xbf'):  # UTF-8 с BOM
-            content = content[3:]
-            logger.info("Detected UTF-8 with BOM")
-        elif b'windows-1251' in content.lower() or b'cp1251' in content.lower():
-            encoding = 'windows-1251'
-            logger.info("Detected windows-1251 encoding")
-        
-        try:
-            # Пробуем декодировать XML с определенной кодировкой
-            xml_content = content.decode(encoding)
-            logger.info(f"Successfully decoded content with {encoding}")
-            
-            # Логируем первые 200 символов содержимого для отладки
-            logger.info(f"Content preview: {xml_content[:200]}")
-            
-            source_xml = ET.fromstring(xml_content)
-            logger.info("Successfully parsed XML")
-            
-        except (UnicodeDecodeError, ET.ParseError) as e:
-            logger.warning(f"Failed to decode with {encoding}: {str(e)}")
-            # Если не удалось, пробуем другие кодировки
-            encodings = ['windows-1251', 'utf-8', 'utf-16', 'cp866']
-            for enc in encodings:
-                if enc != encoding:
-                    try:
-                        xml_content = content.decode(enc)
-                        source_xml = ET.fromstring(xml_content)
-                        encoding = enc
-                        logger.info(f"Successfully decoded with alternative encoding: {enc}")
-                        break
-                    except (UnicodeDecodeError, ET.ParseError) as e:
-                        logger.warning(f"Failed to decode with {enc}: {str(e)}")
-                        continue
-            else:
-                logger.error("Failed to decode with any encoding")
-                raise HTTPException(
-                    status_code=400,
-                    detail="Не удалось определить кодировку файла или файл содержит некорректный XML"
-                )
-        
-        try:
-            # Сохраняем исходный файл
-            source_path = os.path.join(bill_dir, file.filename)
-            with open(source_path, 'w', encoding='windows-1251') as f:
-                f.write(xml_content)
-            logger.info(f"Saved source file: {source_path}")
-            
-            # Создаем card.xml
-            logger.info("Creating card.xml")
-            card_xml = create_card_xml(source_xml)
-            card_content = ('<?xml version="1.0" encoding="windows-1251"?>\n' + 
-                          ET.tostring(card_xml, encoding='unicode'))
-            card_path = os.path.join(bill_dir, 'card.xml')
-            with open(card_path, 'w', encoding='windows-1251') as f:
-                f.write(card_content)
-            logger.info(f"Saved card.xml: {card_path}")
-            
-            # Создаем meta.xml
-            logger.info("Creating meta.xml")
-            meta_xml = create_meta_xml(source_xml)
-            meta_content = ('<?xml version="1.0" encoding="windows-1251"?>\n' + 
-                          ET.tostring(meta_xml, encoding='unicode'))
-            meta_path = os.path.join(temp_dir, 'meta.xml')
-            with open(meta_path, 'w', encoding='windows-1251') as f:
-                f.write(meta_content)
-            logger.info(f"Saved meta.xml: {meta_path}")
-            
-            # Создаем ZIP архив
-            logger.info("Creating ZIP archive")
-            archive_name = os.path.join(TEMP_DIR, f"bill_{timestamp}.zip")
-            with zipfile.ZipFile(archive_name, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                # Добавляем meta.xml в корень архива
-                zipf.write(meta_path, 'meta.xml')
-                # Добавляем файлы из папки 1
-                for root, _, files in os.walk(bill_dir):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        arcname = os.path.join('1', file)
-                        zipf.write(file_path, arcname)
-            logger.info(f"Created ZIP archive: {archive_name}")
-            
-            # Проверяем, что архив существует и имеет размер
-            if not os.path.exists(archive_name):
-                raise HTTPException(
-                    status_code=500,
-                    detail="Ошибка при создании архива: файл не найден"
-                )
-                
-            archive_size = os.path.getsize(archive_name)
-            logger.info(f"Archive size: {archive_size} bytes")
-            
-            if archive_size == 0:
-                raise HTTPException(
-                    status_code=500,
-                    detail="Ошибка при создании архива: файл пуст"
+        record_count('input_bytes', len(content))
+
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+        # Повторная загрузка того же файла отдается из кэша без обработки
+        cache_key = None
+        if result_cache.enabled:
+            with stage('cache'):
+                cache_key = result_key(hashlib.sha256(content).hexdigest(), 'bill', file.filename)
+                cached = await run_in_threadpool(result_cache.get, cache_key)
+            if cached is not None:
+                logger.info("Returning cached bill archive")
+                return Response(
+                    content=cached,
+                    media_type='application/zip',
+                    headers={
+                        'Content-Disposition': f'attachment; filename="bill_{timestamp}.zip"',
+                        'Content-Length': str(len(cached))
+                    }
                 )
-            
-            # Читаем архив в память перед отправкой
-            with open(archive_name, 'rb') as f:
-                archive_data = f.read()
-                
-            # Создаем Response
-            response = Response(
-                content=archive_data,
+
+        if STREAM_RESPONSES:
+            members = await run_conversion(build_bill_members, content, file.filename)
+
+            async def bill_members():
+                for member in members:
+                    yield member
+
+            chunks = stream_zip(bill_members())
+            if cache_key:
+                chunks = cache_stream(cache_key, chunks)
+            return StreamingResponse(
+                chunks,
                 media_type='application/zip',
-                headers={
-                    'Content-Disposition': f'attachment; filename="bill_{timestamp}.zip"',
-                    'Content-Length': str(len(archive_data))
-                }
+                headers={'Content-Disposition': f'attachment; filename="bill_{timestamp}.zip"'}
             )
-            
-            # Очищаем временные файлы
-            if temp_dir and os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir)
-                logger.info(f"Cleaned up temp directory: {temp_dir}")
-            
-            return response
-            
-        except HTTPException:
-            raise
-        except Exception as e:
-            logger.error(f"Unhandled error: {str(e)}", exc_info=True)
-            raise
-        
+
+        archive_data = await run_conversion(convert_bill, content, file.filename, timestamp)
+        if cache_key:
+            await run_in_threadpool(result_cache.put, cache_key, archive_data)
+
+        # Создаем Response
+        return Response(
+            content=archive_data,
+            media_type='application/zip',
+            headers={
+                'Content-Disposition': f'attachment; filename="bill_{timestamp}.zip"',
+                'Content-Length': str(len(archive_data))
+            }
+        )
+
     except HTTPException:
         raise
     except Exception as e:
@@ -818,25 +3532,498 @@ async def process_bill(file: UploadFile = File(...)):
             status_code=500,
             detail=f"Ошибка при обработке файла: {str(e)}"
         )
-        
+
+# Контейнеры пакета счетов: отдельный контейнер на каждый счет или один контейнер со всеми
+BILL_CONTAINER_MODES = ('separate', 'combined')
+
+@app.post("/api/process_bill_batch")
+async def process_bill_batch(files: list[UploadFile] = File(...), container: str = 'separate'):
+    """Пакетная упаковка электронных счетов: XML файлы и ZIP архивы с ними
+
+    При container=separate каждый счет упаковывается в свой контейнер Такском, ошибки
+    счетов записываются в манифест. При container=combined все счета попадают в один
+    контейнер с документами в папках 1, 2, ... - тогда ошибка любого счета отклоняет пакет.
+    Счета упаковываются параллельно группами по BILL_BATCH_SIZE.
+    """
+    record_elapsed('upload')
+    record_report_type('bill_batch')
+
+    if container not in BILL_CONTAINER_MODES:
+        raise HTTPException(status_code=400, detail=f"container must be one of: {', '.join(BILL_CONTAINER_MODES)}")
+    if not files:
+        raise HTTPException(status_code=400, detail="No file provided")
+    separate = container == 'separate'
+    logger.info(f"Получен пакет счетов: {len(files)} файлов, контейнер: {container}")
+
+    # Счета из загрузок и архивов в порядке загрузки; записи манифеста с ошибками приема
+    entries = []
+    bills = []
+    with stage('receive'):
+        for file in files:
+            name = file.filename or ''
+            content = await file.read()
+            record_count('input_bytes', len(content))
+            if name.lower().endswith('.zip'):
+                try:
+                    archive_bills = await run_in_threadpool(read_bill_archive, content)
+                except zipfile.BadZipFile:
+                    entries.append({'file': name, 'status': 'error', 'status_code': 400,
+                                    'error': "Некорректный ZIP архив"})
+                    continue
+                for member_name, member_content in archive_bills:
+                    entry = {'file': f"{name}/{member_name}"}
+                    entries.append(entry)
+                    bills.append((entry, member_content, os.path.basename(member_name)))
+            elif name.lower().endswith('.xml'):
+                entry = {'file': name}
+                entries.append(entry)
+                bills.append((entry, content, os.path.basename(name.replace('\\', '/'))))
+            else:
+                entries.append({'file': name, 'status': 'error', 'status_code': 400,
+                                'error': "Only XML and ZIP files are allowed"})
+    logger.info(f"Received {len(bills)} bills")
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    if separate:
+        names = batch_folder_names([filename for _, _, filename in bills])
+        for (entry, _, _), name in zip(bills, names):
+            entry['container'] = f"{name}.zip"
+
+    # Группы счетов обрабатываются в пуле, не больше одной группы на процесс-обработчик
+    slots = asyncio.Semaphore(max(WORKER_COUNT, 1))
+
+    async def package(group: list) -> list:
+        async with slots:
+            return await run_conversion(build_bill_batch, [(content, filename) for _, content, filename in group],
+                                        separate)
+
+    groups = [bills[i:i + BILL_BATCH_SIZE] for i in range(0, len(bills), BILL_BATCH_SIZE)]
+    tasks = [asyncio.ensure_future(package(group)) for group in groups]
+
+    async def packaged():
+        # Результаты групп в порядке загрузки, пока следующие группы еще упаковываются
+        try:
+            while tasks:
+                group = groups.pop(0)
+                try:
+                    results = await tasks.pop(0)
+                except HTTPException as e:
+                    results = [((e.status_code, e.detail), None)] * len(group)
+                for (entry, _, _), (error, result) in zip(group, results):
+                    if error is not None:
+                        entry.update(status='error', status_code=error[0], error=error[1])
+                    else:
+                        entry['status'] = 'ok'
+                    yield entry, result
+        finally:
+            # При отключении клиента снимаем группы, которые еще не начали обрабатываться
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    if separate:
+        async def containers():
+            async for entry, archive_data in packaged():
+                if archive_data is not None:
+                    yield entry['container'], archive_data
+            failed = sum(1 for entry in entries if entry['status'] != 'ok')
+            logger.info(f"Bill batch completed: {len(entries) - failed} bills packaged, {failed} failed")
+            yield BATCH_MANIFEST_NAME, json.dumps(
+                {'timestamp': timestamp, 'failed': failed, 'files': entries}, ensure_ascii=False, indent=2
+            ).encode('utf-8')
+
+        members = containers()
+        filename = f"bills_{timestamp}.zip"
+    else:
+        # Общий контейнер собирается только из корректных счетов, поэтому ошибки возвращаются до ответа
+        documents = []
+        members = []
+        async for entry, result in packaged():
+            if result is not None:
+                document, document_files = result
+                documents.append(document)
+                members.extend((f"{len(documents)}/{name}", data) for name, data in document_files)
+        errors = [entry for entry in entries if entry['status'] != 'ok']
+        if errors:
+            raise HTTPException(status_code=400, detail="; ".join(f"{entry['file']}: {entry['error']}"
+                                                                  for entry in errors))
+        if not documents:
+            raise HTTPException(status_code=400, detail="No bills provided")
+        members.insert(0, ('meta.xml', await run_in_threadpool(build_meta_content, documents)))
+        logger.info(f"Packaging {len(documents)} bills into one container")
+
+        async def container_members(members):
+            for member in members:
+                yield member
+
+        members = container_members(members)
+        filename = f"bill_{timestamp}.zip"
+
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
+    if STREAM_RESPONSES:
+        return StreamingResponse(stream_zip(members), media_type='application/zip', headers=headers)
+
+    archive_data = await run_in_threadpool(build_zip, [member async for member in members])
+    return Response(content=archive_data, media_type='application/zip',
+                    headers={**headers, 'Content-Length': str(len(archive_data))})
+
+# Асинхронные задачи конвертации для больших файлов
+JOB_STAGES = ['read', 'process', 'write', 'zip']
+# Файл хода выполнения задачи в ее рабочем каталоге и период его чтения, сек
+JOB_PROGRESS_NAME = 'progress.json'
+JOB_PROGRESS_INTERVAL = 0.5
+
+def write_job_progress(path: str, stage: str, files_total: int = 0, files_written: int = 0) -> None:
+    """Запись хода выполнения задачи; файл заменяется целиком, поэтому читается всегда полным"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump({'stage': stage, 'files_total': files_total, 'files_written': files_written}, f)
+    os.replace(temp_path, path)
+
+def convert_job(source: str, filename: str, report_type: str, timestamp: str, result_path: str,
+                work_dir: str, chunked: bool = False) -> int:
+    """Конвертация задачи одним вызовом в процессе-обработчике, возвращает число выходных файлов
+
+    Данные отчета не передаются между процессами: чтение, обработка, запись книг и
+    архива идут в одном процессе, архив пишется сразу в result_path. Этап и число
+    записанных книг пишутся в файл JOB_PROGRESS_NAME каталога задачи work_dir.
+    """
+    progress_path = os.path.join(work_dir, JOB_PROGRESS_NAME)
+    write_job_progress(progress_path, 'read')
+    if chunked:
+        # Большой отчет обрабатывается порциями, этапы идут вперемешку
+        _, files_total = convert_excel_chunked(source, filename, report_type, timestamp, result_path, work_dir)
+        return files_total
+
+    detected_type, df = read_excel_report(source, report_type)
+    write_job_progress(progress_path, 'process')
+    partitions = partition_report(df, detected_type)
+    del df
+    if not partitions:
+        raise Exception("Не удалось создать выходные файлы")
+
+    # Книги пишутся в архив по одной: в памяти не больше одной готовой книги
+    files_total = len(partitions)
+    write_job_progress(progress_path, 'write', files_total)
+    temp_path = os.path.join(work_dir, 'results.zip')
+    with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        while partitions:
+            file_suffix, sheet_name, df_filtered, add_totals, totals = partitions.pop(0)
+            data = write_partition(df_filtered, sheet_name, add_totals, totals)
+            with stage('zip'):
+                zipf.writestr(f"processed_{file_suffix}_{timestamp}_{filename}", data)
+            write_job_progress(progress_path, 'write', files_total, files_total - len(partitions))
+        write_job_progress(progress_path, 'zip', files_total, files_total)
+    os.makedirs(os.path.dirname(result_path), exist_ok=True)
+    shutil.move(temp_path, result_path)
+    return files_total
+
+class LocalJobStorage:
+    """Хранилище загруженных файлов и готовых архивов задач в локальном каталоге"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def upload_path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.xlsx")
+
+    def result_path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.zip")
+
+    def save_upload(self, job_id: str, fileobj) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.upload_path(job_id)
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(fileobj, f)
+        return path
+
+    def save_result(self, job_id: str, data: bytes) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.result_path(job_id)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def delete_upload(self, job_id: str) -> None:
+        path = self.upload_path(job_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def delete(self, job_id: str) -> None:
+        self.delete_upload(job_id)
+        path = self.result_path(job_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def delete_orphans(self, job_ids: set[str], age: float) -> None:
+        """Удаление файлов старше age, не принадлежащих задачам job_ids (например, после перезапуска)"""
+        if not os.path.isdir(self.directory):
+            return
+        now = time.time()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                job_id = entry.name.split('.')[0]
+                if entry.is_file() and job_id not in job_ids and now - entry.stat().st_mtime > age:
+                    os.remove(entry.path)
+
+class ConversionJob:
+    """Состояние задачи конвертации Excel отчета"""
+
+    def __init__(self, filename: str, report_type: str):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.report_type = report_type
+        self.timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.status = 'queued'
+        self.stage: Optional[str] = None
+        self.stages = {stage: 'pending' for stage in JOB_STAGES}
+        self.files_total = 0
+        self.files_written = 0
+        self.error: Optional[str] = None
+        self.error_status: Optional[int] = None
+        self.cache_key: Optional[str] = None
+        self.mode = 'parallel'
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    def start_stage(self, stage: str) -> None:
+        if self.stage is not None:
+            self.stages[self.stage] = 'done'
+        self.status = 'running'
+        self.stage = stage
+        self.stages[stage] = 'running'
+
+    def finish(self) -> None:
+        for stage in JOB_STAGES:
+            self.stages[stage] = 'done'
+        self.status = 'done'
+        self.stage = None
+        self.finished_at = time.time()
+
+    def update_progress(self, path: str) -> None:
+        """Перенос хода выполнения из файла, который пишет convert_job"""
+        try:
+            with open(path) as f:
+                progress = json.load(f)
+        except (OSError, ValueError):
+            return
+        if progress['stage'] != self.stage:
+            self.start_stage(progress['stage'])
+        self.files_total = progress['files_total']
+        self.files_written = progress['files_written']
+
+    def fail(self, status_code: int, detail: str) -> None:
+        if self.stage is not None:
+            self.stages[self.stage] = 'failed'
+        self.status = 'failed'
+        self.error_status = status_code
+        self.error = detail
+        self.finished_at = time.time()
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "filename": self.filename,
+            "report_type": self.report_type,
+            "status": self.status,
+            "stage": self.stage,
+            "stages": dict(self.stages),
+            "files_total": self.files_total,
+            "files_written": self.files_written,
+            "error": self.error,
+            "created_at": datetime.fromtimestamp(self.created_at).isoformat(),
+            "finished_at": datetime.fromtimestamp(self.finished_at).isoformat() if self.finished_at else None,
+            "expires_at": (datetime.fromtimestamp(self.finished_at + JOB_RESULT_TTL).isoformat()
+                           if self.finished_at else None),
+        }
+
+job_storage = LocalJobStorage(JOB_DIR or os.path.join(TEMP_DIR, "ofd_jobs"))
+jobs: dict[str, ConversionJob] = {}
+job_queue: Optional[asyncio.Queue] = None
+job_tasks: list[asyncio.Task] = []
+
+async def follow_job_progress(job: ConversionJob, path: str) -> None:
+    """Периодическое обновление хода выполнения задачи, пока идет конвертация"""
+    while True:
+        job.update_progress(path)
+        await asyncio.sleep(JOB_PROGRESS_INTERVAL)
+
+async def run_job(job: ConversionJob) -> None:
+    """Выполнение задачи одним вызовом в пуле процессов с общим ограничением по времени
+
+    Ход выполнения по этапам (чтение, обработка, запись книг, упаковка архива)
+    процесс-обработчик передает через файл в рабочем каталоге задачи.
+    """
+    source = job_storage.upload_path(job.id)
+    result_path = job_storage.result_path(job.id)
+    output_bytes = 0
+    metrics = RequestMetrics('/api/jobs (background)')
+    current_metrics.set(metrics)
+    status = 200
+    try:
+        job.start_stage('read')
+        with workspaces.open('job') as work_dir:
+            progress_path = os.path.join(work_dir, JOB_PROGRESS_NAME)
+            progress = asyncio.create_task(follow_job_progress(job, progress_path))
+            try:
+                files_total = await run_conversion(convert_job, source, job.filename, job.report_type,
+                                                   job.timestamp, result_path, work_dir, job.mode == 'chunked')
+            finally:
+                progress.cancel()
+                # Этап, на котором конвертация завершилась или прервалась
+                job.update_progress(progress_path)
+        job.files_total = job.files_written = files_total
+        output_bytes = os.path.getsize(result_path)
+        if job.cache_key and job.mode != 'chunked':
+            archive_data = await run_in_threadpool(Path(result_path).read_bytes)
+            await run_in_threadpool(result_cache.put, job.cache_key, archive_data)
+
+        job.finish()
+        logger.info(f"Job {job.id} completed{' in chunks' if job.mode == 'chunked' else ''}: "
+                    f"{job.files_total} files")
+
+    except HTTPException as e:
+        logger.error(f"Job {job.id} failed: {e.detail}")
+        job.fail(e.status_code, e.detail)
+        status = e.status_code
+    except Exception as e:
+        logger.error(f"Job {job.id} failed: {str(e)}", exc_info=True)
+        job.fail(500, str(e))
+        status = 500
+
     finally:
-        # В finally очищаем только архив, так как он уже прочитан в память
+        await run_in_threadpool(job_storage.delete_upload, job.id)
+        metrics_registry.record_request(metrics, status, output_bytes if status == 200 else 0)
+
+async def job_runner() -> None:
+    """Обработчик очереди задач"""
+    while True:
+        job = await job_queue.get()
         try:
-            if archive_name and os.path.exists(archive_name):
-                os.remove(archive_name)
-                logger.info(f"Cleaned up archive: {archive_name}")
+            await run_job(job)
+        finally:
+            job_queue.task_done()
+
+async def expire_jobs() -> None:
+    """Удаление завершенных задач и их файлов по истечении JOB_RESULT_TTL"""
+    while True:
+        await asyncio.sleep(min(60.0, JOB_RESULT_TTL))
+        now = time.time()
+        for job in list(jobs.values()):
+            if job.finished_at is not None and now - job.finished_at > JOB_RESULT_TTL:
+                jobs.pop(job.id, None)
+                await run_in_threadpool(job_storage.delete, job.id)
+                logger.info(f"Job {job.id} expired")
+        # Файлы задач, потерянных при перезапуске
+        await run_in_threadpool(job_storage.delete_orphans, set(jobs), JOB_RESULT_TTL)
+
+async def clean_workspaces() -> None:
+    """Периодическая очистка рабочих каталогов по возрасту и суммарному размеру"""
+    while True:
+        try:
+            usage = await run_in_threadpool(workspaces.clean)
+            logger.debug(f"Workspaces: {usage['workspaces']}, {usage['bytes']} bytes")
         except Exception as e:
-            logger.error(f"Error cleaning up archive: {str(e)}", exc_info=True)
+            logger.error(f"Workspace cleanup failed: {str(e)}", exc_info=True)
+        await asyncio.sleep(WORKSPACE_CLEAN_INTERVAL)
+
+@app.on_event("startup")
+async def start_job_runners():
+    global job_queue
+    job_queue = asyncio.Queue(maxsize=JOB_QUEUE_SIZE)
+    job_tasks.extend(asyncio.create_task(job_runner()) for _ in range(max(JOB_RUNNERS, 1)))
+    job_tasks.append(asyncio.create_task(expire_jobs()))
+    # Первая очистка сразу: каталоги, оставшиеся от предыдущего запуска
+    job_tasks.append(asyncio.create_task(clean_workspaces()))
+
+def get_job(job_id: str) -> ConversionJob:
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена или срок хранения результата истек")
+    return job
+
+@app.post("/api/jobs")
+async def submit_job(file: UploadFile = File(...), report_type: str = 'checks'):
+    """Постановка Excel отчета в очередь на конвертацию, возвращает идентификатор задачи"""
+    logger.info(f"Job submitted: {file.filename}, тип отчета: {report_type}")
+
+    if not file or not file.filename:
+        raise HTTPException(status_code=400, detail="No file provided")
+    if not str(file.filename).endswith('.xlsx'):
+        raise HTTPException(status_code=400, detail="Only .xlsx files are allowed")
+    if job_queue.full():
+        raise HTTPException(status_code=429, detail="Очередь задач заполнена, повторите позже")
+
+    job = ConversionJob(file.filename, report_type)
+
+    try:
+        # Результат того же файла уже есть в кэше
+        if result_cache.enabled:
+            digest = await run_in_threadpool(file_digest, file.file)
+            job.cache_key = result_key(digest, 'excel', report_type, file.filename)
+            cached = await run_in_threadpool(result_cache.get, job.cache_key)
+            if cached is not None:
+                await run_in_threadpool(job_storage.save_result, job.id, cached)
+                job.finish()
+                jobs[job.id] = job
+                logger.info(f"Job {job.id} completed from cache")
+                return JSONResponse(status_code=202, content=job.to_dict())
+
+        job.mode = await run_in_threadpool(choose_excel_mode, file.file, file.size or 0, report_type)
+        await run_in_threadpool(job_storage.save_upload, job.id, file.file)
+        job_queue.put_nowait(job)
+    except asyncio.QueueFull:
+        await run_in_threadpool(job_storage.delete, job.id)
+        raise HTTPException(status_code=429, detail="Очередь задач заполнена, повторите позже")
+
+    jobs[job.id] = job
+    logger.info(f"Job {job.id} queued, queue size: {job_queue.qsize()}")
+    return JSONResponse(status_code=202, content=job.to_dict())
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(job_id: str):
+    """Состояние задачи и ход выполнения по этапам"""
+    return get_job(job_id).to_dict()
+
+@app.get("/api/jobs/{job_id}/download")
+async def download_job(job_id: str):
+    """Готовый архив задачи"""
+    job = get_job(job_id)
+    if job.status == 'failed':
+        raise HTTPException(status_code=job.error_status or 500, detail=job.error)
+    if job.status != 'done':
+        raise HTTPException(status_code=409, detail="Задача еще выполняется")
+
+    return FileResponse(
+        job_storage.result_path(job.id),
+        media_type='application/zip',
+        filename=f"results_{job.timestamp}.zip"
+    )
+
+@app.get("/api/cache")
+async def cache_stats():
+    """Счетчики кэша результатов"""
+    return {
+        "enabled": result_cache.enabled,
+        "max_bytes": result_cache.max_bytes,
+        "ttl": result_cache.ttl,
+        "disk_dir": result_cache.directory or None,
+        **result_cache.info()
+    }
 
 @app.on_event("shutdown")
 async def cleanup_temp_files():
     """Очистка временных файлов при выключении сервера"""
-    if os.path.exists(TEMP_DIR):
-        try:
-            shutil.rmtree(TEMP_DIR)
-            logger.info("Временная директория очищена")
-        except Exception as e:
-            logger.error(f"Ошибка при очистке временной директории: {str(e)}")
+    for task in job_tasks:
+        task.cancel()
+
+    if worker_pool is not None:
+        worker_pool.shutdown(wait=False, cancel_futures=True)
+        logger.info("Пул обработчиков остановлен")
+
+    # Удаляются только рабочие каталоги этого процесса, остальное содержимое TEMP_DIR не трогаем
+    workspaces.close()
+    logger.info("Рабочие каталоги очищены")
 
 if __name__ == "__main__":
     import uvicorn
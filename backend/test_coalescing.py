@@ -0,0 +1,103 @@
+"""Передача результата одновременным одинаковым запросам (InflightResults)
+
+Запуск из каталога backend:
+    python -m pytest test_coalescing.py
+"""
+import asyncio
+
+import pytest
+
+import main
+
+KEY = 'result-key'
+
+@pytest.fixture
+def inflight(monkeypatch):
+    results = main.InflightResults()
+    monkeypatch.setattr(main, 'inflight', results)
+    monkeypatch.setattr(main, 'JOB_TIMEOUT', 0.05)
+    return results
+
+async def chunks(*parts):
+    for part in parts:
+        yield part
+
+async def never_disconnects():
+    await asyncio.Event().wait()
+
+async def serve(response, send):
+    scope = {'type': 'http', 'asgi': {'spec_version': '2.0'}}
+    await response(scope, never_disconnects, send)
+
+def test_leader_stream_never_iterated(inflight):
+    """Клиент отключился до отдачи архива: ждущий запрос конвертирует файл сам"""
+    async def scenario():
+        leader, future = inflight.lead(KEY)
+        assert leader
+        # Ответ создан, но так и не отдан
+        main.SharedStreamingResponse(KEY, future, chunks(b'zip'))
+
+        waiter, pending = inflight.lead(KEY)
+        assert not waiter
+        assert await inflight.wait(KEY, pending) is None
+        assert future.done()
+
+        # Следующая попытка делает ждавший запрос выполняющим, а не ждет снова
+        leader, own = inflight.lead(KEY)
+        assert leader and own is not future
+
+        # Запоздавший результат прежней конвертации не снимает новую запись
+        inflight.finish(KEY, future, b'stale')
+        waiter, pending = inflight.lead(KEY)
+        assert not waiter and pending is own
+        inflight.finish(KEY, own, b'zip')
+        assert await inflight.wait(KEY, pending) == b'zip'
+
+    asyncio.run(scenario())
+
+def test_send_fails_before_first_chunk(inflight):
+    async def scenario():
+        _, future = inflight.lead(KEY)
+        response = main.SharedStreamingResponse(KEY, future, chunks(b'zip'))
+
+        async def send(message):
+            raise OSError("connection reset")
+
+        # Ошибка отправки приходит из группы задач anyio
+        with pytest.raises((OSError, BaseExceptionGroup)):
+            await serve(response, send)
+        assert future.done() and future.result() is None
+        assert inflight.lead(KEY)[0]
+
+    asyncio.run(scenario())
+
+def test_streamed_archive_is_shared(inflight):
+    async def scenario():
+        _, future = inflight.lead(KEY)
+        response = main.SharedStreamingResponse(KEY, future, chunks(b'z', b'ip'))
+        _, pending = inflight.lead(KEY)
+        sent = []
+
+        async def send(message):
+            sent.append(message.get('body', b''))
+
+        await serve(response, send)
+        assert b''.join(sent) == b'zip'
+        assert await inflight.wait(KEY, pending) == b'zip'
+        assert inflight.stats['shared'] == 1
+
+    asyncio.run(scenario())
+
+def test_large_archive_is_not_shared(inflight, monkeypatch):
+    monkeypatch.setattr(main, 'COALESCE_MAX_BYTES', 2)
+    async def scenario():
+        _, future = inflight.lead(KEY)
+        response = main.SharedStreamingResponse(KEY, future, chunks(b'z', b'ip'))
+
+        async def send(message):
+            pass
+
+        await serve(response, send)
+        assert future.result() is None
+
+    asyncio.run(scenario())
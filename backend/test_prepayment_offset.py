@@ -0,0 +1,89 @@
+"""Сравнение зачета предоплаты apply_prepayment_offset с прежним построчным циклом
+
+Запуск из каталога backend:
+    python -m pytest test_prepayment_offset.py
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+
+PREPAYMENT_COLUMN = 'Зачет предоплаты (аванса) по чеку'
+ITEM_NAMES = ['Хлеб', 'Молоко', 'Кофе', None]
+
+def reference_prepayment_offset(df: pd.DataFrame) -> pd.Series:
+    """Прежний зачет предоплаты: цикл по чекам и их позициям"""
+    df = df.copy()
+    for receipt_num, receipt_df in df.groupby('Номер документа'):
+        if (receipt_df[PREPAYMENT_COLUMN] > 0).any():
+            remaining_prepayment = receipt_df[PREPAYMENT_COLUMN].iloc[0]
+            for idx in receipt_df.index:
+                current_amount = df.loc[idx, 'Сумма товара']
+                if remaining_prepayment <= 0:
+                    break
+                if current_amount >= remaining_prepayment:
+                    df.loc[idx, 'Сумма товара'] = current_amount - remaining_prepayment
+                    same_items_mask = ((df['Номер документа'] == receipt_num) & (df.index > idx)
+                                       & (df['Наименование'] == df.loc[idx, 'Наименование']))
+                    df.loc[same_items_mask, 'Сумма товара'] = 0
+                    remaining_prepayment = 0
+                else:
+                    df.loc[idx, 'Сумма товара'] = 0
+                    remaining_prepayment -= current_amount
+    return df['Сумма товара']
+
+def random_receipts(rng: np.random.Generator, receipts: int) -> pd.DataFrame:
+    """Случайные чеки в копейках: позиции чеков вперемешку, пустые суммы и номера,
+    предоплата меньше, равна и больше суммы позиций"""
+    sizes = rng.integers(1, 6, receipts)
+    numbers = np.repeat(np.arange(receipts), sizes).astype(float)
+    rows = len(numbers)
+    amounts = rng.choice([10, 30, 70, 100, 250, 1000], rows).astype(float)
+    amounts[rng.random(rows) < 0.03] = np.nan
+    numbers[rng.random(rows) < 0.02] = np.nan
+
+    # Предоплата чека в первой строке: случайная или ровно сумма первых позиций
+    prepayment = np.zeros(rows)
+    starts = np.r_[0, np.cumsum(sizes)[:-1]]
+    for start, size in zip(starts, sizes):
+        if rng.random() < 0.5:
+            items = np.nan_to_num(amounts[start:start + size])
+            prepayment[start] = (items[:rng.integers(1, size + 1)].sum() if rng.random() < 0.5
+                                 else rng.integers(1, 3000))
+    df = pd.DataFrame({
+        'Номер документа': numbers,
+        'Наименование': rng.choice(np.array(ITEM_NAMES, dtype=object), rows),
+        'Сумма товара': amounts,
+        PREPAYMENT_COLUMN: prepayment,
+    })
+    if rng.random() < 0.5:
+        df = df.sample(frac=1, random_state=int(rng.integers(1 << 31))).reset_index(drop=True)
+    return df
+
+@pytest.mark.parametrize('seed', range(200))
+def test_matches_loop_in_kopecks(seed):
+    df = random_receipts(np.random.default_rng(seed), 30)
+    expected = reference_prepayment_offset(df)
+    result = main.apply_prepayment_offset(df, PREPAYMENT_COLUMN)
+    pd.testing.assert_series_equal(result, expected, check_dtype=False)
+
+@pytest.mark.parametrize('seed', range(200))
+def test_matches_loop_in_rubles(seed):
+    """Суммы в рублях с дробной частью: результат не зависит от порядка вычитаний"""
+    df = random_receipts(np.random.default_rng(seed), 30)
+    expected = reference_prepayment_offset(df) / main.KOPECKS
+    in_rubles = df.assign(**{col: df[col] / main.KOPECKS for col in ['Сумма товара', PREPAYMENT_COLUMN]})
+    result = main.apply_prepayment_offset(in_rubles, PREPAYMENT_COLUMN)
+    pd.testing.assert_series_equal(result, expected, check_dtype=False, atol=1e-9, rtol=0)
+
+def test_fractional_amounts():
+    # 0.7 - (0.1 + 0.3) и (0.7 - 0.1) - 0.3 различаются в последнем разряде
+    df = pd.DataFrame({
+        'Номер документа': [1, 1, 1],
+        'Наименование': ['Хлеб', 'Молоко', 'Кофе'],
+        'Сумма товара': [0.1, 0.3, 0.3],
+        PREPAYMENT_COLUMN: [0.7, 0, 0],
+    })
+    result = main.apply_prepayment_offset(df, PREPAYMENT_COLUMN)
+    np.testing.assert_allclose(result, [0, 0, 0], atol=1e-9)
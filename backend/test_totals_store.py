@@ -0,0 +1,76 @@
+"""Хранилище итогов кассы: обработка только новых строк и учет строк после отдачи результата
+
+Запуск из каталога backend:
+    python -m pytest test_totals_store.py
+"""
+import pandas as pd
+import pytest
+
+import benchmark
+import main
+
+REGISTER = 'shop-1'
+
+@pytest.fixture(autouse=True)
+def totals_store(monkeypatch, tmp_path):
+    store = main.DailyTotalsStore(str(tmp_path / 'totals.db'))
+    monkeypatch.setattr(main, 'totals_store', store)
+    return store
+
+def upload(df: pd.DataFrame) -> tuple[list, tuple]:
+    _, partitions, update = main.prepare_register_excel(benchmark.to_xlsx(df), 'checks', REGISTER)
+    return partitions, update
+
+def totals_by_suffix(partitions: list) -> dict:
+    return {file_suffix: totals.reset_index(drop=True) for file_suffix, _, _, _, totals in partitions}
+
+def assert_same_totals(result: list, expected: list):
+    result, expected = totals_by_suffix(result), totals_by_suffix(expected)
+    assert result.keys() == expected.keys()
+    for file_suffix, totals in expected.items():
+        pd.testing.assert_frame_equal(result[file_suffix], totals, check_dtype=False)
+
+def test_rows_are_recorded_only_by_apply(totals_store):
+    report = benchmark.generate_checks(300)
+    _, plain = main.prepare_excel(benchmark.to_xlsx(report), 'checks')
+
+    # Повтор до учета, например после прерванной загрузки архива, видит те же новые строки
+    first, update = upload(report)
+    retry, _ = upload(report)
+    assert sum(len(df_part) for _, _, df_part, _, _ in retry) == len(report)
+    assert_same_totals(first, plain)
+    assert_same_totals(retry, plain)
+
+    assert totals_store.apply(update) == len(report)
+    again, update = upload(report)
+    assert update[2].empty
+    assert all(df_part.empty for _, _, df_part, _, _ in again)
+    assert_same_totals(again, plain)
+
+def test_overlapping_updates_count_rows_once(totals_store):
+    report = benchmark.generate_checks(300)
+    _, plain = main.prepare_excel(benchmark.to_xlsx(report), 'checks')
+
+    # Две загрузки прочитали хранилище до учета строк друг друга
+    _, month_to_date = upload(report.iloc[:200])
+    _, full = upload(report)
+    assert totals_store.apply(month_to_date) == 200
+    assert totals_store.apply(full) == 100
+
+    stored, _ = upload(report)
+    assert_same_totals(stored, plain)
+
+def test_partition_without_new_rows_next_to_undated_rows(totals_store):
+    report = benchmark.generate_checks(300)
+    usn = report[report['Тип налогообложения'] == 'УСН доход']
+    _, plain = main.prepare_excel(benchmark.to_xlsx(usn), 'checks')
+    totals_store.apply(upload(usn)[1])
+
+    # У ПАТЕНТ только строки без даты: часть есть в обработке, но не в хранилище,
+    # а у хранимой УСН новых строк нет
+    mixed = report.copy()
+    mixed.loc[mixed['Тип налогообложения'] == 'ПАТЕНТ', 'Дата/время'] = pd.NaT
+    partitions, update = upload(mixed)
+    assert update[2].empty
+    assert [(file_suffix, len(df_part)) for file_suffix, _, df_part, _, _ in partitions] == [('УСН', 0)]
+    assert_same_totals(partitions, plain)